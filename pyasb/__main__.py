@@ -30,16 +30,11 @@ try:
     import time
     
     from input_options import *
-    from image_info import *
     from help import *
-    from astrometry import *
-    from star_calibration import *
-    from load_fitsimage import *
-    from bouguer_fit import *
-    from sky_brightness import *
-    from skymap_plot import *
-    from cloud_coverage import *
-    from write_summary import *
+    from pipeline import *
+    from file_register import ProcessedRegister
+    from watch_folder import FolderWatcher
+    from observation_index import ObservationIndex
 except:
     #raise
     print(str(inspect.stack()[0][2:4][::-1])+\
@@ -59,195 +54,13 @@ config_file_default  = 'config.cfg'
 def handler(signum, frame):
     print 'Signal handler called with signal', signum
     print "CTRL-C pressed"
-    raise SystemExit
-    #sys.exit(0)
+    # Not SystemExit, which is taken as a failed image (see analyze_image)
+    raise KeyboardInterrupt
 
 signal.signal(signal.SIGTERM, handler)
 signal.signal(signal.SIGINT, handler)
 
 
-#@profile
-class LoadImage(object):
-    def __init__(self, InputOptions, ImageInfo, ConfigOptions, input_file=None):
-        # Load Image file list
-        if input_file == None:
-            input_file = InputOptions.fits_filename_list[0]
-        
-        ''' Load fits image '''
-        self.FitsImage = FitsImage(input_file)
-        # Local copy of ImageInfo. We will process it further.
-        self.ImageInfo = ImageInfo
-        self.ImageInfo.read_header(self.FitsImage.fits_Header)
-        self.ImageInfo.config_processing_specificfilter(ConfigOptions)
-        
-        try:
-            self.FitsImage.subtract_corners_background = True
-            self.FitsImage.reduce_science_frame(\
-                self.ImageInfo.darkframe,\
-                self.ImageInfo.sel_flatfield,\
-                MasterBias=None,\
-                Mask=ImageInfo.maskframe,\
-                ImageInfo=self.ImageInfo)
-        except:
-            raise
-            print(inspect.stack()[0][2:4][::-1])
-            print('Cannot reduce science frame')
-        
-        # Flip image if needed
-        self.FitsImage.flip_image_if_needed(self.ImageInfo)
-        
-        self.FitsImage.__clear__()
-        self.output_paths(InputOptions)
-    
-
-    def output_paths(self,InputOptions):
-        # Output file paths (NOTE: should be moved to another file or at least separated function)
-        # Photometric table
-        
-        path_list = [\
-            "photometry_table_path", "skymap_path", "bouguerfit_path", \
-            "skybrightness_map_path", "skybrightness_table_path", \
-            "cloudmap_path", "clouddata_path", "summary_path"]
-        
-        for path in path_list:
-            try: setattr(self.ImageInfo,path,getattr(InputOptions,path))
-            except:
-                try: getattr(InputOptions,path)
-                except: 
-                    setattr(self.ImageInfo,path,False)
-        
-#@profile
-class ImageAnalysis():
-    def __init__(self,Image):
-        ''' Analize image and perform star astrometry & photometry. 
-            Returns ImageInfo and StarCatalog'''
-        self.StarCatalog = StarCatalog(Image.ImageInfo)
-        
-        if (Image.ImageInfo.calibrate_astrometry==True):
-            Image.ImageInfo.skymap_path="screen"
-            TheSkyMap = SkyMap(Image.ImageInfo,Image.FitsImage)
-            TheSkyMap.setup_skymap()
-            TheSkyMap.set_starcatalog(self.StarCatalog)
-            TheSkyMap.astrometry_solver()
-        
-        self.StarCatalog.process_catalog_specific(Image.FitsImage,Image.ImageInfo)
-        self.StarCatalog.save_to_file(Image.ImageInfo)
-        TheSkyMap = SkyMap(Image.ImageInfo,Image.FitsImage)
-        TheSkyMap.setup_skymap()
-        TheSkyMap.set_starcatalog(self.StarCatalog)
-        TheSkyMap.complete_skymap()
-
-'''#@profile
-class MultipleImageAnalysis():
-    def __init__(self,InputOptions):
-        class StarCatalog_():
-            StarList = []
-            StarList_woPhot = []
-        
-        InputFileList = InputOptions.fits_filename_list
-        
-        for EachFile in InputFileList:
-            EachImage = LoadImage(EachFile)
-            EachAnalysis = ImageAnalysis(EachImage)
-            self.StarCatalog.StarList.append(EachAnalysis.StarCatalog.StarList)
-            self.StarCatalog.StarList_woPhot.append(EachAnalysis.StarCatalog.StarList_woPhot)
-'''
-
-#@profile
-class InstrumentCalibration():
-    def __init__(self,ImageInfo,StarCatalog):
-        try:
-            self.BouguerFit = BouguerFit(ImageInfo,StarCatalog)
-        except Exception as e:
-            print(inspect.stack()[0][2:4][::-1])
-            print('Cannot perform the Bouguer Fit. Error is: ')
-            print type(e)
-            print e
-            exit(0)
-            #raise
-        
-
-#@profile
-class MeasureSkyBrightness():
-    def __init__(self,FitsImage,ImageInfo,BouguerFit):
-        ImageCoordinates_ = ImageCoordinates(ImageInfo)
-        TheSkyBrightness = SkyBrightness(\
-                        FitsImage,ImageInfo,ImageCoordinates_,BouguerFit)
-        TheSkyBrightnessGraph = SkyBrightnessGraph(\
-                        TheSkyBrightness,ImageInfo,BouguerFit)
-        
-        '''
-        TheSkyBrightness = SkyBrightness(ImageInfo)
-        TheSkyBrightness.load_mask(altitude_cut=10)
-        TheSkyBrightness.load_sky_image(FitsImage)
-        #TheSkyBrightness.calibrate_image(FitsImage,ImageInfo,BouguerFit)
-        TheSkyBrightness.zernike_decomposition(BouguerFit,npoints=5000,order=10)
-        '''
-        
-        self.SBzenith = TheSkyBrightness.SBzenith
-        self.SBzenith_err = TheSkyBrightness.SBzenith_err
-
-#@profile
-def perform_complete_analysis(InputOptions,ImageInfoCommon,ConfigOptions,input_file):
-    # Load Image into memory & reduce it.
-        # Clean (no leaks)
-        Image_ = LoadImage(InputOptions,ImageInfoCommon,ConfigOptions,input_file)
-        
-        # Look for stars that appears in the catalog, measure their fluxes. Generate starmap.
-        # Clean (no leaks)
-        ImageAnalysis_ = ImageAnalysis(Image_)
-        
-        print('Image date: '+str(Image_.ImageInfo.date_string)+\
-         ', Image filter: '+str(Image_.ImageInfo.used_filter))
-        
-        'Create the needed classes for the summary write'
-        class InstrumentCalibration_:
-            class BouguerFit:
-                class Regression:
-                    mean_zeropoint = -1
-                    error_zeropoint = -1
-                    extinction = -1
-                    error_extinction = -1
-                    Nstars_rel = -1
-                    Nstars_initial = -1
-        
-        try:
-            # Calibrate instrument with image. Generate fit plot.
-            # Clean (no leaks)
-            InstrumentCalibration_ = InstrumentCalibration(\
-                Image_.ImageInfo,
-                ImageAnalysis_.StarCatalog)
-        except:
-            class ImageSkyBrightness:
-                SBzenith = '-1'
-                SBzenith_err = '-1'
-            
-        else:
-            # Measure sky brightness / background. Generate map.
-            ImageSkyBrightness = MeasureSkyBrightness(\
-                Image_.FitsImage,
-                Image_.ImageInfo,
-                InstrumentCalibration_.BouguerFit)
-        
-        '''
-        Even if calibration fails, 
-        we will try to determine cloud coverage
-        and write the summary
-        '''
-        
-        # Detect clouds on image
-        ImageCloudCoverage = CloudCoverage(\
-            Image_,
-            ImageAnalysis_,
-            InstrumentCalibration_.BouguerFit)
-        
-        Summary_ = Summary(Image_, InputOptions, ImageAnalysis_, \
-            InstrumentCalibration_, ImageSkyBrightness, ImageCloudCoverage)
-        
-        #gc.collect()
-        #print(gc.garbage)
-
-
 def get_config_filename(InputOptions):
     config_file = config_file_default
     try:
@@ -261,6 +74,42 @@ def get_config_filename(InputOptions):
     return(config_file)
 
 
+def select_by_date(InputOptions,ImageInfoCommon):
+    ''' Images of the requested dates (-d), from the observation index '''
+    if InputOptions.index_path==False:
+        print(str(inspect.stack()[0][2:4][::-1])+\
+         ': date selection needs an observation index (-idx)')
+        return([])
+    
+    # Nights start at local noon
+    Index = ObservationIndex(InputOptions.index_path,ImageInfoCommon.longitude)
+    if len(InputOptions.index_dirs)>0:
+        Index.update(InputOptions.index_dirs)
+    selected = Index.select(InputOptions.dates,InputOptions.index_filter)
+    print('Images selected from the index: '+str(len(selected)))
+    return(selected)
+
+
+def watch_directories(InputOptions,ImageInfoCommon,ConfigOptions):
+    ''' Daemon mode: analyze the new images as soon as they are complete '''
+    register = None
+    if ImageInfoCommon.watch_register!=False:
+        # Images that failed or timed out are tried again after a restart
+        register = ProcessedRegister(ImageInfoCommon.watch_register,\
+            retry_statuses=['failed','timeout'])
+    
+    Watcher = FolderWatcher(InputOptions.watch_dirs,register,\
+        settle_time=ImageInfoCommon.watch_settle_time,\
+        poll_interval=ImageInfoCommon.watch_poll_interval)
+    
+    for input_file,size,mtime in Watcher.new_files():
+        print('New image: '+str(input_file))
+        result = analyze_image(InputOptions,ImageInfoCommon,ConfigOptions,\
+            input_file,ImageInfoCommon.image_timeout)
+        if register is not None:
+            register.add(input_file,size,mtime,result['status'])
+
+
 if __name__ == '__main__':
     #gc.set_debug(gc.DEBUG_STATS)
     PlatformHelp_ = PlatformHelp()
@@ -278,8 +127,19 @@ if __name__ == '__main__':
         PlatformHelp_.show_help()
         raise SystemExit
     
-    for input_file in InputOptions.fits_filename_list:
-        perform_complete_analysis(InputOptions,ImageInfoCommon,ConfigOptions_,input_file)
+    if InputOptions.date_set==True:
+        InputOptions.fits_filename_list += select_by_date(InputOptions,ImageInfoCommon)
+    
+    try:
+        # Images given with -i or -d first, watching never ends
+        if InputOptions.watch_dirs==False or len(InputOptions.fits_filename_list)>0:
+            analyze_batch(InputOptions,ImageInfoCommon,ConfigOptions_,\
+                InputOptions.fits_filename_list)
+        
+        if InputOptions.watch_dirs!=False:
+            watch_directories(InputOptions,ImageInfoCommon,ConfigOptions_)
+    except KeyboardInterrupt:
+        raise SystemExit
     
     '''gc.collect()
     
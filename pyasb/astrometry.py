@@ -256,9 +256,73 @@ Generate a class that contains a map of coordinates
 that match the Image pixels
 '''
 
+def interpolate_lut(lut,step,xcoords,ycoords,period=None):
+    '''
+    Bilinear interpolation of a table computed every step pixels.
+    xcoords and ycoords are the (1d) pixel coordinates requested,
+    the result has shape [len(ycoords),len(xcoords)].
+    If period is given, values are interpolated along the shortest arc
+    (e.g. azimuths around 0/360 degrees).
+    '''
+    def lerp(a,b,t):
+        d = b-a
+        if period is not None:
+            d = (d+period/2.)%period-period/2.
+        return(a+t*d)
+    
+    x = np.array(xcoords,dtype='float32')/step
+    y = np.array(ycoords,dtype='float32')/step
+    j = np.clip(x.astype(int),0,np.shape(lut)[1]-2)
+    i = np.clip(y.astype(int),0,np.shape(lut)[0]-2)
+    
+    # Separable interpolation, first along rows then along columns
+    rows = lerp(lut[:,j],lut[:,j+1],(x-j)[None,:])
+    result = lerp(rows[i,:],rows[i+1,:],(y-i)[:,None])
+    if period is not None:
+        result = result%period
+    return(result)
+
 class ImageCoordinates():
-    def __init__(self,ImageInfo):
-        self.calculate_altaz(ImageInfo)
+    '''
+    Maps of horizontal coordinates for each pixel of the image.
+    Maps only depend on the image geometry (the sidereal time cancels
+    in the derotation), so they are kept and shared between images.
+    '''
+    
+    cached_maps = {}
+    max_cached_maps = 2
+    
+    def __init__(self,ImageInfo,derotate=None):
+        if derotate is None:
+            derotate = getattr(ImageInfo,'derotate_coordinates',False)
+        if ImageInfo.latitude_offset==0 and ImageInfo.longitude_offset==0:
+            derotate = False
+        
+        key = self.geometry_key(ImageInfo,derotate)
+        if key in self.cached_maps:
+            self.azimuth_map,self.altitude_map = self.cached_maps[key]
+            return(None)
+        
+        if derotate==True:
+            self.calculate_altaz_lut(ImageInfo,\
+                step=getattr(ImageInfo,'coordinates_lut_step',8))
+        else:
+            self.calculate_altaz(ImageInfo)
+        
+        self.azimuth_map.flags.writeable = False
+        self.altitude_map.flags.writeable = False
+        if len(self.cached_maps)>=self.max_cached_maps:
+            self.cached_maps.clear()
+        self.cached_maps[key] = (self.azimuth_map,self.altitude_map)
+    
+    @staticmethod
+    def geometry_key(ImageInfo,derotate):
+        return(tuple(ImageInfo.resolution)+(\
+            ImageInfo.projection, ImageInfo.radial_factor,\
+            ImageInfo.azimuth_zeropoint, ImageInfo.delta_x, ImageInfo.delta_y,\
+            ImageInfo.latitude, ImageInfo.latitude_offset,\
+            ImageInfo.longitude_offset, derotate,\
+            getattr(ImageInfo,'coordinates_lut_step',8)))
     
     def calculate_altaz(self,ImageInfo):
         ''' Reimplementation with numpy arrays (fast on large arrays). 
@@ -273,3 +337,44 @@ class ImageCoordinates():
         az,alt = xy2horiz(X,Y,ImageInfo,derotate=False)
         self.azimuth_map = np.array(az,dtype='float16')
         self.altitude_map = np.array(alt,dtype='float16')
+    
+    def calculate_altaz_lut(self,ImageInfo,step=8,max_error=0.05):
+        '''
+        Derotated (real) altitude and azimuth maps. The exact
+        transformation is only computed every step pixels and the
+        rest is interpolated. The table is refined until the error at
+        the center of the cells (the worst case for the bilinear 
+        interpolation) is below max_error degrees above the horizon.
+        '''
+        nx,ny = ImageInfo.resolution[0],ImageInfo.resolution[1]
+        
+        while True:
+            xlut = step*np.arange(int(np.ceil((nx-1.)/step))+1)
+            ylut = step*np.arange(int(np.ceil((ny-1.)/step))+1)
+            Xlut,Ylut = np.meshgrid(xlut,ylut)
+            az_lut,alt_lut = xy2horiz(Xlut,Ylut,ImageInfo,derotate=True)
+            
+            # Error at the center of each cell
+            xmid,ymid = xlut[:-1]+step/2.,ylut[:-1]+step/2.
+            Xmid,Ymid = np.meshgrid(xmid,ymid)
+            az_mid,alt_mid = xy2horiz(Xmid,Ymid,ImageInfo,derotate=True)
+            az_int  = interpolate_lut(az_lut,step,xmid,ymid,period=360)
+            alt_int = interpolate_lut(alt_lut,step,xmid,ymid)
+            
+            az_error = (az_int-az_mid+180)%360-180
+            error = np.sqrt((alt_int-alt_mid)**2+\
+                (az_error*np.cos(alt_mid*np.pi/180.))**2)
+            above_horizon = alt_mid>0
+            self.lut_error = np.max(error[above_horizon]) if np.any(above_horizon) else 0
+            
+            if self.lut_error<=max_error or step<=1:
+                break
+            step = max(1,step//2)
+        
+        self.lut_step = step
+        x = np.arange(nx)
+        y = np.arange(ny)
+        self.azimuth_map  = np.array(\
+            interpolate_lut(az_lut,step,x,y,period=360),dtype='float16')
+        self.altitude_map = np.array(\
+            interpolate_lut(alt_lut,step,x,y),dtype='float16')
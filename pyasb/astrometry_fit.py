@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+'''
+PyASB astrometric solution fitting.
+
+Fit the camera projection parameters (radial factor, azimuth
+zeropoint, optical axis displacement and zenith pointing offsets)
+to pairs of horizontal coordinates and measured image positions.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+try:
+    import sys,os,inspect
+    import datetime
+    import numpy as np
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+
+# Order of the parameters in the solution vectors
+projection_parameter_names = [\
+    "radial_factor", "azimuth_zeropoint", "delta_x", "delta_y",\
+    "latitude_offset", "longitude_offset"]
+
+deg = np.pi/180.
+
+def get_projection_parameters(ImageInfo):
+    ''' Return the current astrometric solution as an array '''
+    return(np.array([float(getattr(ImageInfo,name)) \
+        for name in projection_parameter_names]))
+
+def set_projection_parameters(ImageInfo,params):
+    ''' Store the given astrometric solution in ImageInfo '''
+    for name,value in zip(projection_parameter_names,params):
+        setattr(ImageInfo,name,float(value))
+
+'''
+Projection model.
+Pure function of the parameters, equivalent to astrometry.horiz2xy
+with derotate=True, but with closed-form derivatives.
+'''
+
+def _pointing_matrix(latitude):
+    # Horizontal <-> hour angle frame (the matrix is its own inverse).
+    # Horizontal vectors are (North, East, Up)
+    sinl,cosl = np.sin(latitude),np.cos(latitude)
+    return(np.array([[-sinl,0,cosl],[0,-1,0],[cosl,0,sinl]]))
+
+def _pointing_matrix_derivative(latitude):
+    sinl,cosl = np.sin(latitude),np.cos(latitude)
+    return(np.array([[-cosl,0,-sinl],[0,0,0],[-sinl,0,cosl]]))
+
+def _hourangle_matrix(angle):
+    sina,cosa = np.sin(angle),np.cos(angle)
+    return(np.array([[cosa,-sina,0],[sina,cosa,0],[0,0,1]]))
+
+def _hourangle_matrix_derivative(angle):
+    sina,cosa = np.sin(angle),np.cos(angle)
+    return(np.array([[-sina,-cosa,0],[cosa,-sina,0],[0,0,0]]))
+
+def projection_model(params,azimuth,altitude,resolution,latitude,\
+ projection='ZEA',jacobian=False):
+    '''
+    Return X,Y image positions of the given horizontal coordinates
+    (degrees) for the parameter vector params.
+    If jacobian is True, also return dX/dparams and dY/dparams
+    (arrays of shape [npoints,nparams]).
+    '''
+    radial_factor,azimuth_zeropoint,delta_x,delta_y,\
+     latitude_offset,longitude_offset = params
+
+    azimuth  = np.atleast_1d(np.array(azimuth,dtype=float))*deg
+    altitude = np.atleast_1d(np.array(altitude,dtype=float))*deg
+
+    vector = np.array([\
+        np.cos(altitude)*np.cos(azimuth),\
+        np.cos(altitude)*np.sin(azimuth),\
+        np.sin(altitude)])
+
+    # Derotation: real horizontal coordinates -> camera ones.
+    # Only depends on the site latitude, the sidereal time cancels out.
+    lat_real   = latitude*deg
+    lat_camera = (latitude-latitude_offset)*deg
+    hourangle_shift = -longitude_offset*deg
+
+    M_real   = _pointing_matrix(lat_real)
+    M_camera = _pointing_matrix(lat_camera)
+    Rz       = _hourangle_matrix(hourangle_shift)
+    rotated  = np.dot(M_camera,np.dot(Rz,np.dot(M_real,vector)))
+
+    hx,hy,hz = rotated
+    hz = np.clip(hz,-1,1)
+    rho = np.sqrt(hx**2+hy**2)
+    scale = radial_factor/deg
+
+    if projection == 'ZEA':
+        radius = scale*np.sqrt(2*(1-hz))
+    elif projection == 'ARC':
+        radius = scale*(1-np.arcsin(hz)/(90*deg))
+    else:
+        raise ValueError('Unknown projection '+str(projection))
+
+    angle = np.arctan2(hy,hx)-azimuth_zeropoint*deg
+    cosu,sinu = np.cos(angle),np.sin(angle)
+
+    X = resolution[0]//2 - delta_x + radius*cosu
+    Y = resolution[1]//2 + delta_y + radius*sinu
+
+    if jacobian==False:
+        return(X,Y)
+
+    npoints = np.size(X)
+    dX = np.zeros((npoints,6))
+    dY = np.zeros((npoints,6))
+
+    # radial_factor and azimuth_zeropoint
+    dX[:,0] = cosu*radius/radial_factor
+    dY[:,0] = sinu*radius/radial_factor
+    dX[:,1] = radius*sinu*deg
+    dY[:,1] = -radius*cosu*deg
+    # optical axis displacement
+    dX[:,2] = -1
+    dY[:,3] = +1
+
+    # zenith pointing offsets, through the rotated vector
+    dM_camera = -deg*_pointing_matrix_derivative(lat_camera)
+    dRz       = -deg*_hourangle_matrix_derivative(hourangle_shift)
+    drotated = [\
+        np.dot(dM_camera,np.dot(Rz,np.dot(M_real,vector))),\
+        np.dot(M_camera,np.dot(dRz,np.dot(M_real,vector)))]
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        if projection == 'ZEA':
+            dradius_dhz = -scale**2/radius
+        elif projection == 'ARC':
+            dradius_dhz = -scale/(90*deg)/rho
+        dradius_dhz[~np.isfinite(dradius_dhz)] = 0
+        rho2 = np.where(rho>0,rho**2,np.inf)
+
+    for k,(dhx,dhy,dhz) in enumerate(drotated):
+        dangle  = (hx*dhy-hy*dhx)/rho2
+        dradius = dradius_dhz*dhz
+        dX[:,4+k] = dradius*cosu - radius*sinu*dangle
+        dY[:,4+k] = dradius*sinu + radius*cosu*dangle
+
+    return(X,Y,dX,dY)
+
+'''
+Least squares solver
+'''
+
+def levenberg_marquardt(function,initial,free=None,\
+ max_iterations=100,tolerance=1e-10,damping=1e-3):
+    '''
+    Minimize sum(residuals**2) where function(params) returns the
+    residuals and their jacobian [nresiduals,nparams].
+    Parameters with free==False are kept fixed.
+    Returns the solution, the final cost and the number of iterations.
+    '''
+    params = np.array(initial,dtype=float)
+    if free is None:
+        free = np.ones(np.size(params),dtype=bool)
+    free = np.array(free,dtype=bool)
+
+    residuals,jacobian = function(params)
+    cost = np.sum(residuals**2)
+
+    for iteration in xrange(max_iterations):
+        J  = jacobian[:,free]
+        JJ = np.dot(J.T,J)
+        Jr = np.dot(J.T,residuals)
+        # Marquardt scaling, avoid singular diagonal for unused parameters
+        diagonal = np.diag(JJ).copy()
+        diagonal[diagonal<=0] = 1
+
+        improved = False
+        while damping<1e12:
+            try:
+                step = np.linalg.solve(JJ+damping*np.diag(diagonal),-Jr)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+
+            trial = np.array(params)
+            trial[free] += step
+            trial_residuals,trial_jacobian = function(trial)
+            trial_cost = np.sum(trial_residuals**2)
+            if np.isfinite(trial_cost) and trial_cost<cost:
+                improved = True
+                break
+            damping *= 10
+
+        if not improved:
+            break
+
+        relative_change = (cost-trial_cost)/max(cost,1e-30)
+        params,residuals,jacobian,cost = \
+            trial,trial_residuals,trial_jacobian,trial_cost
+        damping = max(damping/10.,1e-12)
+
+        if relative_change<tolerance:
+            break
+
+    return(params,cost,iteration+1)
+
+def fit_projection(azimuth,altitude,Xcoord,Ycoord,ImageInfo,\
+ initial=None,free=None):
+    '''
+    Fit the projection parameters to the measured positions.
+    Returns the solution and the rms of the residuals (pixels)
+    '''
+    azimuth  = np.array(azimuth,dtype=float)
+    altitude = np.array(altitude,dtype=float)
+    Xcoord   = np.array(Xcoord,dtype=float)
+    Ycoord   = np.array(Ycoord,dtype=float)
+
+    if initial is None:
+        initial = get_projection_parameters(ImageInfo)
+
+    def residuals_and_jacobian(params):
+        X,Y,dX,dY = projection_model(\
+            params,azimuth,altitude,\
+            ImageInfo.resolution,ImageInfo.latitude,\
+            ImageInfo.projection,jacobian=True)
+        return(np.concatenate([X-Xcoord,Y-Ycoord]),np.vstack([dX,dY]))
+
+    solution,cost,niter = levenberg_marquardt(\
+        residuals_and_jacobian,initial,free=free)
+
+    rms = np.sqrt(cost/max(np.size(Xcoord),1))
+    return(solution,rms)
+
+def fit_projection_frames(frames,ImageInfo,initial=None,free=None):
+    '''
+    Fit a single solution to the stars measured in several frames
+    taken with the same camera. frames is a list of 
+    (azimuth,altitude,Xcoord,Ycoord) arrays.
+    The projection model does not depend on the sidereal time,
+    so all the pairs are solved as a single system.
+    '''
+    azimuth,altitude,Xcoord,Ycoord = \
+        [np.concatenate([np.atleast_1d(frame[k]) for frame in frames]) \
+         for k in xrange(4)]
+    return(fit_projection(azimuth,altitude,Xcoord,Ycoord,ImageInfo,\
+        initial=initial,free=free))
+
+def projection_rms(params,azimuth,altitude,Xcoord,Ycoord,ImageInfo):
+    ''' Return the rms distance (pixels) between model and measures '''
+    X,Y = projection_model(params,azimuth,altitude,\
+        ImageInfo.resolution,ImageInfo.latitude,ImageInfo.projection)
+    return(np.sqrt(np.mean((X-np.array(Xcoord))**2+(Y-np.array(Ycoord))**2)))
+
+'''
+Automatic refinement from the detected stars.
+'''
+
+class AstrometryCache():
+    '''
+    Astrometric solutions, one per observatory and night.
+    Solutions are kept in memory and, if a path is given, in small
+    text files (same format as the config file) so that other
+    PyASB processes can use them.
+    '''
+
+    solutions = {}
+
+    def __init__(self,ImageInfo):
+        self.cache_path = getattr(ImageInfo,'astrometry_cache_path',False)
+        self.key = (str(ImageInfo.obs_name),\
+            self.night(ImageInfo.fits_date,ImageInfo.longitude))
+
+    @staticmethod
+    def night(fits_date,longitude=0.0):
+        '''
+        Night identifier. Images before local noon (mean solar time at
+        the longitude, degrees East) belong to the previous night.
+        '''
+        date = datetime.datetime.strptime(fits_date,"%Y%m%d_%H%M%S")
+        return((date+datetime.timedelta(hours=float(longitude)/15.-12)).strftime("%Y%m%d"))
+
+    def filename(self):
+        return(str("%s/AstrometricSolution_%s_%s.txt" \
+            %(self.cache_path,self.key[0],self.key[1])))
+
+    def load(self):
+        ''' Return the cached solution for this night or None '''
+        if self.key in self.solutions:
+            return(self.solutions[self.key])
+
+        if self.cache_path in [False, "False", "false", "F"]:
+            return(None)
+
+        try:
+            values = {}
+            for line in open(self.filename(),'r').readlines():
+                if line[0]=="#" or len(line.split("="))!=2: continue
+                name,value = line.split("=")
+                values[name.strip()] = float(value)
+            params = np.array([values[name] for name in projection_parameter_names])
+        except:
+            return(None)
+        else:
+            self.solutions[self.key] = params
+            return(params)
+
+    def save(self,params,rms,nstars):
+        self.solutions[self.key] = np.array(params)
+
+        if self.cache_path in [False, "False", "false", "F"]:
+            return(None)
+
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
+
+        content = ['# Astrometric solution. rms=%.3f px, %d stars\n' %(rms,nstars)]
+        for name,value in zip(projection_parameter_names,params):
+            content.append('%s = %.8f\n' %(name,value))
+
+        # Write to a temporary file first, other processes may be reading it
+        temporary_filename = self.filename()+'.'+str(os.getpid())
+        cachefile = open(temporary_filename,'w+')
+        cachefile.writelines(content)
+        cachefile.close()
+        os.rename(temporary_filename,self.filename())
+
+def use_cached_astrometry(ImageInfo):
+    ''' Update ImageInfo with the solution cached for its night (if any) '''
+    try:
+        assert(ImageInfo.refine_astrometry==True)
+        params = AstrometryCache(ImageInfo).load()
+        assert(params is not None)
+    except:
+        return(False)
+    else:
+        print('Using cached astrometric solution for this night')
+        set_projection_parameters(ImageInfo,params)
+        return(True)
+
+def refine_astrometry(StarCatalog,ImageInfo,min_stars=10):
+    '''
+    Fit the projection parameters to the predicted (catalog) and
+    measured (centroid) positions of the detected stars.
+    The solution is only accepted if it reduces the residuals.
+    '''
+    try:
+        assert(ImageInfo.refine_astrometry==True)
+    except:
+        return(None)
+
+    StarList = StarCatalog.StarList_Det
+    if len(StarList)<min_stars:
+        print('Skipping astrometric refinement, only %d stars detected' %len(StarList))
+        return(None)
+
+    azimuth  = np.array([Star.azimuth for Star in StarList])
+    altitude = np.array([Star.altit_appa for Star in StarList])
+    Xcoord   = np.array([Star.Xcoord for Star in StarList])
+    Ycoord   = np.array([Star.Ycoord for Star in StarList])
+
+    initial = get_projection_parameters(ImageInfo)
+    initial_rms = projection_rms(initial,azimuth,altitude,Xcoord,Ycoord,ImageInfo)
+    solution,rms = fit_projection(azimuth,altitude,Xcoord,Ycoord,\
+        ImageInfo,initial=initial)
+
+    print('Astrometric refinement: rms %.3f -> %.3f px (%d stars)' \
+     %(initial_rms,rms,len(StarList)))
+
+    if not (np.all(np.isfinite(solution)) and solution[0]>0 and rms<initial_rms):
+        print('Astrometric refinement rejected')
+        return(None)
+
+    solution[1] = solution[1]%360
+
+    set_projection_parameters(ImageInfo,solution)
+    AstrometryCache(ImageInfo).save(solution,rms,len(StarList))
+    return(solution)
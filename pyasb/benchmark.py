@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+'''
+PyASB benchmark suite
+
+Time each stage of the analysis (catalog, reduction, photometry,
+Bouguer fit, sky brightness, clouds, plots) on synthetic images
+(see synthetic_image.py) of several resolutions and star numbers.
+
+Each case is run with only the summary ('summary') and with all the
+tables and figures ('full'); the difference is the cost of the SB
+and cloud grids and the plots. Results are appended to a JSON lines
+file and compared with the previous benchmark run.
+
+The startup time (a new interpreter importing the pipeline) is also
+measured and checked against a budget. matplotlib and the scipy
+modules only used for some outputs must not be imported at startup.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import time
+    import json
+    import platform
+    import subprocess
+    import numpy as np
+    import astropy.io.fits as pyfits
+    from pipeline import *
+    from synthetic_image import SyntheticAllSky,radial_factor_for
+    from instrumentation import PipelineStats
+    from input_options import read_option_pairs
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+output_options = {\
+ 'summary': ['-or'],
+ 'full': ['-or','-ot','-om','-ob','-os','-ost','-ocm','-oct']}
+
+# Imported on demand (see lazy_modules.py), not at startup
+deferred_modules = ['matplotlib','matplotlib.pyplot',\
+ 'scipy.interpolate','scipy.stats','scipy.spatial']
+
+
+class FakeInputOptions:
+    void = None
+
+def git_revision():
+    try:
+        return(subprocess.check_output(['git','rev-parse','--short','HEAD'],\
+         cwd=os.path.dirname(os.path.abspath(__file__)),\
+         stderr=open(os.devnull,'w')).strip())
+    except (OSError,subprocess.CalledProcessError):
+        return('unknown')
+
+def benchmark_config(config_file,resolution,extra_options=[]):
+    '''
+    Config file options with the geometry of the synthetic images
+    (centered, zenith pointing) and without pre-screening, astrometry
+    solving, checkpoints or plot workers (figures are rendered, and timed,
+    in the analysis).
+    '''
+    ConfigOptions_ = ConfigOptions(config_file)
+    for option,value in [\
+     ['radial_factor',radial_factor_for(resolution)],['azimuth_zeropoint',0],\
+     ['delta_x',0],['delta_y',0],['latitude_offset',0],['longitude_offset',0],\
+     ['flip_image',False],['calibrate_astrometry',False],['refine_astrometry',False],\
+     ['derotate_coordinates',False],['prescreen',False],['batch_checkpoint',False],\
+     ['image_timeout',0],['plot_workers',0]]+extra_options:
+        ConfigOptions_.add_option(option,str(value))
+    return(ConfigOptions_)
+
+def synthetic_frames(config_file,frames_dir,resolution,date,used_filter,exposure):
+    ''' Image, MasterDark and FlatField. Generated once, then reused. '''
+    frames = ["%s/Synthetic_%s_%s.fits" %(frames_dir,date,used_filter),\
+     "%s/Synthetic_MasterDark_%ds.fits" %(frames_dir,exposure),\
+     "%s/Synthetic_FlatField_%s.fits" %(frames_dir,used_filter)]
+    if all([os.path.isfile(frame) for frame in frames]):
+        print('Using the synthetic images in '+str(frames_dir))
+        return(frames)
+
+    ConfigOptions_ = benchmark_config(config_file,resolution)
+    ImageInfoCommon = ImageInfo()
+    ImageInfoCommon.config_processing_common(ConfigOptions_,FakeInputOptions)
+    Synthetic = SyntheticAllSky(ImageInfoCommon,ConfigOptions_,\
+     date,exposure,used_filter,resolution)
+    return(Synthetic.save(frames_dir))
+
+def run_case(config_file,frames,resolution,max_star_number,outputs,case_dir,repeat=3):
+    ''' Analyze the synthetic image repeat times. Returns the stats of each run. '''
+    used_filter = ImageTest.correct_filter(pyfits.getheader(frames[0]))
+    ConfigOptions_ = benchmark_config(config_file,resolution,[\
+     ['max_star_number',max_star_number],['darkframe',frames[1]],\
+     ['flatfield_'+used_filter.split('_')[1],frames[2]]])
+
+    analysis_options = ['pyasb','-i',frames[0]]
+    for option in output_options[outputs]:
+        analysis_options += [option,case_dir]
+    InputOptions = ReadOptions(analysis_options)
+    ImageInfoCommon = ImageInfo()
+    ImageInfoCommon.config_processing_common(ConfigOptions_,InputOptions)
+
+    records = []
+    for run in range(repeat):
+        Stats = PipelineStats(frames[0])
+        status = 'failed'
+        try:
+            status = analysis_stages(\
+             InputOptions,ImageInfoCommon,ConfigOptions_,frames[0],Stats)
+        except Exception as e:
+            print(str(inspect.stack()[0][2:4][::-1])+' '+type(e).__name__+': '+str(e))
+        Stats.finish(status,getattr(Stats,'ImageInfo',None))
+        Stats.record.update({'run': run, 'outputs': outputs,\
+         'resolution': list(resolution), 'max_star_number': max_star_number,\
+         'case': '%dx%d_%dstars_%s' %(resolution[0],resolution[1],max_star_number,outputs)})
+        records.append(Stats.record)
+    return(records)
+
+def startup_time(budget,repeat=3):
+    '''
+    Time to start a new interpreter and import the pipeline (best of
+    repeat runs) and deferred modules that were imported anyway.
+    '''
+    check_imports = 'import sys,json; import pipeline; '+\
+     'print(json.dumps([m for m in %s if m in sys.modules]))' %repr(deferred_modules)
+    walls = []
+    for run in range(repeat):
+        wall = time.time()
+        output = subprocess.check_output([sys.executable,'-c',check_imports],\
+         cwd=os.path.dirname(os.path.abspath(__file__)))
+        walls.append(round(time.time()-wall,4))
+    loaded = json.loads(output.strip().split('\n')[-1])
+    record = {'case': 'startup', 'status': 'OK', 'wall': min(walls),\
+     'stages': [{'stage': 'import_pipeline', 'wall': min(walls)}],\
+     'startup_budget': budget, 'deferred_modules_loaded': loaded}
+    if min(walls)>budget or len(loaded)>0:
+        record['status'] = 'over_budget'
+        print('WARNING: startup %.3f s (budget %.3f s), deferred modules loaded: %s' \
+         %(min(walls),budget,', '.join(loaded) if len(loaded)>0 else 'none'))
+    return(record)
+
+def best_times(records):
+    ''' Fastest run of each stage (and of the whole analysis) by case '''
+    times = {}
+    for record in records:
+        case_times = times.setdefault(record['case'],{})
+        for stage in record['stages']+[{'stage': 'total', 'wall': record['wall']}]:
+            case_times[stage['stage']] = min(stage['wall'],\
+             case_times.get(stage['stage'],stage['wall']))
+    return(times)
+
+def compare_with_previous(records,results_file):
+    ''' Print the best times of this run and of the previous run stored '''
+    previous = []
+    if os.path.isfile(results_file):
+        stored = [json.loads(line) for line in open(results_file) if line.strip()!='']
+        if len(stored)>0:
+            last_run = max([record['benchmark_run'] for record in stored])
+            previous = [record for record in stored if record['benchmark_run']==last_run]
+            print('Previous benchmark run: '+str(last_run)+\
+             ' (revision '+str(previous[0].get('revision'))+')')
+
+    current_times,previous_times = best_times(records),best_times(previous)
+    for case in sorted(current_times):
+        print('\n'+case+'\n'+'%-20s %10s %10s %8s' %('stage','time (s)','previous','ratio'))
+        for stage,wall in sorted(current_times[case].items()):
+            before = previous_times.get(case,{}).get(stage)
+            if before is None:
+                print('%-20s %10.3f %10s %8s' %(stage,wall,'-','-'))
+            else:
+                print('%-20s %10.3f %10.3f %8.2f' %(stage,wall,before,wall/max(before,1e-6)))
+
+def save_results(records,results_file):
+    results_dir = os.path.dirname(results_file)
+    if results_dir!='' and not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    results = open(results_file,'a+')
+    for record in records:
+        results.write(json.dumps(record,sort_keys=True)+'\n')
+    results.close()
+
+
+class BenchmarkOptions():
+    '''
+    -c config_file -o work_dir -j results_file
+    -r resolutions (WxH,WxH,...) -n star_numbers (N,N,...)
+    -p outputs (summary,full) -k repeat -b startup_budget (s)
+    '''
+    options = {'-c': 'configfile', '-o': 'work_dir', '-j': 'results_file',\
+     '-r': 'resolutions', '-n': 'star_numbers', '-p': 'outputs', '-k': 'repeat',\
+     '-b': 'startup_budget'}
+
+    def __init__(self,input_options):
+        self.configfile = 'config.cfg'
+        self.work_dir = 'benchmark'
+        self.results_file = None
+        self.resolutions = '1000x1000,2000x2000'
+        self.star_numbers = '100,300'
+        self.outputs = 'summary,full'
+        self.repeat = 3
+        self.startup_budget = 1.5
+
+        read_option_pairs(self,input_options[1:],'benchmark.py')
+
+        self.resolutions = [[int(value) for value in resolution.split('x')] \
+         for resolution in self.resolutions.split(',')]
+        self.star_numbers = [int(value) for value in self.star_numbers.split(',')]
+        self.outputs = self.outputs.split(',')
+        self.repeat = int(self.repeat)
+        self.startup_budget = float(self.startup_budget)
+        if self.results_file is None:
+            self.results_file = self.work_dir+'/benchmark_results.jsonl'
+
+
+if __name__ == '__main__':
+    Options = BenchmarkOptions(sys.argv)
+    benchmark_run = time.strftime('%Y%m%d_%H%M%S',time.gmtime())
+    environment = {'benchmark_run': benchmark_run, 'revision': git_revision(),\
+     'python': platform.python_version(), 'numpy': np.__version__,\
+     'machine': platform.node()+' '+platform.machine()}
+
+    records = [startup_time(Options.startup_budget,Options.repeat)]
+    records[0].update(environment)
+    for resolution in Options.resolutions:
+        frames_dir = '%s/frames_%dx%d' %(Options.work_dir,resolution[0],resolution[1])
+        frames = synthetic_frames(Options.configfile,frames_dir,resolution,\
+         '20130115_220000','Johnson_V',30.)
+        for max_star_number in Options.star_numbers:
+            for outputs in Options.outputs:
+                case_dir = '%s/output_%s' %(Options.work_dir,outputs)
+                for record in run_case(Options.configfile,frames,resolution,\
+                 max_star_number,outputs,case_dir,Options.repeat):
+                    record.update(environment)
+                    records.append(record)
+
+    compare_with_previous(records,Options.results_file)
+    save_results(records,Options.results_file)
+    print('\nResults appended to '+str(Options.results_file))
@@ -28,17 +28,20 @@ __status__ = "Prototype" # "Prototype", "Development", or "Production"
 
 try:
     import sys,os,inspect
-    import matplotlib.pyplot as plt
-    import matplotlib.colors as mpc
-    import matplotlib.patches as mpp
-    import scipy.stats as stats
     import math
     import numpy as np
     import astrometry
+    from lazy_modules import LazyModule
+    from plot_rendering import Renderer,Plots,plot_data
 except:
     print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
     raise SystemExit
 
+stats = LazyModule('scipy.stats')
+# Only needed to draw the Bouguer fit
+mpc = LazyModule('matplotlib.colors')
+mpp = LazyModule('matplotlib.patches')
+
 class BouguerFit():
     def __init__(self,ImageInfo,PhotometricCatalog):
         print('Calculating Instrument zeropoint and extinction ...')
@@ -137,19 +140,13 @@ class BouguerFit():
             print('Skipping BouguerFit Graph')
             return(None)
 
-        ''' Plot photometric data from the bouguer fit '''
+        Plots.submit('bouguer',self.bouguer_plot_data(ImageInfo),ImageInfo)
 
+    def bouguer_plot_data(self,ImageInfo):
+        ''' Plot inputs of the Bouguer plot '''
         xfit = np.linspace(1,astrometry.calculate_airmass(ImageInfo.min_altitude),10)
         yfit = np.polyval([self.Regression.mean_slope,self.Regression.mean_zeropoint],xfit)
 
-        bouguerfigure = plt.figure(figsize=(8,6))
-        bouguerplot = bouguerfigure.add_subplot(111)
-        bouguerplot.set_title('Bouguer extinction law fit\n',size="xx-large")
-        bouguerplot.set_xlabel('Airmass')
-        bouguerplot.set_ylabel(r'$m_0+2.5\log_{10}(F)$',size="large")
-        bouguerplot.errorbar(self.xdata, self.ydata, yerr=self.yerr, fmt='*', ecolor='g')
-        bouguerplot.plot(xfit,yfit,'r-')
-
         try:
             plot_infotext = \
                 ImageInfo.date_string+"\n"+str(ImageInfo.latitude)+5*" "+str(ImageInfo.longitude)+"\n"+\
@@ -160,23 +157,39 @@ class BouguerFit():
                 +str("%.3f"%float(self.Regression.error_slope))+"\n"+\
                 str("%.0f"%(self.Regression.Nstars_rel))+"% of "+\
                 str(self.Regression.Nstars_initial)+" photometric measures shown"
-            bouguerplot.text(0.05,0.05,plot_infotext,fontsize='x-small',transform = bouguerplot.transAxes)
         except:
             print(inspect.stack()[0][2:4][::-1])
             raise
 
+        return(plot_data(ImageInfo,'bouguerfit_path','BouguerFit',\
+            xdata=self.xdata,ydata=self.ydata,yerr=self.yerr,\
+            xfit=xfit,yfit=yfit,infotext=plot_infotext))
+
+
+def bouguer_template(bouguerfigure):
+    ''' Axes and labels of the Bouguer plot (the same for every image) '''
+    bouguerplot = bouguerfigure.add_subplot(111)
+    bouguerplot.set_title('Bouguer extinction law fit\n',size="xx-large")
+    bouguerplot.set_xlabel('Airmass')
+    bouguerplot.set_ylabel(r'$m_0+2.5\log_{10}(F)$',size="large")
+    return(bouguerplot)
+
+def draw_bouguer_plot(PlotData):
+    ''' Plot photometric data from the bouguer fit '''
+    with Renderer.figure('bouguer',PlotData['output_path'],(8,6),\
+     bouguer_template,PlotData['reuse_figures']) as (bouguerfigure,bouguerplot,new):
+        bouguerplot.errorbar(PlotData['xdata'],PlotData['ydata'],\
+            yerr=PlotData['yerr'],fmt='*',ecolor='g')
+        bouguerplot.plot(PlotData['xfit'],PlotData['yfit'],'r-')
+        bouguerplot.text(0.05,0.05,PlotData['infotext'],\
+            fontsize='x-small',transform = bouguerplot.transAxes)
+
         # Show or save the bouguer plot
-        if ImageInfo.bouguerfit_path=="screen":
-            plt.show()
-        else:
-            bouguer_filename = str("%s/BouguerFit_%s_%s_%s.png" %(\
-                ImageInfo.bouguerfit_path, ImageInfo.obs_name,\
-                ImageInfo.fits_date, ImageInfo.used_filter))
-            plt.tight_layout(pad=0)
-            plt.savefig(bouguer_filename,bbox_inches='tight')
-
-        #plt.clf()
-        #plt.close('all')
+        Renderer.output(bouguerfigure,PlotData['output_path'],PlotData['filename'],\
+            tight_layout={'pad':0},bbox_inches='tight')
+
+Plots.register('bouguer',draw_bouguer_plot,'BouguerFit')
+
 
 class TheilSenRegression():
     # Robust Theil Sen estimator, instead of the classic least-squares.
@@ -29,17 +29,21 @@ try:
     import copy
     import numpy as np
     import warnings
-    import scipy.interpolate as sint
-    import matplotlib as mpl
-    import matplotlib.pyplot as plt
-    import matplotlib.colors as mpc
-    import matplotlib.cm as mpcm
-    import matplotlib.patches as mpp
     from star_calibration import StarCatalog
+    from lazy_modules import LazyModule
+    from plot_rendering import Renderer,Plots,plot_data
+    from quicklook_maps import cloudmap_quicklook
 except:
     print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
     raise SystemExit
 
+# Only needed for the cloud map
+sint = LazyModule('scipy.interpolate')
+mpl = LazyModule('matplotlib')
+mpc = LazyModule('matplotlib.colors')
+mpcm = LazyModule('matplotlib.cm')
+mpp = LazyModule('matplotlib.patches')
+
 warnings.simplefilter("ignore", category=RuntimeWarning)
 
 class CloudCoverage():
@@ -91,7 +95,8 @@ class CloudCoverage():
         try:
             assert(\
                 Image.ImageInfo.clouddata_path!=False or\
-                Image.ImageInfo.cloudmap_path!=False)
+                Image.ImageInfo.cloudmap_path!=False or\
+                Image.ImageInfo.cloudmap_quicklook_path!=False)
         except Exception as e:
             #print(inspect.stack()[0][2:4][::-1])
             print('Skipping cloud coverage detection')
@@ -107,7 +112,12 @@ class CloudCoverage():
                 self.StarCatalog.StarList_WithNearbyStar,
                 self.StarCatalog.StarList_TotVisible,BouguerFit)
             self.cloud_map(BouguerFit,ImageInfo=Image.ImageInfo)
+            cloudmap_quicklook(self,Image.ImageInfo)
             self.clouddata_table(ImageInfo=Image.ImageInfo)
+            Results = getattr(Image.ImageInfo,'results',None)
+            if Results is not None:
+                Results.add_grid('cloud_grid',self.ALTdirs,self.AZdirs,\
+                    self.CloudCoverage,self.CloudCoverageErr)
     
     def star_detection(self,Image):
         # relax requisites to get more stars
@@ -220,6 +230,25 @@ class CloudCoverage():
         self.CloudCoverageErr = self.cloud_coverage_error(self.CloudCoverage,PercentageStars,PredictedStars)
         self.CloudCoverage[PredictedStars<2] = None # not enough stars
     
+    @staticmethod
+    def cloudtable_content(ALTdirs,AZdirs,CloudCoverage,CloudCoverageErr):
+        header = '#Altitude\Azimuth'
+        for az_ in  AZdirs:
+            header += ', '+str(az_)
+        header+='\n'
+        
+        content = [header]
+        
+        for k,alt_ in enumerate(ALTdirs):
+            line = str(alt_)
+            for j in xrange(len(AZdirs)):
+                line += ', '+str("%.3f +/- %.3f" %\
+                 (float(CloudCoverage[k][j]), \
+                 float(CloudCoverageErr[k][j])))
+            line+='\n'
+            content.append(line)
+        return(content)
+    
     def clouddata_table(self,ImageInfo):
         try:
             assert(ImageInfo.clouddata_path!=False)
@@ -228,21 +257,8 @@ class CloudCoverage():
             print('Skipping write clouddata table to file')
         else:
             print('Write clouddata table to file')
-            header = '#Altitude\Azimuth'
-            for az_ in  self.AZdirs:
-                header += ', '+str(az_)
-            header+='\n'
-            
-            content = [header]
-            
-            for k,alt_ in enumerate(self.ALTdirs):
-                line = str(alt_)
-                for j in xrange(len(self.AZdirs)):
-                    line += ', '+str("%.3f +/- %.3f" %\
-                     (float(self.CloudCoverage[k][j]), \
-                     float(self.CloudCoverageErr[k][j])))
-                line+='\n'
-                content.append(line)
+            content = self.cloudtable_content(\
+                self.ALTdirs,self.AZdirs,self.CloudCoverage,self.CloudCoverageErr)
             
             if ImageInfo.clouddata_path == "screen":
                 print(content)
@@ -265,18 +281,62 @@ class CloudCoverage():
         else:
             print('Output cloudmap')
         
-        ''' Create the cloud map '''
-        self.Cloudfigure = plt.figure(figsize=(8,7.5))
-        self.Cloudgraph  = self.Cloudfigure.add_subplot(111,projection='polar')
-        
-        
+        Plots.submit('cloudmap',self.cloudmap_plot_data(BouguerFit,ImageInfo),ImageInfo)
+
+    def cloudmap_plot_data(self,BouguerFit,ImageInfo):
+        ''' Plot inputs of the cloud map: cloud coverage grid and texts '''
+        image_information = str(ImageInfo.date_string)+" UTC\n"+str(ImageInfo.latitude)+5*" "+\
+            str(ImageInfo.longitude)+"\n"+ImageInfo.used_filter+4*" "+\
+            "K="+str("%.3f" % float(BouguerFit.Regression.extinction))+"+-"+\
+            str("%.3f" % float(BouguerFit.Regression.error_extinction))+"\n"+\
+            str("Cloud coverage: %.3f +/- %.3f" %\
+             (float(self.mean_cloudcover),float(self.error_cloudcover)))
+
+        return(plot_data(ImageInfo,'cloudmap_path','CloudMap',\
+            AZgrid=np.array(self.AZgrid),ZDgrid=np.array(self.ZDgrid),\
+            CloudCoverage=np.array(self.CloudCoverage,dtype=float),\
+            title=ImageInfo.cloudmap_title,image_information=image_information))
+
+
+class CloudMap():
+    ''' Draw the cloud map from its plot inputs '''
+    def __init__(self,PlotData):
+        with Renderer.figure('cloudmap',PlotData['output_path'],(8,7.5),\
+         self.cloud_map_template,PlotData['reuse_figures']) as \
+         (self.Cloudfigure,self.Cloudgraph,new):
+            self.draw_cloud_map(PlotData,new)
+            Renderer.output(self.Cloudfigure,PlotData['output_path'],PlotData['filename'],\
+                tight_layout={'pad':-1.5,'rect':[0.1,0.05,1.,0.95]})
+
+    @staticmethod
+    def cloud_map_template(Cloudfigure):
+        ''' Polar axes, ticks and grid (the same for every image) '''
+        Cloudgraph = Cloudfigure.add_subplot(111,projection='polar')
+
+        radial_locator = np.arange(10,90+1,10)
+        radial_label = ["$80$","$70$","$60$","$50$","$40$","$30$","$20$","$10$","$0$"]
+        theta_locator = np.arange(0,360,45)
+        theta_label = ["$N$","$NE$","$E$","$SE$","$S$","$SW$","$W$","$NW$"]
+
+        Cloudgraph.set_rgrids(radial_locator,radial_label,\
+         size="large",color='k',alpha=0.75)
+        Cloudgraph.set_thetagrids(theta_locator,theta_label,size="large")
+        # rotate the graph (North up)
+        Cloudgraph.set_theta_direction(-1)
+        Cloudgraph.set_theta_offset(np.pi/2)
+        Cloudgraph.grid(True)
+        return(Cloudgraph)
+
+    def draw_cloud_map(self,PlotData,new=True):
+        ''' Data, colorbar (only in new figures) and information text '''
         # Grid and interpolate data
         self.AZgridi,self.ZDgridi = np.mgrid[0:2*np.pi:1000j, 0:90:1000j]
         self.ALTgridi = 90. - self.ZDgridi
-        coord_reshape = np.array([[self.AZgrid[j][k],self.ZDgrid[j][k]] \
-            for k in xrange(len(self.AZgrid[0])) for j in xrange(len(self.AZgrid))])
-        data_reshape = np.array([self.CloudCoverage[j][k] \
-            for k in xrange(len(self.AZgrid[0])) for j in xrange(len(self.AZgrid))])
+        AZgrid,ZDgrid = PlotData['AZgrid'],PlotData['ZDgrid']
+        coord_reshape = np.array([[AZgrid[j][k],ZDgrid[j][k]] \
+            for k in xrange(len(AZgrid[0])) for j in xrange(len(AZgrid))])
+        data_reshape = np.array([PlotData['CloudCoverage'][j][k] \
+            for k in xrange(len(AZgrid[0])) for j in xrange(len(AZgrid))])
         self.CloudCoveragei = sint.griddata(coord_reshape,data_reshape, \
             (self.AZgridi,self.ZDgridi), method='nearest')
         
@@ -302,67 +362,30 @@ class CloudCoverage():
             vmax=1,
             cmap=cloud_cmap)
         
-        # Ticks
-        def ticks_and_locators():
-            ''' Add ticks to the graph '''
-            radial_locator = np.arange(10,90+1,10)
-            radial_label = ["$80$","$70$","$60$","$50$","$40$","$30$","$20$","$10$","$0$"]
-            theta_locator = np.arange(0,360,45)
-            theta_label = ["$N$","$NE$","$E$","$SE$","$S$","$SW$","$W$","$NW$"]
-            
-            self.Cloudgraph.set_rgrids(radial_locator,radial_label,\
-             size="large",color='k',alpha=0.75)
-            self.Cloudgraph.set_thetagrids(theta_locator,theta_label,size="large")
-            # rotate the graph (North up)
-            self.Cloudgraph.set_theta_direction(-1)
-            self.Cloudgraph.set_theta_offset(np.pi/2)
-        
-        self.Cloudgraph.grid(True)
-        
         # Colorbar
         def color_bar():
             ''' Add the colorbar '''
             # Separation between colour bar and graph
             self.Cloudfigure.subplots_adjust(right=1)
             # Color bar 
-            self.Cloudcolorbar = plt.colorbar(\
-             self.ColorMesh,orientation='vertical',pad=0.07,shrink=0.75)
+            # Not linked to the mesh, the colorbar is kept when the figure is reused
+            ColorScale = mpcm.ScalarMappable(norm=mpc.Normalize(vmin=0,vmax=1),cmap=cloud_cmap)
+            ColorScale.set_array(np.array([]))
+            self.Cloudcolorbar = self.Cloudfigure.colorbar(\
+             ColorScale,ax=self.Cloudgraph,orientation='vertical',pad=0.07,shrink=0.75)
             self.Cloudfigure.subplots_adjust(right=0.80) # Restore separation
             #self.ColorMesh.set_clim(0.0,1.0)
             self.Cloudcolorbar.set_ticks(np.arange(0,1+1e-6,0.1))
             self.Cloudcolorbar.set_label("Cloud Coverage",rotation="vertical",size="large")
         
-        
-        # Ticks and colorbar
-        ticks_and_locators()
-        color_bar()
+        # The colorbar (fixed limits) is kept when the figure is reused
+        if new: color_bar()
         
         # Information text on image
-        self.Cloudgraph.text(0,np.max(self.ZDgridi)+15, unicode(ImageInfo.cloudmap_title, 'utf-8'),\
+        self.Cloudgraph.text(0,np.max(self.ZDgridi)+15, unicode(PlotData['title'], 'utf-8'),\
             horizontalalignment='center',size='xx-large')
         # Image information
-        image_information = str(ImageInfo.date_string)+" UTC\n"+str(ImageInfo.latitude)+5*" "+\
-            str(ImageInfo.longitude)+"\n"+ImageInfo.used_filter+4*" "+\
-            "K="+str("%.3f" % float(BouguerFit.Regression.extinction))+"+-"+\
-            str("%.3f" % float(BouguerFit.Regression.error_extinction))+"\n"+\
-            str("Cloud coverage: %.3f +/- %.3f" %\
-             (float(self.mean_cloudcover),float(self.error_cloudcover)))
-        
-        self.Cloudgraph.text(5*np.pi/4,145,unicode(image_information,'utf-8'),fontsize='x-small')
-        
-        if ImageInfo.cloudmap_path=="screen":
-            plt.show()
-        else:
-            cloudmap_filename = str("%s/CloudMap_%s_%s_%s.png" %(\
-                ImageInfo.cloudmap_path, ImageInfo.obs_name,\
-                ImageInfo.fits_date, ImageInfo.used_filter))
-            plt.tight_layout(pad=-1.5,rect=[0.1,0.05,1.,0.95])
-            plt.savefig(cloudmap_filename)
-        
-        #plt.clf()
-        #plt.close('all')
-        
-        
-        
-        
-    
+        self.Cloudgraph.text(5*np.pi/4,145,unicode(PlotData['image_information'],'utf-8'),\
+            fontsize='x-small')
+
+Plots.register('cloudmap',CloudMap,'CloudMap')
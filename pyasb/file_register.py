@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+'''
+Register of analyzed files
+
+Append-only log of the files already analyzed, loaded in memory
+as a set. Each line has the file path, size and modification time
+(tab separated), so a file that changes is analyzed again, optionally
+followed by other fields (e.g. the result of the analysis). Old
+registers with only the path are still understood.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import threading
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+
+class ProcessedRegister():
+    '''
+    Set of (path, size, mtime) of the analyzed files.
+    Lookups don't read the file, updates are single appends (safe
+    between threads of the same process and between processes).
+    Files whose last status (first extra field) is in retry_statuses
+    are not taken as analyzed, so they are tried again.
+    '''
+    def __init__(self,register_filename,retry_statuses=[]):
+        self.register_filename = register_filename
+        self.retry_statuses = list(retry_statuses)
+        self.lock = threading.Lock()
+        self.entries = set()
+        self.legacy_entries = set()
+        self.load()
+
+    @staticmethod
+    def entry(path,size=None,mtime=None):
+        size  = None if size in [None,''] else int(size)
+        mtime = None if mtime in [None,''] else int(float(mtime))
+        return((str(path),size,mtime))
+
+    def load(self):
+        if not os.path.isfile(self.register_filename):
+            return
+
+        for line in open(self.register_filename,'r'):
+            line = line.replace('\r','').replace('\n','')
+            if line=='': continue
+            fields = line.split('\t')
+            if len(fields)>=3:
+                try:
+                    self.update(self.entry(*fields[:3]),fields[3:4])
+                    continue
+                except ValueError:
+                    pass
+            # Old register format, only the path
+            self.legacy_entries.add(fields[0])
+
+    def update(self,entry,fields):
+        # The last line of a file wins
+        if len(fields)>0 and str(fields[0]) in self.retry_statuses:
+            self.entries.discard(entry)
+        else:
+            self.entries.add(entry)
+
+    def __len__(self):
+        return(len(self.entries)+len(self.legacy_entries))
+
+    def contains(self,path,size=None,mtime=None):
+        ''' True if the file (with this size and mtime) was analyzed '''
+        if str(path) in self.legacy_entries:
+            return(True)
+        return(self.entry(path,size,mtime) in self.entries)
+
+    def add(self,path,size=None,mtime=None,*fields):
+        ''' Append the file (and any extra fields) to the register '''
+        path,size,mtime = self.entry(path,size,mtime)
+        fields = [' '.join(str(field).split()) for field in fields]
+        line = '\t'.join([path,'' if size is None else str(size),\
+            '' if mtime is None else str(mtime)]+fields)+'\r\n'
+
+        with self.lock:
+            register_dir = os.path.dirname(self.register_filename)
+            if register_dir!='' and not os.path.exists(register_dir):
+                os.makedirs(register_dir)
+            # O_APPEND writes of a single line are not interleaved
+            register_fd = os.open(self.register_filename,\
+                os.O_WRONLY|os.O_APPEND|os.O_CREAT,0644)
+            try: os.write(register_fd,line)
+            finally: os.close(register_fd)
+            self.update((path,size,mtime),fields[0:1])
@@ -29,10 +29,17 @@ try:
     import datetime
     import time
     import signal
-    import urllib
+    import shutil
+    import io
+    import stat
+    import json
+    import tempfile
+    import threading
+    import Queue
     import gzip
     import ftputil
-    import pyfits
+    from file_register import ProcessedRegister
+    from pipeline import *
 except:
     print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
     raise SystemExit
@@ -51,9 +58,7 @@ cloudmap_path = base_dir+"/cloudmaps/"
 clouddata_table_path = base_dir+"/clouddata/"
 summary_path = base_dir+"/summary/"
 register_analyzed_files = base_dir+"/register.txt"
-
-ftp_images_since_reconnect = 0
-ftp_max_images_until_reconnect = 20
+remote_listing_cache = base_dir+"/remote_listing.json"
 
 
 '''
@@ -65,31 +70,129 @@ ftp_max_images_until_reconnect = 20
 def handler(signum, frame):
         print 'Signal handler called with signal', signum
         print "CTRL-C pressed"
-        sys.exit(0)
+        # Not SystemExit, which is taken as a failed image (see analyze_image)
+        raise KeyboardInterrupt
 
 signal.signal(signal.SIGTERM, handler)
 signal.signal(signal.SIGINT, handler)
 
 
+class FtpDownloader(threading.Thread):
+    '''
+    Download worker. Keeps its own FTP connection open between files and
+    puts the local copies in a bounded queue, waiting while it is full.
+    With in_memory, the copies are memory buffers instead of files in
+    download_dir (a directory of this process, see perform_analysis).
+    '''
+    def __init__(self,worker_id,host_factory,remote_queue,local_queue,download_dir,\
+     max_retries=3,in_memory=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.worker_id = worker_id
+        self.host_factory = host_factory
+        self.remote_queue = remote_queue
+        self.local_queue = local_queue
+        self.max_retries = max_retries
+        self.in_memory = in_memory
+        self.download_dir = download_dir
+        self.ndownloads = 0
+        self.host = None
+    
+    def connect(self):
+        if self.host is None:
+            self.host = self.host_factory()
+    
+    def disconnect(self):
+        if self.host is not None:
+            try: self.host.close()
+            except: pass
+            self.host = None
+    
+    def download(self,remote_filename,local_filename=None):
+        '''
+        Binary copy of the remote file, renamed when complete.
+        Without local_filename, returns a memory buffer with the file.
+        '''
+        self.connect()
+        remote_file = self.host.open(remote_filename,'rb')
+        try:
+            if local_filename is None:
+                local_copy = io.BytesIO()
+                shutil.copyfileobj(remote_file,local_copy,1<<20)
+                local_copy.seek(0)
+                return(local_copy)
+            
+            local_file = open(local_filename+'.part','wb')
+            try:
+                try: shutil.copyfileobj(remote_file,local_file,1<<20)
+                finally: local_file.close()
+            except:
+                # Don't leave partial copies behind
+                os.remove(local_filename+'.part')
+                raise
+        finally:
+            remote_file.close()
+        os.rename(local_filename+'.part',local_filename)
+        return(local_filename)
+    
+    def run(self):
+        while True:
+            remote_filename = self.remote_queue.get()
+            if remote_filename is None: break
+            
+            self.ndownloads += 1
+            local_filename = None
+            if self.in_memory==False:
+                local_filename = '%s/pyasb_%d_%d.fits' \
+                 %(self.download_dir,self.worker_id,self.ndownloads)
+            
+            for attempt in xrange(self.max_retries):
+                try:
+                    local_copy = self.download(remote_filename,local_filename)
+                except Exception as e:
+                    print(str(inspect.stack()[0][2:4][::-1])+\
+                     ' Download of '+str(remote_filename)+' failed: '+str(e))
+                    # The connection may be broken, open a new one
+                    self.disconnect()
+                    time.sleep(2**attempt)
+                else:
+                    break
+            else:
+                local_copy = None
+            
+            self.local_queue.put((remote_filename,local_copy))
+        
+        self.disconnect()
+
+
 class FtpSession():
-    def __init__(self,ftp_server,ftp_user,ftp_pass,ftp_basedir,analysis_basedir):
+    def __init__(self,ftp_server,ftp_user,ftp_pass,ftp_basedir,analysis_basedir,\
+     host_factory=None,rescan=False,recent_dirs=2):
         self.ftp_server  = ftp_server
         self.ftp_user    = ftp_user
         self.ftp_pass    = ftp_pass
         self.ftp_basedir = ftp_basedir
         
-        self.ftp_connect()
-        self.fitslist = []
-        self.fits_search_remotepath(basedir=ftp_basedir)
-        self.ftp_disconnect()
+        # Anything with the FTPHost interface (open, listdir, lstat, close) can be used
+        if host_factory is None:
+            host_factory = lambda: ftputil.FTPHost(\
+             self.ftp_server,self.ftp_user,self.ftp_pass)
+        self.host_factory = host_factory
         
         self.update_dirs_path(analysis_basedir)
         self.create_analysis_paths()
+        
+        self.ftp_connect()
+        self.fitslist = []
+        self.fitsinfo = {}
+        self.fits_search_remotepath(basedir=ftp_basedir,\
+         rescan=rescan,recent_dirs=recent_dirs)
+        self.ftp_disconnect()
         #self.perform_analysis()
     
     def ftp_connect(self):
         ''' Establish FTP connection. Returns ftp session '''
-        self.ftp = ftputil.FTPHost(ftp_server,ftp_user,ftp_pass)
+        self.ftp = self.host_factory()
     
     def ftp_disconnect(self):
         ''' End FTP connection '''
@@ -113,7 +216,8 @@ class FtpSession():
         try:
             global base_dir,temporary_path,skymap_path,photometry_table_path,\
               bouguerfit_path,skybrightness_map_path,skybrightness_table_path,\
-              cloudmap_path,clouddata_table_path,summary_path,register_analyzed_files
+              cloudmap_path,clouddata_table_path,summary_path,register_analyzed_files,\
+              remote_listing_cache
             
             base_dir = analysis_basedir
             temporary_path = "/tmp/"
@@ -126,27 +230,10 @@ class FtpSession():
             clouddata_table_path = base_dir+"/clouddata/"
             summary_path = base_dir+"/summary/"
             register_analyzed_files = base_dir+"/register.txt"
+            remote_listing_cache = base_dir+"/remote_listing.json"
         except:
             print(str(inspect.stack()[0][2:4][::-1])+' Dont update base_dir')
 
-    def download_file(self,remote_filename,local_filename):
-        ''' Download remote file to local temporary copy '''
-        if not os.path.exists(temporary_path): os.makedirs(temporary_path)
-        #local_filename = temporary_path + tempfilename
-        #temporary_file = open(tempfilename,'wb')
-        if os.path.isfile(local_filename):
-            os.remove(local_filename)
-        
-        # Binary files are easily corrupted if downloaded from Win->Linux through ftp.
-        # Download instead using urllib.    
-        urllib.urlretrieve(\
-            'ftp://'+str(self.ftp_user)+':'+str(self.ftp_pass)+\
-            '@'+str(self.ftp_server)+str(remote_filename),str(local_filename))
-        
-        #self.ftp.download(remote_filename, local_filename,'w')
-        #self.ftp.retrbinary('RETR '+filename,temporary_file.write)
-        #temporary_file.close()
-    
     def create_analysis_paths(self):
         ''' Create neccesary file path. Must be defined at the beginning of the script'''
         for directory in [\
@@ -155,104 +242,203 @@ class FtpSession():
          summary_path, temporary_path, cloudmap_path, clouddata_table_path]:
             if not os.path.exists(directory): os.makedirs(directory)
     
-    def fits_search_remotepath(self,basedir=''):
-        ''' Recursively search fits files in the remote server. Return a self.list of fits files'''
-        recursive = self.ftp.walk(basedir,topdown=True,onerror=None)
-        for root,dirs,files in recursive:
-            for name in files:
+    @staticmethod
+    def is_valid_fits(thefile):
+        valid_ext = ['.fts','.fit','.fits','.FTS','.FIT','.FITS']
+        invalid_prefixes = ['SBJo']
+        
+        use_file = False
+        for known_ext in valid_ext:
+            if known_ext in thefile:
+                use_file = True
+        
+        if use_file == True:
+            for bad_prefix in invalid_prefixes:
+                if bad_prefix in thefile:
+                    use_file = False
+        
+        return(use_file)
+    
+    def load_remote_listing(self,basedir):
+        ''' Listing of the previous run (empty if it was another server) '''
+        try:
+            cached = json.load(open(remote_listing_cache,'r'))
+            assert cached['server']==self.ftp_server and cached['basedir']==basedir
+        except:
+            return({},0)
+        else:
+            return(cached['listing'],cached['scan_time'])
+    
+    def save_remote_listing(self,basedir,scan_time):
+        temp_cache = remote_listing_cache+'.tmp'
+        with open(temp_cache,'w') as cache_file:
+            json.dump({'server':self.ftp_server,'basedir':basedir,\
+             'scan_time':scan_time,'listing':self.listing},cache_file)
+        os.rename(temp_cache,remote_listing_cache)
+    
+    def list_remote_dir(self,path):
+        ''' Subdirectories {name:mtime} and files {name:[size,mtime]} of path '''
+        dirs,files = {},{}
+        for name in self.ftp.listdir(path):
+            try: file_stat = self.ftp.lstat(os.path.join(path,name))
+            except: continue
+            if stat.S_ISDIR(file_stat.st_mode):
+                dirs[name] = file_stat.st_mtime
+            else:
+                files[name] = [file_stat.st_size,file_stat.st_mtime]
+        return(dirs,files)
+    
+    def copy_cached_tree(self,path,previous):
+        self.listing[path] = previous[path]
+        for name in previous[path]['dirs']:
+            subpath = os.path.join(path,name)
+            if subpath in previous:
+                self.copy_cached_tree(subpath,previous)
+    
+    def scan_remote_dir(self,path,previous,last_scan,rescan,recent_dirs):
+        '''
+        List path and descend only into the subdirectories that may have
+        new files: not seen before, modified, newer than the last run
+        (1 day margin for the coarse FTP timestamps) or among the most
+        recent ones. The rest are taken from the cached listing.
+        '''
+        dirs,files = self.list_remote_dir(path)
+        self.listing[path] = {'dirs':dirs,'files':files}
+        
+        old_dirs = previous.get(path,{'dirs':{}})['dirs']
+        recent = sorted(dirs,key=lambda name:(dirs[name],name))[-recent_dirs:]
+        for name in dirs:
+            subpath = os.path.join(path,name)
+            if rescan or subpath not in previous or old_dirs.get(name)!=dirs[name] \
+             or name in recent or dirs[name]>=last_scan-86400:
+                self.scan_remote_dir(subpath,previous,last_scan,rescan,recent_dirs)
+            else:
+                self.copy_cached_tree(subpath,previous)
+    
+    def fits_search_remotepath(self,basedir='',rescan=False,recent_dirs=2):
+        ''' 
+        Recursively search fits files in the remote server. Return a self.list of fits files.
+        The listing is cached, unless rescan is set only new directories are listed.
+        '''
+        scan_time = time.time()
+        previous,last_scan = self.load_remote_listing(basedir)
+        self.listing = {}
+        self.scan_remote_dir(basedir,previous,last_scan,rescan,recent_dirs)
+        
+        for root in sorted(self.listing):
+            for name in sorted(self.listing[root]['files']):
                 thefile = os.path.join(root, name)
-                #FileName, FileExt = os.path.splitext(thefile)
-                valid_ext = ['.fts','.fit','.fits','.FTS','.FIT','.FITS']
-                invalid_prefixes = ['SBJo']
-                
-                use_file = False
-                for known_ext in valid_ext:
-                    if known_ext in thefile:
-                        use_file = True
-                
-                if use_file == True:
-                    for bad_prefix in invalid_prefixes:
-                        #if FileExt == known_ext:
-                        if bad_prefix in thefile:
-                            use_file = False
-                
-                if use_file == True:
+                if self.is_valid_fits(thefile):
                     self.fitslist.append("/"+thefile)
+                    self.fitsinfo["/"+thefile] = \
+                     tuple(self.listing[root]['files'][name])
         
+        self.save_remote_listing(basedir,scan_time)
     
-    def perform_analysis(self,pyasb_fullanalysis,pyasb_overwrite):
-        ''' 
-        For each file in the remote list:
-         1.- Download the image to a tmp file.
-         2.- Perform the analysis.
-         3.- write results and append the file to the list of analyzed files.
+    def setup_analysis(self,pyasb_config,pyasb_fullanalysis,download_dir):
+        '''
+        Prepare the PyASB options once. The analysis runs in this process,
+        so the catalog, calibration frames and coordinate maps are only
+        loaded for the first image.
         '''
+        # Input files are given one by one to perform_complete_analysis
+        analysis_options = ["pyasb", "-i", download_dir,\
+         "-ob", bouguerfit_path, "-ot", photometry_table_path,\
+         "-or", summary_path, "-c", pyasb_config]
+        if pyasb_fullanalysis==True:
+            analysis_options += [\
+             "-os", skybrightness_map_path, "-om", skymap_path,\
+             "-ost", skybrightness_table_path, "-ocm", cloudmap_path,\
+             "-oct", clouddata_table_path]
         
-        ftp_images_since_reconnect = 0;
+        self.InputOptions = ReadOptions(analysis_options)
+        self.ConfigOptions = ConfigOptions(pyasb_config)
+        self.ImageInfoCommon = ImageInfo()
+        self.ImageInfoCommon.config_processing_common(\
+         self.ConfigOptions,self.InputOptions)
+    
+    def select_files(self,pyasb_overwrite):
+        ''' Remote files that still need to be analyzed '''
+        self.register = ProcessedRegister(register_analyzed_files)
         
+        selected = []
         for each_fitsfile in self.fitslist:
-            ftp_images_since_reconnect+=1;
             if "Johnson_U" in each_fitsfile:
                 print('Johnson U file detected, SNR will be too low, discarding')
                 continue
             
-            if not os.path.isfile(register_analyzed_files):
-                register_analyzed = open(register_analyzed_files,"w+")
-                register_analyzed.close()
-            
-            register_analyzed = open(register_analyzed_files,"r+").readlines()
-            
-            if os.path.split(each_fitsfile)[1] in str(register_analyzed):
+            size,mtime = self.fitsinfo.get(each_fitsfile,(None,None))
+            if self.register.contains(each_fitsfile,size,mtime):
                 if pyasb_overwrite==True: 
                     print 'Previous analysis results detected, Overwrite mode is ON'
                 elif pyasb_overwrite==False: 
                     print 'Previous analysis results detected, Overwrite mode is OFF'
                     continue
             
-            self.ftp_connect()
-            print('---> Downloading file '+str(each_fitsfile))
-            actual_localdir = os.getcwd()
-            # Download the image
-            temp_filename = temporary_path+'/pyasb_'+\
-             str(datetime.datetime.now())\
-             .replace("-","").replace(":","").\
-             replace(" ","_").replace(".","_")+\
-             '.fits'
+            selected.append(each_fitsfile)
+        
+        return(selected)
+    
+    @staticmethod
+    def in_memory_copy(local_copy):
+        return(not isinstance(local_copy,basestring))
+    
+    def perform_analysis(self,pyasb_config,pyasb_fullanalysis,pyasb_overwrite,\
+     nconnections=2,nprefetch=4,in_memory=False):
+        ''' 
+        Download and analysis are pipelined:
+         1.- nconnections workers download the images to tmp files
+             (or memory buffers if in_memory is set),
+             keeping at most nprefetch images waiting for analysis.
+         2.- Meanwhile, the images already downloaded are analyzed.
+         3.- write results and append the file to the list of analyzed files.
+        The tmp files go to a new directory, so several processes can
+        share temporary_path.
+        '''
+        
+        download_dir = tempfile.mkdtemp(prefix='pyasb_ftp_',dir=temporary_path)
+        try:
+            self.pipelined_analysis(pyasb_config,pyasb_fullanalysis,pyasb_overwrite,\
+             nconnections,nprefetch,in_memory,download_dir)
+        finally:
+            shutil.rmtree(download_dir,ignore_errors=True)
+    
+    def pipelined_analysis(self,pyasb_config,pyasb_fullanalysis,pyasb_overwrite,\
+     nconnections,nprefetch,in_memory,download_dir):
+        self.setup_analysis(pyasb_config,pyasb_fullanalysis,download_dir)
+        selected = self.select_files(pyasb_overwrite)
+        
+        remote_queue = Queue.Queue()
+        local_queue = Queue.Queue(maxsize=nprefetch)
+        for each_fitsfile in selected:
+            remote_queue.put(each_fitsfile)
+        
+        for worker_id in xrange(nconnections):
+            remote_queue.put(None)
+            FtpDownloader(worker_id,self.host_factory,remote_queue,local_queue,\
+             download_dir,in_memory=in_memory).start()
+        
+        for k in xrange(len(selected)):
+            # Wait with timeout, so CTRL-C is not blocked
+            while True:
+                try: each_fitsfile,local_copy = local_queue.get(timeout=1)
+                except Queue.Empty: continue
+                else: break
             
-            try:
-                self.download_file(each_fitsfile,temp_filename)
-            except:
-                print(inspect.stack()[0][2:4][::-1])
-                raise
-                print 'File cannot be downloaded, continue with next one';
-                self.ftp_disconnect()
+            if local_copy is None:
+                print('File '+str(each_fitsfile)+' cannot be downloaded, continue with next one')
+                continue
             
-            print('---> Launching PyASB to analyze '+str(each_fitsfile))
-            # Analize the image
-            complete_analysis_exec = " "
-            if pyasb_fullanalysis==True:
-                complete_analysis_exec = \
-                 " -os " + skybrightness_map_path +\
-                 " -om " + skymap_path +\
-                 " -ost " + skybrightness_table_path +\
-                 " -ocm " + cloudmap_path +\
-                 " -oct " + clouddata_table_path
-            try:
-                os.system("python pyasb_launcher.py -i "+\
-                 temp_filename+\
-                 " -ob " + bouguerfit_path + \
-                 " -ot " + photometry_table_path +\
-                 " -or " + summary_path + " -c "+ pyasb_config + \
-                 complete_analysis_exec)
-                os.remove(temp_filename)
-            except:
-                print('Error performing pyasb analysis, please check the file.')
-                #pass
+            print('---> Analyzing '+str(each_fitsfile))
+            result = analyze_image(self.InputOptions,self.ImageInfoCommon,\
+             self.ConfigOptions,local_copy,self.ImageInfoCommon.image_timeout)
             
-            register_analyzed = open(register_analyzed_files,"a+")
-            register_analyzed.write(each_fitsfile+"\r\n");
-            self.ftp_disconnect()
-            time.sleep(2)
+            if self.in_memory_copy(local_copy):
+                local_copy.close()
+            else:
+                os.remove(local_copy)
+            size,mtime = self.fitsinfo.get(each_fitsfile,(None,None))
+            self.register.add(each_fitsfile,size,mtime,result['status'])
             
 
 def show_help():
@@ -268,8 +454,12 @@ def show_help():
      ' -b base_dir: base dir to start the iterative search\n'+\
      ' -c config_file: pyasb config file to use\n'+\
      ' -d analysis_basedir: pyasb analysis base directory\n'+\
+     ' -n connections: number of simultaneous FTP downloads (default 2)\n'+\
+     ' --prefetch N: max downloaded images waiting for analysis (default 4)\n'+\
+     ' --inmemory: keep the downloaded images in memory instead of tmp files\n'+\
      ' --overwrite: overwrite any previous analysis data in dir.\n'+\
      '              Default is to keep the old data\n'+\
+     ' --rescan: list the whole remote tree, ignoring the cached listing\n'+\
      ' --full: perform full analysis (generates sky brightness map, takes more time).\n'+\
      '         Default is to do a simple analysis (no SB map generation)\n')
     exit(0)
@@ -291,6 +481,10 @@ if __name__ == '__main__':
         ftp_pass = ''
         ftp_basedir = ''
         pyasb_config = 'pyasb_config.cfg'
+        ftp_connections = 2
+        ftp_prefetch = 4
+        ftp_rescan = False
+        ftp_inmemory = False
         
         while len(input_options)>0:
             input_option = input_options[0]
@@ -314,6 +508,16 @@ if __name__ == '__main__':
             elif input_option == '-d':
                                 analysis_basedir = input_options[1]
                                 input_options.pop(1)
+            elif input_option == '-n':
+                ftp_connections = int(input_options[1])
+                input_options.pop(1)
+            elif input_option == '--prefetch':
+                ftp_prefetch = int(input_options[1])
+                input_options.pop(1)
+            elif input_option == '--inmemory':
+                ftp_inmemory = True
+            elif input_option == '--rescan':
+                ftp_rescan = True
             elif input_option == '--full':
                 pyasb_fullanalysis = True
             elif input_option == '--overwrite':
@@ -332,10 +536,14 @@ if __name__ == '__main__':
           ftp_user,\
           ftp_pass,\
           ftp_basedir,\
-          analysis_basedir)
+          analysis_basedir,\
+          rescan=ftp_rescan)
         
         print('Number of files found: '+str(len(FtpRemoteSession.fitslist)))
-        FtpRemoteSession.perform_analysis(pyasb_fullanalysis,pyasb_overwrite)
+        FtpRemoteSession.perform_analysis(pyasb_config,pyasb_fullanalysis,pyasb_overwrite,\
+          ftp_connections,ftp_prefetch,ftp_inmemory)
+    except KeyboardInterrupt:
+        sys.exit(0)
     except:
         print(inspect.stack()[0][2:4][::-1])
         raise
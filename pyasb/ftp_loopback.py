@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+'''
+FTP loopback check
+
+Check the FTP download pipeline of fromftp.py without an FTP server:
+a local directory is served through LocalFtpHost, a stand-in with the
+FTPHost interface (open, listdir, lstat, close) that can simulate slow
+transfers and dropped connections. Checked:
+
+ - Remote listing: every FITS file of the tree is found.
+ - Prefetch and backpressure: while the analysis does not take images,
+   the downloads stop at nprefetch waiting images (plus the one each
+   connection holds), and all of them arrive intact afterwards.
+ - Retry: a broken transfer is retried with a new connection, and a
+   file that fails every attempt is reported and leaves no partial copy.
+
+With a config file and a directory of images, the whole analysis
+(FtpSession.perform_analysis) is also run on the served images.
+
+  ftp_loopback.py [-c config_file -i images_dir]
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import time
+    import shutil
+    import tempfile
+    import threading
+    import Queue
+    from fromftp import FtpSession,FtpDownloader
+    from input_options import read_option_pairs,option_pairs_usage
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+
+class LoopbackState():
+    '''
+    State shared by all the connections to the served directory:
+    failures {remote_filename: n}, the next n transfers of the file
+    break after the first block; delay, seconds per transfer;
+    completed, number of finished transfers.
+    '''
+    def __init__(self,root,failures={},delay=0.):
+        self.root = root
+        self.failures = dict(failures)
+        self.delay = delay
+        self.completed = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def next_transfer_fails(self,remote_filename):
+        with self.lock:
+            if self.failures.get(remote_filename,0)>0:
+                self.failures[remote_filename] -= 1
+                return(True)
+            return(False)
+
+    def transfer_completed(self):
+        with self.lock:
+            self.completed += 1
+
+
+class LoopbackFile():
+    ''' Remote file being read, optionally slow or broken '''
+    def __init__(self,State,local_file,broken):
+        self.State = State
+        self.local_file = local_file
+        self.broken = broken
+        self.blocks = 0
+
+    def read(self,size=-1):
+        if self.blocks==0:
+            time.sleep(self.State.delay)
+        elif self.broken:
+            raise IOError('Loopback connection lost')
+        self.blocks += 1
+        data = self.local_file.read(size)
+        if data=='':
+            self.State.transfer_completed()
+        return(data)
+
+    def close(self):
+        self.local_file.close()
+
+
+class LocalFtpHost():
+    ''' Stand-in for ftputil.FTPHost, remote paths are relative to State.root '''
+    def __init__(self,State):
+        self.State = State
+        with State.lock:
+            State.connections += 1
+
+    def local_path(self,path):
+        return(os.path.join(self.State.root,path.lstrip('/')))
+
+    def listdir(self,path):
+        return(os.listdir(self.local_path(path)))
+
+    def lstat(self,path):
+        return(os.lstat(self.local_path(path)))
+
+    def open(self,path,mode='rb'):
+        broken = self.State.next_transfer_fails(path)
+        return(LoopbackFile(self.State,open(self.local_path(path),mode),broken))
+
+    def close(self):
+        pass
+
+
+def create_remote_tree(root,nfiles,size=100000):
+    ''' Night directories with fake FITS files. Returns the remote filenames. '''
+    remote_files = []
+    for k in xrange(nfiles):
+        remote_filename = '/night%d/image%03d.fits' %(k%3,k)
+        local_filename = os.path.join(root,remote_filename.lstrip('/'))
+        if not os.path.exists(os.path.dirname(local_filename)):
+            os.makedirs(os.path.dirname(local_filename))
+        with open(local_filename,'wb') as local_file:
+            local_file.write(os.urandom(size))
+        remote_files.append(remote_filename)
+    # Not FITS, must be ignored
+    open(os.path.join(root,'night0','readme.txt'),'w').close()
+    return(sorted(remote_files))
+
+def start_downloads(State,remote_files,download_dir,nconnections,nprefetch,max_retries=3):
+    remote_queue = Queue.Queue()
+    local_queue = Queue.Queue(maxsize=nprefetch)
+    for remote_filename in remote_files:
+        remote_queue.put(remote_filename)
+    for worker_id in xrange(nconnections):
+        remote_queue.put(None)
+        FtpDownloader(worker_id,lambda: LocalFtpHost(State),remote_queue,local_queue,\
+         download_dir,max_retries=max_retries).start()
+    return(local_queue)
+
+def same_content(State,remote_filename,local_copy):
+    with open(os.path.join(State.root,remote_filename.lstrip('/')),'rb') as remote_file:
+        with open(local_copy,'rb') as local_file:
+            return(remote_file.read()==local_file.read())
+
+
+def check_listing(State,remote_files,work_dir):
+    Session = FtpSession('loopback','','','',work_dir,\
+     host_factory=lambda: LocalFtpHost(State),rescan=True)
+    return(sorted(Session.fitslist)==remote_files,\
+     '%d of %d files listed' %(len(Session.fitslist),len(remote_files)))
+
+def check_backpressure(State,remote_files,download_dir,nconnections=2,nprefetch=2):
+    local_queue = start_downloads(State,remote_files,download_dir,nconnections,nprefetch)
+    # The analysis is busy: the downloads must stop
+    time.sleep(10*State.delay+1)
+    stalled = State.completed
+    received = [local_queue.get(timeout=60) for remote_filename in remote_files]
+    intact = all([local_copy is not None and same_content(State,remote_filename,local_copy) \
+     for remote_filename,local_copy in received])
+    return(stalled<=nprefetch+nconnections and intact and \
+     sorted([remote_filename for remote_filename,local_copy in received])==remote_files,\
+     '%d downloads while stalled (max %d), %d received, intact: %s' \
+     %(stalled,nprefetch+nconnections,len(received),intact))
+
+def check_retry(State,remote_files,download_dir,max_retries=3):
+    recovered,lost = remote_files[0:2]
+    State.failures = {recovered: max_retries-1, lost: max_retries}
+    connections = State.connections
+    local_queue = start_downloads(State,[recovered,lost],download_dir,1,2,max_retries)
+    received = dict([local_queue.get(timeout=60) for k in xrange(2)])
+    partial = [filename for filename in os.listdir(download_dir) if filename.endswith('.part')]
+    return(received[recovered] is not None and same_content(State,recovered,received[recovered]) \
+     and received[lost] is None and len(partial)==0,\
+     'recovered: %s, lost reported: %s, new connections: %d, partial copies: %d' \
+     %(received[recovered] is not None,received[lost] is None,\
+       State.connections-connections,len(partial)))
+
+def check_analysis(config_file,images_dir,work_dir):
+    State = LoopbackState(images_dir)
+    Session = FtpSession('loopback','','','',work_dir,\
+     host_factory=lambda: LocalFtpHost(State),rescan=True)
+    Session.perform_analysis(config_file,False,True,nconnections=2,nprefetch=2)
+    # Every image is added to the register, whatever the result of its analysis
+    return(State.completed==len(Session.fitslist) and len(Session.register)==len(Session.fitslist),\
+     '%d of %d images downloaded, %d registered' \
+     %(State.completed,len(Session.fitslist),len(Session.register)))
+
+
+def loopback_checks(config_file=None,images_dir=None):
+    ''' Run the checks, returns the number of failed ones '''
+    work_dir = tempfile.mkdtemp(prefix='pyasb_loopback_')
+    try:
+        remote_root = os.path.join(work_dir,'remote')
+        remote_files = create_remote_tree(remote_root,8)
+        checks = [\
+         ['listing', lambda: check_listing(\
+           LoopbackState(remote_root),remote_files,os.path.join(work_dir,'listing'))],\
+         ['backpressure', lambda: check_backpressure(\
+           LoopbackState(remote_root,delay=0.05),remote_files,tempfile.mkdtemp(dir=work_dir))],\
+         ['retry', lambda: check_retry(\
+           LoopbackState(remote_root),remote_files,tempfile.mkdtemp(dir=work_dir))]]
+        if config_file is not None:
+            checks.append(['analysis', lambda: check_analysis(\
+              config_file,images_dir,os.path.join(work_dir,'analysis'))])
+
+        failed = 0
+        for name,check in checks:
+            try:
+                passed,message = check()
+            except Exception as e:
+                passed,message = False,type(e).__name__+': '+str(e)
+            failed += not passed
+            print('%-14s %s  %s' %(name,'OK  ' if passed else 'FAIL',message))
+        return(failed)
+    finally:
+        shutil.rmtree(work_dir,ignore_errors=True)
+
+
+class LoopbackOptions():
+    ''' option value pairs '''
+    options = {'-c': 'config_file', '-i': 'images_dir'}
+
+    def __init__(self,input_options):
+        self.config_file = None
+        self.images_dir = None
+
+        read_option_pairs(self,input_options[1:],'ftp_loopback.py')
+        if (self.config_file is None)!=(self.images_dir is None):
+            option_pairs_usage('ftp_loopback.py',self.options)
+
+
+if __name__ == '__main__':
+    Options = LoopbackOptions(sys.argv)
+    failed = loopback_checks(Options.config_file,Options.images_dir)
+    sys.exit(0 if failed==0 else 1)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+'''
+Golden outputs regression check
+
+Analyze fixed images (synthetic ones, see synthetic_image.py, and
+optionally real reference frames) and compare the results with the
+stored golden outputs: summary values (zero point, extinction, zenith
+SB, cloud coverage), the photometry of each star and the SB grid.
+
+Each code path (variant) is a set of config options applied on top
+of the config file, e.g. "lut:derotate_coordinates=True". The report
+gives the numeric drift of every quantity against its tolerance and
+the time of each stage, so a faster path can be enabled once it
+reproduces the golden outputs.
+
+  golden_outputs.py record -c config -g golden_dir [-r 1000x1000,...] [-i image.fits,...]
+  golden_outputs.py check  -c config -g golden_dir [-x name:option=value,...] [-t quantity=tol]
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import glob
+    import json
+    import shutil
+    import tempfile
+    import numpy as np
+    from pipeline import *
+    from instrumentation import PipelineStats
+    from input_options import read_option_pairs,option_pairs_usage
+    from benchmark import benchmark_config,synthetic_frames,git_revision
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+# Max allowed difference with the golden outputs (magnitudes unless noted)
+default_tolerances = {\
+ 'zero_point': 0.01, 'extinction': 0.01, 'sb_zenith': 0.01,\
+ 'cloud_cover': 0.02, 'stars': 0,\
+ 'star_m25logF': 0.005, 'star_flux_rel': 0.002, 'missing_stars': 0,\
+ 'sb_grid': 0.01}
+
+
+def read_summary(summary_file):
+    ''' Values of the Summary_*.txt file '''
+    fields = [field.strip() for field in open(summary_file).readlines()[1].split(',')]
+    def value_error(field):
+        return([float(value) for value in field.split('+/-')])
+    summary = {'stars': int(fields[2]), 'good_stars': float(fields[3])}
+    for name,field in zip(['zero_point','extinction','sb_zenith','cloud_cover'],fields[4:8]):
+        summary[name],summary[name+'_err'] = value_error(field)
+    return(summary)
+
+def read_phottable(phottable_file):
+    ''' Photometry of each star of the PhotTable_*.txt file, by HD code '''
+    names = ['azimuth','altitude','airmass','magnitude','color',\
+     'starflux','starflux_err','m25logF','m25logF_err']
+    stars = {}
+    for line in open(phottable_file):
+        if line.startswith('#') or line.strip()=='': continue
+        fields = line.split(',')
+        # The common name may contain commas, numbers are the last fields
+        stars[fields[0].strip()] = dict(zip(names,[float(value) for value in fields[-9:]]))
+    return(stars)
+
+def read_sbtable(sbtable_file):
+    ''' SB and its error in each point of the SBTable_*.txt grid, by "alt_az" '''
+    lines = open(sbtable_file).readlines()
+    azimuths = [field.strip() for field in lines[0].split(',')[1:]]
+    grid = {}
+    for line in lines[1:]:
+        fields = line.split(',')
+        for azimuth,field in zip(azimuths,fields[1:]):
+            grid[fields[0].strip()+'_'+azimuth] = [float(value) for value in field.split('+/-')]
+    return(grid)
+
+def read_outputs(output_dir):
+    ''' Parsed outputs of one analysis (empty if a file is missing) '''
+    outputs = {'summary': {}, 'stars': {}, 'sb_grid': {}}
+    for key,pattern,reader in [\
+     ['summary','Summary_*.txt',read_summary],\
+     ['stars','PhotTable_*.txt',read_phottable],\
+     ['sb_grid','SBTable_*.txt',read_sbtable]]:
+        files = glob.glob(os.path.join(output_dir,pattern))
+        if len(files)>0:
+            outputs[key] = reader(files[0])
+    return(outputs)
+
+
+def compare_outputs(golden,outputs,tolerances):
+    '''
+    Max drift of each quantity. Returns a list of
+    (quantity, drift, tolerance, passed).
+    '''
+    def drift(values,reference):
+        values,reference = np.array(values,dtype=float),np.array(reference,dtype=float)
+        if np.size(values)==0: return(0.)
+        # NaN in both is not a difference
+        same_nan = np.isnan(values)*np.isnan(reference)
+        differences = np.abs(values-reference)
+        differences[same_nan] = 0
+        return(float(np.max(differences)) if np.all(np.isfinite(differences)) else np.inf)
+
+    results = []
+    for quantity in ['zero_point','extinction','sb_zenith','cloud_cover','stars']:
+        if quantity not in golden['summary']: continue
+        results.append([quantity,\
+         drift([outputs['summary'].get(quantity,np.nan)],[golden['summary'][quantity]])])
+
+    common = [name for name in golden['stars'] if name in outputs['stars']]
+    results.append(['missing_stars',float(len(golden['stars'])-len(common)+\
+     len([name for name in outputs['stars'] if name not in golden['stars']]))])
+    results.append(['star_m25logF',drift(\
+     [outputs['stars'][name]['m25logF'] for name in common],\
+     [golden['stars'][name]['m25logF'] for name in common])])
+    results.append(['star_flux_rel',drift(\
+     [outputs['stars'][name]['starflux']/golden['stars'][name]['starflux'] for name in common],\
+     [1.0 for name in common])])
+
+    if len(golden['sb_grid'])>0:
+        points = sorted(golden['sb_grid'])
+        results.append(['sb_grid',drift(\
+         [outputs['sb_grid'].get(point,[np.nan])[0] for point in points],\
+         [golden['sb_grid'][point][0] for point in points])])
+
+    return([(quantity,value,tolerances[quantity],value<=tolerances[quantity]) \
+     for quantity,value in results])
+
+
+class RegressionCase():
+    ''' Image and config options (on top of the config file) to analyze '''
+    def __init__(self,name,input_file,config_options,resolution=None):
+        self.name = name
+        self.input_file = input_file
+        self.config_options = config_options
+        self.resolution = resolution
+
+    def config(self,config_file,variant_options=[]):
+        if self.resolution is not None:
+            ConfigOptions_ = benchmark_config(config_file,self.resolution,self.config_options)
+        else:
+            ConfigOptions_ = ConfigOptions(config_file)
+            for option,value in self.config_options:
+                ConfigOptions_.add_option(option,str(value))
+        for option,value in variant_options:
+            ConfigOptions_.add_option(option,str(value))
+        return(ConfigOptions_)
+
+    def analyze(self,config_file,output_dir,variant_options=[]):
+        ''' Run the analysis. Returns the stats and the parsed outputs. '''
+        ConfigOptions_ = self.config(config_file,variant_options)
+        InputOptions = ReadOptions(['pyasb','-i',self.input_file,\
+         '-or',output_dir,'-ot',output_dir,'-os',output_dir,'-ost',output_dir])
+        ImageInfoCommon = ImageInfo()
+        ImageInfoCommon.config_processing_common(ConfigOptions_,InputOptions)
+
+        Stats = PipelineStats(self.input_file)
+        status = 'failed'
+        try:
+            status = analysis_stages(\
+             InputOptions,ImageInfoCommon,ConfigOptions_,self.input_file,Stats)
+        except Exception as e:
+            print(str(inspect.stack()[0][2:4][::-1])+' '+type(e).__name__+': '+str(e))
+        Stats.finish(status,getattr(Stats,'ImageInfo',None))
+        return(Stats.record,read_outputs(output_dir))
+
+
+def synthetic_cases(config_file,work_dir,resolutions):
+    cases = []
+    for resolution in resolutions:
+        frames_dir = '%s/frames_%dx%d' %(work_dir,resolution[0],resolution[1])
+        frames = synthetic_frames(config_file,frames_dir,resolution,\
+         '20130115_220000','Johnson_V',30.)
+        cases.append(RegressionCase('synthetic_%dx%d' %tuple(resolution),frames[0],\
+         [['darkframe',frames[1]],['flatfield_V',frames[2]]],resolution))
+    return(cases)
+
+def reference_cases(input_files):
+    ''' Real frames, analyzed with the config file as it is '''
+    return([RegressionCase('reference_'+os.path.splitext(os.path.basename(input_file))[0],\
+     os.path.abspath(input_file),[]) for input_file in input_files])
+
+
+def record_golden(config_file,golden_dir,cases):
+    if not os.path.exists(golden_dir):
+        os.makedirs(golden_dir)
+    for Case in cases:
+        output_dir = tempfile.mkdtemp(prefix='pyasb_golden_')
+        try:
+            stats,outputs = Case.analyze(config_file,output_dir)
+        finally:
+            shutil.rmtree(output_dir,ignore_errors=True)
+        if stats['status']!='ok':
+            print('WARNING: '+Case.name+' analysis status is '+str(stats['status']))
+        golden_file = open(os.path.join(golden_dir,Case.name+'.json'),'w')
+        json.dump({'name': Case.name, 'input_file': Case.input_file,\
+         'config_options': Case.config_options, 'resolution': Case.resolution,\
+         'revision': git_revision(), 'stats': stats, 'outputs': outputs},\
+         golden_file,indent=1,sort_keys=True)
+        golden_file.close()
+        print('Golden outputs of '+Case.name+' saved')
+
+def check_golden(config_file,golden_dir,variants,tolerances):
+    ''' Compare every variant with the golden outputs. Returns True if all pass. '''
+    all_passed = True
+    for golden_file in sorted(glob.glob(os.path.join(golden_dir,'*.json'))):
+        golden = json.load(open(golden_file))
+        Case = RegressionCase(golden['name'],golden['input_file'],\
+         golden['config_options'],golden['resolution'])
+
+        for variant_name,variant_options in variants:
+            output_dir = tempfile.mkdtemp(prefix='pyasb_check_')
+            try:
+                stats,outputs = Case.analyze(config_file,output_dir,variant_options)
+            finally:
+                shutil.rmtree(output_dir,ignore_errors=True)
+            comparison = compare_outputs(golden['outputs'],outputs,tolerances)
+            all_passed = all_passed and all([passed for _,_,_,passed in comparison])
+            print_report(Case.name,variant_name,golden['stats'],stats,comparison)
+    return(all_passed)
+
+def print_report(case_name,variant_name,golden_stats,stats,comparison):
+    print('\n'+case_name+' ['+variant_name+'], status '+str(stats['status']))
+    print('%-16s %12s %12s %6s' %('quantity','drift','tolerance',''))
+    for quantity,value,tolerance,passed in comparison:
+        print('%-16s %12.5f %12.5f %6s' %(quantity,value,tolerance,'OK' if passed else 'FAIL'))
+
+    golden_times = dict([(stage['stage'],stage['wall']) for stage in golden_stats['stages']])
+    print('%-16s %12s %12s' %('stage','time (s)','golden (s)'))
+    for stage in stats['stages']+[{'stage': 'total', 'wall': stats['wall']}]:
+        golden_time = golden_stats['wall'] if stage['stage']=='total' \
+         else golden_times.get(stage['stage'],np.nan)
+        print('%-16s %12.3f %12.3f' %(stage['stage'],stage['wall'],golden_time))
+
+
+class GoldenOptions():
+    ''' mode (record or check) followed by option value pairs '''
+    options = {'-c': 'configfile', '-g': 'golden_dir', '-o': 'work_dir',\
+     '-r': 'resolutions', '-i': 'input_files', '-x': 'variants', '-t': 'tolerances'}
+
+    def __init__(self,input_options):
+        self.configfile = 'config.cfg'
+        self.golden_dir = 'golden'
+        self.work_dir = 'benchmark'
+        self.resolutions = '1000x1000'
+        self.input_files = ''
+        self.variants = []
+        self.tolerances = []
+
+        if len(input_options)<2 or input_options[1] not in ['record','check']:
+            option_pairs_usage('golden_outputs.py',self.options,'record|check')
+        self.mode = input_options[1]
+        # -x and -t can be given several times
+        read_option_pairs(self,input_options[2:],'golden_outputs.py','record|check',\
+            repeatable=['-x','-t'])
+
+        self.resolutions = [[int(value) for value in resolution.split('x')] \
+         for resolution in self.resolutions.split(',') if resolution!='']
+        self.input_files = [name for name in self.input_files.split(',') if name!='']
+
+        # name:option=value,option=value
+        variants = [['baseline',[]]]
+        for variant in self.variants:
+            name,options = variant.split(':',1) if ':' in variant else [variant,'']
+            variants.append([name,[option.split('=',1) for option in options.split(',') \
+             if '=' in option]])
+        self.variants = variants
+
+        tolerances = dict(default_tolerances)
+        for tolerance in self.tolerances:
+            quantity,value = tolerance.split('=')
+            tolerances[quantity] = float(value)
+        self.tolerances = tolerances
+
+
+if __name__ == '__main__':
+    Options = GoldenOptions(sys.argv)
+    if Options.mode=='record':
+        cases = synthetic_cases(Options.configfile,Options.work_dir,Options.resolutions)+\
+         reference_cases(Options.input_files)
+        record_golden(Options.configfile,Options.golden_dir,cases)
+    else:
+        passed = check_golden(Options.configfile,Options.golden_dir,\
+         Options.variants,Options.tolerances)
+        print('\nRegression check '+('passed' if passed else 'FAILED'))
+        sys.exit(0 if passed else 1)
@@ -53,11 +53,19 @@ class PlatformHelp():
             '-h: print this help message\n\n'+\
             '-i input_allsky_image: \n'+\
             '  All Sky image you want to be analyzed\n\n'+\
+            '-w watch_dir [watch_dir2 ...]: \n'+\
+            '  Daemon mode. Analyze the new images written\n'+\
+            '  in these directories until stopped\n\n'+\
             '-c config_file: \n'+\
             '  Use alternative config file\n\n'+\
-            '-d [year,month,day]:\n'+\
-            '  Date to be analyzed (AstMon-UCM only)\n'+\
+            '-d year[-month[-day]]:\n'+\
+            '  Nights to be analyzed (needs -idx)\n'+\
             '  month and day are optional\n\n'+\
+            '-idx index_file [image_dir ...]:\n'+\
+            '  Observation index (SQLite) used to select the images\n'+\
+            '  by date. The image dirs are scanned for new images\n\n'+\
+            '-f filter:\n'+\
+            '  Only images with this filter (U,B,V,R,I)\n\n'+\
             '-om output_map_image path:\n'+\
             '  Output star map image, full or relative path\n'+\
             '  if no output file, show the map on screen\n\n'+\
@@ -86,6 +86,40 @@ class ImageInfo(ImageTest):
         self.calibrate_astrometry = False
         self.projection = 'ZEA'
         self.sel_flatfield=None
+        self.centroid_iterations = 3
+        self.centroid_tolerance = 0.05
+        self.max_centroid_shift = 5.0
+        self.refine_astrometry = False
+        self.astrometry_cache_path = False
+        self.astrometry_solver = "blind"
+        self.derotate_coordinates = False
+        self.coordinates_lut_step = 8
+        self.watch_register = False
+        self.watch_settle_time = 2.0
+        self.watch_poll_interval = 1.0
+        self.prescreen = False
+        self.prescreen_reject = False
+        self.prescreen_max_sun_altitude = -18.0
+        self.prescreen_max_saturated = 0.05
+        self.prescreen_min_range = 50.0
+        self.prescreen_decimation = 8
+        self.batch_checkpoint = False
+        self.image_timeout = 0
+        self.reuse_figures = True
+        self.plot_workers = 0
+        self.plot_every = 1
+        self.plot_nice = 10
+        self.plot_timeout = 300.0
+        self.plot_data_path = False
+        self.defer_plots = False
+        self.skymap_max_labels = 200
+        self.skymap_label_spacing = 0
+        self.skymap_dpi = 100
+        self.skymap_stretch_refresh = 1
+        self.skybrightness_quicklook_path = False
+        self.cloudmap_quicklook_path = False
+        self.quicklook_size = 256
+        self.results_database = False
         # A better aprox would be np.min(self.resolution)/(180.0*np.sqrt(2)/np.pi)
         # but it depends on the image, which has not yet been read.
         
@@ -100,18 +134,29 @@ class ImageInfo(ImageTest):
             "radial_factor", "azimuth_zeropoint", "min_altitude", \
             "base_radius", "baseflux_detectable", "lim_Kendall_tau",\
             "ccd_bits", "ccd_gain", "perc_low", "perc_high", "read_noise", \
-            "thermal_noise", "max_magnitude"]
+            "thermal_noise", "max_magnitude", "centroid_tolerance", \
+            "max_centroid_shift", "watch_settle_time", "watch_poll_interval", \
+            "prescreen_max_sun_altitude", "prescreen_max_saturated", "prescreen_min_range", \
+            "image_timeout", "skymap_label_spacing", "plot_timeout"]
         
-        list_int_options = [ "max_star_number" ]
+        list_int_options = [ "max_star_number", "centroid_iterations", \
+            "coordinates_lut_step", "prescreen_decimation", \
+            "plot_workers", "plot_every", "plot_nice", "skymap_max_labels", \
+            "skymap_dpi", "skymap_stretch_refresh", "quicklook_size" ]
         
-        list_bool_options = [ "calibrate_astrometry", "flip_image" ]
+        list_bool_options = [ "calibrate_astrometry", "flip_image", "refine_astrometry", \
+            "derotate_coordinates", "prescreen", "prescreen_reject", "reuse_figures", \
+            "defer_plots" ]
         
         list_str_options = [\
             "obs_name", "backgroundmap_title", "cloudmap_title", "skymap_path",\
             "photometry_table_path", "bouguerfit_path", "skybrightness_map_path", \
             "skybrightness_table_path", "cloudmap_path", "clouddata_path", \
             "summary_path", "catalog_filename", "darkframe", "biasframe", \
-            "maskframe","projection" ]
+            "maskframe","projection", "astrometry_cache_path", "astrometry_solver", \
+            "watch_register", "batch_checkpoint", "plot_data_path", \
+            "skybrightness_quicklook_path", "cloudmap_quicklook_path", \
+            "results_database" ]
         
         for option in ConfigOptions.FileOptions:
             setattr(self,option[0],option[1])
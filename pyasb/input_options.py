@@ -24,6 +24,7 @@ __status__ = "Prototype" # "Prototype", "Development", or "Production"
 
 try:
     import sys,os,inspect
+    from datetime import datetime
 except:
     print(str(inspect.stack()[0][2:4][::-1]+': One or more modules missing'))
     raise SystemExit
@@ -34,7 +35,8 @@ class ReadOptions():
         self.options = { '-h': lambda: 'show_help', '-d': lambda: 'use_date', '-i': lambda: 'use_file', 
             '-c': lambda: 'use_configfile', '-om': lambda: 'use_skymap', '-ocm': lambda: 'use_cloudmap', 
             '-oct': lambda: 'use_clouddata', '-or': lambda: 'use_results', '-ot': lambda: 'use_phottable', 
-            '-ob': lambda: 'use_bouguerfit', '-os': lambda: 'use_sb' , '-ost': lambda: 'use_sbtable'}
+            '-ob': lambda: 'use_bouguerfit', '-os': lambda: 'use_sb' , '-ost': lambda: 'use_sbtable',
+            '-w': lambda: 'use_watch', '-idx': lambda: 'use_index', '-f': lambda: 'use_filter'}
         
         # By default, we wont show on screen nor save on disk.
         self.configfile = False;
@@ -47,6 +49,12 @@ class ReadOptions():
         self.cloudmap_path=False; 
         self.clouddata_path=False; 
         self.summary_path=False; 
+        self.watch_dirs=False;
+        self.dates=[];
+        self.fits_filename_list=[];
+        self.index_path=False;
+        self.index_dirs=[];
+        self.index_filter=False;
         
         print('Input Options: '+str(input_options))
         
@@ -66,6 +74,17 @@ class ReadOptions():
                     self.dates=self.input_date()
                 elif input_option == 'use_file':
                     self.fits_filename_list = self.input_file()
+                elif input_option == 'use_index':
+                    index_args = self.input_list()
+                    if len(index_args)>0:
+                        self.index_path = index_args[0]
+                        self.index_dirs = index_args[1:]
+                elif input_option == 'use_filter':
+                    filter_args = self.input_list()
+                    if len(filter_args)>0:
+                        self.index_filter = filter_args[0]
+                elif input_option == 'use_watch':
+                    self.watch_dirs = self.input_list()
                 elif input_option == 'use_configfile':
                     self.configfile = self.reference_file()
                 elif input_option == 'use_phottable':
@@ -92,9 +111,10 @@ class ReadOptions():
         if self.show_help==False: # NOTE: Check this statement
             self.date_set=True 
             self.inputfile_set=True
+            self.watch_set=True
             
             try: 
-                assert(len(dates)>=1)
+                assert(len(self.dates)>=1)
             except:
                 self.date_set=False
             
@@ -103,7 +123,12 @@ class ReadOptions():
             except:
                 self.inputfile_set=False
             
-            if not (self.date_set or self.inputfile_set):
+            try: 
+                assert(len(self.watch_dirs)>=1)
+            except:
+                self.watch_set=False
+            
+            if not (self.date_set or self.inputfile_set or self.watch_set):
                 self.need_date_or_file()
     
     def incorrect_parameter(self):
@@ -157,6 +182,15 @@ class ReadOptions():
                 self.input_options.remove(self.input_options[1])
                 return list_files
     
+    def input_list(self):
+        # One or more values (e.g. directories), until the next option
+        list_values = []
+        while len(self.input_options)>2 and \
+         self.options.get(self.input_options[2], lambda : None)()==None:
+            list_values.append(self.input_options.pop(2))
+        self.input_options.pop(1)
+        return list_values
+    
     def output_file(self):
         # If output is not disabled, then show on screen or save to file
         try: self.input_options[2]
@@ -183,6 +217,7 @@ class ReadOptions():
         try: self.input_options[2]
         except: self.need_date_or_file()
         else:
+            days=None
             try: date=self.input_options[2].split("-")
             except: 
                 self.need_date_or_file()
@@ -210,15 +245,15 @@ class ReadOptions():
                 # Short format processing
                 year_ = year%2000 + 2000
                 for month in months:
-                    try: days
-                    except: 
+                    month_days = days
+                    if month_days is None:
                         # Leap year?
                         if month==2 and (year_%4==0 and ((year_ %100!=0) or (year_%400==0))):
-                            days=range(1,29+1,1)
+                            month_days=range(1,29+1,1)
                         else:
-                            days=range(1,days_month[month]+1,1)
+                            month_days=range(1,days_month[month]+1,1)
         
-                    for day in days:
+                    for day in month_days:
                         use_date=True
                         if year_>int(today_yearmonthday[0]):
                             use_date=False
@@ -232,6 +267,29 @@ class ReadOptions():
                             dates.append([year_,month,day])
             self.input_options.remove(self.input_options[2]); self.input_options.remove(self.input_options[1])
             return dates
-    
-    
 
+
+def option_pairs_usage(program,options,arguments=''):
+    ''' Print the usage of a script with option value pairs and exit '''
+    print('Usage: '+' '.join([program]+([arguments] if arguments!='' else [])+\
+        [option+' '+options[option] for option in sorted(options)]))
+    raise SystemExit
+
+def read_option_pairs(Options,input_options,program,arguments='',repeatable=[]):
+    '''
+    Set the attributes of Options named in Options.options from the
+    option value pairs of input_options (the command line without the
+    program name and arguments). Options in repeatable are appended to
+    a list. Prints the usage and exits with -h or a missing value.
+    '''
+    input_options = list(input_options)
+    if '-h' in input_options or len(input_options)%2!=0:
+        option_pairs_usage(program,Options.options,arguments)
+    for option,value in zip(input_options[0::2],input_options[1::2]):
+        if option not in Options.options:
+            print('ERROR. Incorrect parameter: '+str(option))
+            raise SystemExit
+        if option in repeatable:
+            getattr(Options,Options.options[option]).append(value)
+        else:
+            setattr(Options,Options.options[option],value)
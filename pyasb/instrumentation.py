@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+'''
+Pipeline instrumentation
+
+Wall time, CPU time and memory of each stage of the analysis,
+and the number of stars after each selection step. One JSON
+record per image is appended to pipeline_stats.jsonl in the
+summary directory.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import time
+    import json
+    from contextlib import contextmanager
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, no CPU time / memory there
+    resource = None
+
+
+def process_usage():
+    ''' CPU time (s) and peak resident memory (MB) of the process '''
+    if resource is None:
+        return(time.clock(),float('nan'))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kB on Linux, bytes on Mac OS
+    scale = 1024.**2 if sys.platform=='darwin' else 1024.
+    return(usage.ru_utime+usage.ru_stime,usage.ru_maxrss/scale)
+
+
+class PipelineStats():
+    '''
+    Stats of the analysis of one image.
+    Memory is the peak of the process (it can only grow), so the
+    increment shows which stage needed more memory than the previous ones.
+    before_stage(name), if given, is called when each stage starts.
+    '''
+    star_lists = [('total','StarList_Tot'),('visible','StarList_TotVisible'),\
+        ('detected','StarList_Det'),('photometric','StarList_Phot')]
+
+    def __init__(self,input_file=None,before_stage=None):
+        self.before_stage = before_stage
+        self.start_wall = time.time()
+        self.start_cpu,self.start_memory = process_usage()
+        self.record = {\
+            'file': input_file if input_file is None or \
+                isinstance(input_file,basestring) else 'in memory',
+            'start': self.start_wall, 'stages': [], 'stars': {}}
+
+    @contextmanager
+    def stage(self,name):
+        ''' Measure the code inside a with block '''
+        if self.before_stage is not None:
+            self.before_stage(name)
+        wall,(cpu,memory) = time.time(),process_usage()
+        try:
+            yield
+        finally:
+            end_cpu,end_memory = process_usage()
+            self.record['stages'].append({'stage': name,\
+                'wall': round(time.time()-wall,4), 'cpu': round(end_cpu-cpu,4),\
+                'peak_memory_mb': round(end_memory,1),\
+                'memory_increase_mb': round(end_memory-memory,1)})
+
+    def count_stars(self,StarCatalog):
+        for name,star_list in self.star_lists:
+            if hasattr(StarCatalog,star_list):
+                self.record['stars'][name] = len(getattr(StarCatalog,star_list))
+
+    def count(self,name,value):
+        self.record['stars'][name] = value
+
+    def finish(self,status,ImageInfo=None):
+        end_cpu,end_memory = process_usage()
+        self.record.update({'status': status,\
+            'wall': round(time.time()-self.start_wall,4),\
+            'cpu': round(end_cpu-self.start_cpu,4),\
+            'peak_memory_mb': round(end_memory,1)})
+        for attribute in ['fits_date','used_filter']:
+            if hasattr(ImageInfo,attribute):
+                self.record[attribute] = str(getattr(ImageInfo,attribute))
+
+    def save(self,summary_path):
+        ''' Append the record as a JSON line (nothing if there is no summary dir) '''
+        if summary_path in [ False, "False", "false", "F", "screen" ]:
+            return
+        if not os.path.exists(summary_path):
+            os.makedirs(summary_path)
+        stats_file = open(summary_path+'/pipeline_stats.jsonl','a+')
+        stats_file.write(json.dumps(self.record,sort_keys=True)+'\n')
+        stats_file.close()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+'''
+Lazy module imports
+
+matplotlib and some scipy submodules take a long time to import, but
+they are only needed for some outputs. Modules are imported the first
+time one of their attributes is used, e.g.
+
+  plt = LazyModule('matplotlib.pyplot')
+  plt.figure()  # matplotlib is imported here
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import importlib
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+
+class LazyModule(object):
+    ''' Stand-in for a module, imported on first use '''
+    def __init__(self,module_name):
+        self.__dict__['module_name'] = module_name
+        self.__dict__['module'] = None
+
+    def load(self):
+        if self.__dict__['module'] is None:
+            self.__dict__['module'] = importlib.import_module(self.module_name)
+        return(self.__dict__['module'])
+
+    def __getattr__(self,attribute):
+        return(getattr(self.load(),attribute))
+
+    def __repr__(self):
+        return('<lazy module '+self.module_name+\
+         (' (loaded)>' if self.__dict__['module'] is not None else '>'))
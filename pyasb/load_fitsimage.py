@@ -85,6 +85,26 @@ class ImageTest():
             return 'Johnson_'+used_filter[7:]
 
 
+class CalibrationFrames():
+    '''
+    Calibration frames (dark, flat, bias, mask) are shared by many
+    images. Keep them in memory until the file changes.
+    '''
+    loaded = {}
+    
+    @classmethod
+    def load(cls,filename):
+        ''' Returns data and header of the calibration frame '''
+        frame_key = (filename,os.path.getmtime(filename))
+        if frame_key not in cls.loaded:
+            for old_key in [key for key in cls.loaded if key[0]==filename]:
+                del cls.loaded[old_key]
+            frame_HDU = pyfits.open(filename,memmap=False)
+            cls.loaded[frame_key] = (frame_HDU[0].data,frame_HDU[0].header)
+            frame_HDU.close()
+        return(cls.loaded[frame_key])
+
+
 class FitsImage(ImageTest):
     def __init__(self,input_file):
         self.load_science(input_file)
@@ -93,7 +113,11 @@ class FitsImage(ImageTest):
         self.fits_data_notcalibrated = np.array(self.fits_data)
 
     def load_science(self,input_file):
-        print('Loading ScienceFrame ['+str(input_file)+'] ...'),
+        ''' input_file can be a file name or a file-like object (memory buffer) '''
+        if isinstance(input_file,basestring):
+            print('Loading ScienceFrame ['+str(input_file)+'] ...'),
+        else:
+            print('Loading ScienceFrame [in memory] ...'),
         try:
             file_opened = pyfits.open(input_file)
             self.fits_data   = file_opened[0].data
@@ -108,8 +132,7 @@ class FitsImage(ImageTest):
     def load_mask(self,Mask):
         print('Loading Mask ...'),
         try:
-            Mask_HDU    = pyfits.open(Mask)
-            self.mask   = Mask_HDU[0].data
+            self.mask   = CalibrationFrames.load(Mask)[0]
         except:
             print(inspect.stack()[0][2:4][::-1])
             #raise
@@ -118,9 +141,7 @@ class FitsImage(ImageTest):
     def load_dark(self,MasterDark):
         print('Loading MasterDark ...'),
         try:
-            MasterDark_HDU    = pyfits.open(MasterDark)
-            self.MasterDark_Data   = MasterDark_HDU[0].data
-            self.MasterDark_Header = MasterDark_HDU[0].header
+            self.MasterDark_Data,self.MasterDark_Header = CalibrationFrames.load(MasterDark)
             self.MasterDark_Texp   = float(ImageTest.correct_exposure(self.MasterDark_Header))
         except:
             print(inspect.stack()[0][2:4][::-1])
@@ -130,11 +151,9 @@ class FitsImage(ImageTest):
     def load_flat(self,MasterFlat):
         print('Loading MasterFlat ...'),
         try:
-            MasterFlat_HDU    = pyfits.open(MasterFlat)
-            self.MasterFlat_Data   = MasterFlat_HDU[0].data
+            self.MasterFlat_Data,self.MasterFlat_Header = CalibrationFrames.load(MasterFlat)
             # Normalize MasterFlat
             self.MasterFlat_Data = self.MasterFlat_Data / np.mean(self.MasterFlat_Data)
-            self.MasterFlat_Header = MasterFlat_HDU[0].header
             self.MasterFlat_Texp   = float(ImageTest.correct_exposure(self.MasterFlat_Header))
         except:
             print(inspect.stack()[0][2:4][::-1])
@@ -144,9 +163,7 @@ class FitsImage(ImageTest):
     def load_bias(self,MasterBias):
         print('Loading MasterBias ...'),
         try:
-            MasterBias_HDU    = pyfits.open(MasterBias)
-            self.MasterBias_Data   = MasterBias_HDU[0].data
-            self.MasterBias_Header = MasterBias_HDU[0].header
+            self.MasterBias_Data,self.MasterBias_Header = CalibrationFrames.load(MasterBias)
             self.MasterBias_Texp   = float(ImageTest.correct_exposure(self.MasterBias_Header))
         except:
             print(inspect.stack()[0][2:4][::-1])
@@ -221,7 +238,7 @@ class FitsImage(ImageTest):
                      (self.ScienceFrame_Texp-self.MasterBias_Texp)+\
                      self.MasterBias_Data
                     self.SyntDark_Texp   = self.fits_Texp
-                    self.SyntDark_Header = self.MasterDark_Header
+                    self.SyntDark_Header = self.MasterDark_Header.copy()
                     self.SyntDark_Header['EXPOSURE'] = self.SyntDark_Texp
                 except:
                     print(inspect.stack()[0][2:4][::-1])
@@ -250,6 +267,11 @@ class FitsImage(ImageTest):
                 print("Removed: %.2f +/- %.2f counts from measured background" \
                  %(self.bias_image_median,self.bias_image_err))
                 
+                Results = getattr(ImageInfo,'results',None)
+                if Results is not None:
+                    Results.add('image_bias',[(str(ImageInfo.date_string),\
+                        float(self.bias_image_median),float(self.bias_image_err))])
+                
                 if ImageInfo.summary_path not in [ False, "False", "false", "F", "screen" ]:
                     if not os.path.exists(ImageInfo.summary_path):
                         os.makedirs(ImageInfo.summary_path)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+'''
+Observation index
+
+SQLite index of the images, built only from their FITS headers
+(DATE, FILTER, EXPOSURE, NAXIS1/2). It is used to select the images
+of a given date and filter without opening them.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import sqlite3
+    import astropy.io.fits as pyfits
+    from load_fitsimage import ImageTest
+    from astrometry_fit import AstrometryCache
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+
+class ObservationIndex():
+    '''
+    Images indexed by night (images before local noon at the longitude
+    belong to the previous night, as in AstrometryCache) and filter.
+    Files are only read again when their size or mtime change.
+    '''
+    valid_ext = ['.fts','.fit','.fits','.FTS','.FIT','.FITS']
+
+    def __init__(self,index_filename,longitude=0.0):
+        self.index_filename = index_filename
+        self.longitude = float(longitude)
+        self.connection = sqlite3.connect(index_filename)
+        with self.connection:
+            self.connection.execute(\
+                'CREATE TABLE IF NOT EXISTS observations ('+\
+                'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '+\
+                'date TEXT, night TEXT, filter TEXT, exposure REAL, '+\
+                'naxis1 INTEGER, naxis2 INTEGER)')
+            self.connection.execute(\
+                'CREATE INDEX IF NOT EXISTS observations_night '+\
+                'ON observations (night, filter)')
+            self.connection.execute(\
+                'CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+        self.update_nights()
+
+    def update_nights(self):
+        ''' Nights of the indexed images, if they were computed for another longitude '''
+        stored = self.connection.execute(\
+            "SELECT value FROM settings WHERE name='longitude'").fetchone()
+        # Indexes without settings used noon UTC
+        if stored is not None and float(stored[0])==self.longitude:
+            return
+        with self.connection:
+            if stored is not None or self.longitude!=0:
+                self.connection.executemany('UPDATE observations SET night=? WHERE path=?',\
+                    [(AstrometryCache.night(date,self.longitude),path) for path,date in \
+                     self.connection.execute(\
+                        'SELECT path,date FROM observations WHERE date IS NOT NULL').fetchall()])
+            self.connection.execute('INSERT OR REPLACE INTO settings VALUES (?,?)',\
+                ('longitude',repr(self.longitude)))
+
+    def read_header(self,path):
+        ''' date, night, filter, exposure, naxis1, naxis2 (no pixel data is read) '''
+        header = pyfits.getheader(path)
+        date = ImageTest.correct_date(header)
+        resolution = ImageTest.correct_resolution(header)
+        return((date,AstrometryCache.night(date,self.longitude),ImageTest.correct_filter(header),\
+            ImageTest.correct_exposure(header),resolution[0],resolution[1]))
+
+    def list_files(self,directories):
+        for directory in directories:
+            for root,dirs,files in os.walk(directory):
+                for name in files:
+                    if os.path.splitext(name)[1] in self.valid_ext:
+                        yield(os.path.abspath(os.path.join(root,name)))
+
+    def update(self,directories):
+        ''' Index the new or modified images and forget the deleted ones '''
+        indexed = dict((path,(size,mtime)) for path,size,mtime in \
+            self.connection.execute('SELECT path,size,mtime FROM observations'))
+
+        found = set()
+        new_rows = []
+        for path in self.list_files(directories):
+            try: file_stat = os.stat(path)
+            except OSError: continue
+            found.add(path)
+            if indexed.get(path)==(file_stat.st_size,file_stat.st_mtime):
+                continue
+            try:
+                values = self.read_header(path)
+            except Exception:
+                # Not a valid AllSky image, keep it to avoid reading it again
+                values = (None,)*6
+            new_rows.append((path,file_stat.st_size,file_stat.st_mtime)+values)
+
+        scanned = [os.path.join(os.path.abspath(directory),'') for directory in directories]
+        removed = [(path,) for path in indexed if path not in found and \
+            any(path.startswith(directory) for directory in scanned)]
+
+        with self.connection:
+            self.connection.executemany(\
+                'INSERT OR REPLACE INTO observations VALUES (?,?,?,?,?,?,?,?,?)',new_rows)
+            self.connection.executemany('DELETE FROM observations WHERE path=?',removed)
+
+        print('Observation index: %d images indexed, %d removed' \
+            %(len(new_rows),len(removed)))
+
+    def select(self,dates,used_filter=None):
+        ''' Images of the given nights ([year,month,day] list), sorted by date '''
+        nights = set('%04d%02d%02d' %tuple(date) for date in dates)
+        if len(nights)==0:
+            return([])
+
+        query = 'SELECT path,night FROM observations WHERE night BETWEEN ? AND ?'
+        parameters = [min(nights),max(nights)]
+        if used_filter not in [None,False]:
+            if not str(used_filter).startswith('Johnson'):
+                used_filter = 'Johnson_'+str(used_filter)
+            query += ' AND filter=?'
+            parameters.append(used_filter)
+
+        selected = self.connection.execute(query+' ORDER BY date',parameters)
+        return([str(path) for path,night in selected if night in nights])
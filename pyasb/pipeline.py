@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+'''
+PyASB analysis pipeline
+
+Load, reduce and analyze a single image. The classes here are shared
+by the command line launcher and the FTP front end, so several images
+can be processed in the same interpreter (catalog, calibration frames
+and coordinate maps stay loaded between images).
+____________________________
+
+This module is part of the PyASB project, 
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+
+try:
+    import sys,os,inspect
+    import copy
+    import time
+    import signal
+    
+    from input_options import *
+    from image_info import *
+    from astrometry import *
+    from astrometry_fit import *
+    from plate_solver import *
+    from star_calibration import *
+    from load_fitsimage import *
+    from bouguer_fit import *
+    from sky_brightness import *
+    from skymap_plot import *
+    from cloud_coverage import *
+    from write_summary import *
+    from prescreen import ImagePrescreen
+    from file_register import ProcessedRegister
+    from instrumentation import PipelineStats
+    from plot_rendering import Plots
+    from quicklook_maps import skybrightness_quicklook
+    from results_store import image_results
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+\
+     ': One or more modules missing')
+    raise SystemExit
+
+
+#@profile
+class LoadImage(object):
+    def __init__(self, InputOptions, ImageInfo, ConfigOptions, input_file=None):
+        # Load Image file list
+        if input_file == None:
+            input_file = InputOptions.fits_filename_list[0]
+        
+        ''' Load fits image '''
+        self.FitsImage = FitsImage(input_file)
+        # Local copy of ImageInfo. We will process it further.
+        # (the common one is reused for the next images)
+        self.ImageInfo = copy.copy(ImageInfo)
+        self.ImageInfo.read_header(self.FitsImage.fits_Header)
+        self.ImageInfo.config_processing_specificfilter(ConfigOptions)
+        # Results of this image for the results database (if enabled)
+        self.ImageInfo.results = image_results(self.ImageInfo)
+        use_cached_astrometry(self.ImageInfo)
+        
+        try:
+            self.FitsImage.subtract_corners_background = True
+            self.FitsImage.reduce_science_frame(\
+                self.ImageInfo.darkframe,\
+                self.ImageInfo.sel_flatfield,\
+                MasterBias=None,\
+                Mask=ImageInfo.maskframe,\
+                ImageInfo=self.ImageInfo)
+        except:
+            raise
+            print(inspect.stack()[0][2:4][::-1])
+            print('Cannot reduce science frame')
+        
+        # Flip image if needed
+        self.FitsImage.flip_image_if_needed(self.ImageInfo)
+        
+        self.FitsImage.__clear__()
+        self.output_paths(InputOptions)
+    
+
+    def output_paths(self,InputOptions):
+        # Output file paths (NOTE: should be moved to another file or at least separated function)
+        # Photometric table
+        
+        path_list = [\
+            "photometry_table_path", "skymap_path", "bouguerfit_path", \
+            "skybrightness_map_path", "skybrightness_table_path", \
+            "cloudmap_path", "clouddata_path", "summary_path"]
+        
+        for path in path_list:
+            try: setattr(self.ImageInfo,path,getattr(InputOptions,path))
+            except:
+                try: getattr(InputOptions,path)
+                except: 
+                    setattr(self.ImageInfo,path,False)
+        
+#@profile
+class ImageAnalysis():
+    def __init__(self,Image,Stats=None):
+        ''' Analize image and perform star astrometry & photometry. 
+            Returns ImageInfo and StarCatalog'''
+        if Stats is None:
+            Stats = PipelineStats()
+        
+        with Stats.stage('catalog'):
+            self.StarCatalog = StarCatalog(Image.ImageInfo)
+        
+        if (Image.ImageInfo.calibrate_astrometry==True):
+            with Stats.stage('astrometry_solver'):
+                if (Image.ImageInfo.astrometry_solver=="interactive"):
+                    Image.ImageInfo.skymap_path="screen"
+                    TheSkyMap = SkyMap(Image.ImageInfo,Image.FitsImage)
+                    TheSkyMap.setup_skymap()
+                    TheSkyMap.set_starcatalog(self.StarCatalog)
+                    TheSkyMap.astrometry_solver()
+                else:
+                    BlindAstrometry(Image.FitsImage,Image.ImageInfo,self.StarCatalog)
+        
+        with Stats.stage('photometry'):
+            self.StarCatalog.process_catalog_specific(Image.FitsImage,Image.ImageInfo)
+        Stats.count_stars(self.StarCatalog)
+        with Stats.stage('astrometry_refine'):
+            refine_astrometry(self.StarCatalog,Image.ImageInfo)
+            self.StarCatalog.save_to_file(Image.ImageInfo)
+        with Stats.stage('skymap'):
+            TheSkyMap = SkyMap(Image.ImageInfo,Image.FitsImage)
+            TheSkyMap.set_starcatalog(self.StarCatalog)
+            TheSkyMap.complete_skymap()
+
+'''#@profile
+class MultipleImageAnalysis():
+    def __init__(self,InputOptions):
+        class StarCatalog_():
+            StarList = []
+            StarList_woPhot = []
+        
+        InputFileList = InputOptions.fits_filename_list
+        
+        for EachFile in InputFileList:
+            EachImage = LoadImage(EachFile)
+            EachAnalysis = ImageAnalysis(EachImage)
+            self.StarCatalog.StarList.append(EachAnalysis.StarCatalog.StarList)
+            self.StarCatalog.StarList_woPhot.append(EachAnalysis.StarCatalog.StarList_woPhot)
+'''
+
+#@profile
+class InstrumentCalibration():
+    def __init__(self,ImageInfo,StarCatalog):
+        try:
+            self.BouguerFit = BouguerFit(ImageInfo,StarCatalog)
+        except Exception as e:
+            print(inspect.stack()[0][2:4][::-1])
+            print('Cannot perform the Bouguer Fit. Error is: ')
+            print type(e)
+            print e
+            raise
+        
+
+#@profile
+class MeasureSkyBrightness():
+    def __init__(self,FitsImage,ImageInfo,BouguerFit):
+        ImageCoordinates_ = ImageCoordinates(ImageInfo)
+        TheSkyBrightness = SkyBrightness(\
+                        FitsImage,ImageInfo,ImageCoordinates_,BouguerFit)
+        TheSkyBrightnessGraph = SkyBrightnessGraph(\
+                        TheSkyBrightness,ImageInfo,BouguerFit)
+        skybrightness_quicklook(TheSkyBrightness,ImageInfo)
+        
+        '''
+        TheSkyBrightness = SkyBrightness(ImageInfo)
+        TheSkyBrightness.load_mask(altitude_cut=10)
+        TheSkyBrightness.load_sky_image(FitsImage)
+        #TheSkyBrightness.calibrate_image(FitsImage,ImageInfo,BouguerFit)
+        TheSkyBrightness.zernike_decomposition(BouguerFit,npoints=5000,order=10)
+        '''
+        
+        self.SBzenith = TheSkyBrightness.SBzenith
+        self.SBzenith_err = TheSkyBrightness.SBzenith_err
+
+#@profile
+def perform_complete_analysis(InputOptions,ImageInfoCommon,ConfigOptions,input_file,\
+ Timer=None):
+        '''
+        Analyze one image. Returns 'ok', 'rejected' (by the pre-screening)
+        or 'uncalibrated' (the Bouguer fit failed, only clouds and summary).
+        Time and memory of each stage go to pipeline_stats.jsonl (see
+        instrumentation.py), also for the images that fail.
+        Timer (AnalysisTimer) stops the analysis after its timeout.
+        '''
+        if Timer is None:
+            Timer = AnalysisTimer(0)
+        Stats = PipelineStats(input_file,before_stage=Timer.check)
+        status = 'failed'
+        try:
+            status = analysis_stages(\
+                InputOptions,ImageInfoCommon,ConfigOptions,input_file,Stats,Timer)
+            return(status)
+        finally:
+            # The stats are written without interruptions
+            Timer.disarm()
+            if Timer.expired and status=='failed':
+                status = 'timeout'
+            # ImageInfo of the loaded image, if it got that far
+            ImageInfo = getattr(Stats,'ImageInfo',ImageInfoCommon)
+            Stats.finish(status,ImageInfo)
+            try:
+                Stats.save(getattr(ImageInfo,'summary_path',False))
+            except IOError as e:
+                print(str(inspect.stack()[0][2:4][::-1])+\
+                    ' Cannot write pipeline stats: '+str(e))
+
+def analysis_stages(InputOptions,ImageInfoCommon,ConfigOptions,input_file,Stats,Timer=None):
+        if Timer is None:
+            Timer = AnalysisTimer(0)
+        # Discard daytime, saturated or blank images before loading them.
+        if ImageInfoCommon.prescreen==True:
+            with Stats.stage('prescreen'):
+                Prescreen_ = ImagePrescreen(input_file,ImageInfoCommon)
+            if Prescreen_.accepted==False and ImageInfoCommon.prescreen_reject==True:
+                return('rejected')
+        
+    # Load Image into memory & reduce it.
+        # Clean (no leaks)
+        with Stats.stage('load'):
+            Image_ = LoadImage(InputOptions,ImageInfoCommon,ConfigOptions,input_file)
+        Stats.ImageInfo = Image_.ImageInfo
+        
+        # Look for stars that appears in the catalog, measure their fluxes. Generate starmap.
+        # Clean (no leaks)
+        ImageAnalysis_ = ImageAnalysis(Image_,Stats)
+        
+        print('Image date: '+str(Image_.ImageInfo.date_string)+\
+         ', Image filter: '+str(Image_.ImageInfo.used_filter))
+        
+        'Create the needed classes for the summary write'
+        class InstrumentCalibration_:
+            class BouguerFit:
+                class Regression:
+                    mean_zeropoint = -1
+                    error_zeropoint = -1
+                    extinction = -1
+                    error_extinction = -1
+                    Nstars_rel = -1
+                    Nstars_initial = -1
+        
+        try:
+            # Calibrate instrument with image. Generate fit plot.
+            # Clean (no leaks)
+            with Stats.stage('bouguer_fit'):
+                InstrumentCalibration_ = InstrumentCalibration(\
+                    Image_.ImageInfo,
+                    ImageAnalysis_.StarCatalog)
+        except Exception:
+            status = 'uncalibrated'
+            class ImageSkyBrightness:
+                SBzenith = '-1'
+                SBzenith_err = '-1'
+            
+        else:
+            status = 'ok'
+            Regression = InstrumentCalibration_.BouguerFit.Regression
+            Stats.count('fit_initial',Regression.Nstars_initial)
+            Stats.count('fit_final',Regression.Nstars_final)
+            # Measure sky brightness / background. Generate map.
+            with Stats.stage('sky_brightness'):
+                ImageSkyBrightness = MeasureSkyBrightness(\
+                    Image_.FitsImage,
+                    Image_.ImageInfo,
+                    InstrumentCalibration_.BouguerFit)
+        
+        '''
+        Even if calibration fails, 
+        we will try to determine cloud coverage
+        and write the summary
+        '''
+        
+        # Detect clouds on image
+        with Stats.stage('cloud_coverage'):
+            ImageCloudCoverage = CloudCoverage(\
+                Image_,
+                ImageAnalysis_,
+                InstrumentCalibration_.BouguerFit)
+        
+        with Stats.stage('summary'):
+            Summary_ = Summary(Image_, InputOptions, ImageAnalysis_, \
+                InstrumentCalibration_, ImageSkyBrightness, ImageCloudCoverage)
+        
+        # All the results of the image in one transaction, never interrupted
+        Timer.disarm()
+        if Image_.ImageInfo.results is not None:
+            with Stats.stage('results_database'):
+                Image_.ImageInfo.results.save()
+        
+        #gc.collect()
+        #print(gc.garbage)
+        return(status)
+
+class AnalysisTimeout(Exception):
+    pass
+
+class AnalysisTimer():
+    '''
+    Timeout of the analysis of one image (Unix only, with SIGALRM).
+    The alarm interrupts the running stage once. Some stages catch every
+    exception, so the next stage doesn't start either (check is called
+    at the start of each stage). The alarm is disarmed before the
+    results and the stats are written, they are never half-written.
+    '''
+    def __init__(self,timeout):
+        self.timeout = timeout
+        self.enabled = timeout>0 and hasattr(signal,'SIGALRM')
+        self.expired = False
+    
+    def handler(self,signum,frame):
+        self.expired = True
+        raise AnalysisTimeout('analysis timeout')
+    
+    def start(self):
+        if self.enabled:
+            self.previous_handler = signal.signal(signal.SIGALRM,self.handler)
+            signal.alarm(int(self.timeout+0.999))
+    
+    def disarm(self):
+        if self.enabled:
+            signal.alarm(0)
+    
+    def stop(self):
+        if self.enabled:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM,self.previous_handler)
+    
+    def check(self,stage=None):
+        if self.expired:
+            raise AnalysisTimeout('analysis timeout')
+
+def analyze_image(InputOptions,ImageInfoCommon,ConfigOptions,input_file,timeout=0):
+    '''
+    Run perform_complete_analysis isolated: errors are returned, not raised.
+    If timeout>0 (seconds) the analysis is stopped after that time (Unix only).
+    Returns a dict with file, status ('ok', 'rejected', 'uncalibrated',
+    'failed' or 'timeout'), error and elapsed time.
+    '''
+    result = {'file': input_file if isinstance(input_file,basestring) else 'in memory',\
+        'status': 'failed', 'error': '', 'elapsed': 0}
+    start = time.time()
+    
+    Timer = AnalysisTimer(timeout)
+    Timer.start()
+    try:
+        result['status'] = perform_complete_analysis(\
+            InputOptions,ImageInfoCommon,ConfigOptions,input_file,Timer)
+    except AnalysisTimeout:
+        result['status'] = 'timeout'
+        result['error'] = 'more than %d s' %timeout
+    except (Exception,SystemExit) as e:
+        result['error'] = type(e).__name__+': '+str(e)
+    finally:
+        Timer.stop()
+    
+    result['elapsed'] = time.time()-start
+    if Timer.expired and result['status']!='timeout':
+        # The timeout was caught inside the last stage, the analysis is incomplete
+        result['status'] = 'timeout'
+        result['error'] = 'more than %d s' %timeout
+    if result['status'] in ['failed','timeout']:
+        print(str(inspect.stack()[0][2:4][::-1])+' Analysis of '+\
+            str(result['file'])+' '+result['status']+'. '+result['error'])
+    return(result)
+
+def analyze_batch(InputOptions,ImageInfoCommon,ConfigOptions,input_files):
+    '''
+    Analyze the images one by one, a failed image doesn't stop the batch.
+    If batch_checkpoint is set, the results are appended there and the
+    images already in it (same size and mtime) are skipped, so an
+    interrupted batch can be resumed. Images that failed or timed out
+    are analyzed again.
+    '''
+    checkpoint = None
+    if ImageInfoCommon.batch_checkpoint!=False:
+        checkpoint = ProcessedRegister(ImageInfoCommon.batch_checkpoint,\
+            retry_statuses=['failed','timeout'])
+    
+    results = []
+    for input_file in input_files:
+        input_file = os.path.abspath(input_file)
+        try:
+            file_stat = os.stat(input_file)
+            size,mtime = file_stat.st_size,file_stat.st_mtime
+        except OSError:
+            size,mtime = None,None
+        
+        if checkpoint is not None and checkpoint.contains(input_file,size,mtime):
+            print('Skipping '+str(input_file)+', already in the checkpoint')
+            continue
+        
+        result = analyze_image(InputOptions,ImageInfoCommon,ConfigOptions,\
+            input_file,ImageInfoCommon.image_timeout)
+        results.append(result)
+        if checkpoint is not None:
+            checkpoint.add(input_file,size,mtime,\
+                result['status'],'%.2f' %result['elapsed'],result['error'])
+    
+    # Figures still being rendered by the plot workers
+    Plots.wait()
+    
+    statuses = [result['status'] for result in results]
+    print('Batch finished: %d images analyzed ' %len(results)+str(dict(\
+        [(status,statuses.count(status)) for status in set(statuses)])))
+    return(results)
+
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+'''
+Blind astrometric solver
+
+Find the astrometric solution without user interaction. Bright sources
+are extracted from the image and matched to the catalog stars with
+triangle invariants (geometric hashing). The matches are then used to
+fit the full projection model (see astrometry_fit).
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import itertools
+    import numpy as np
+    import scipy.ndimage as ndimage
+    from astrometry_fit import *
+    from star_calibration import batch_centroid
+    from lazy_modules import LazyModule
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+# Only needed for blind astrometry
+spatial = LazyModule('scipy.spatial')
+
+
+def extract_sources(fits_data,mask=None,max_sources=150,box=5):
+    '''
+    Return X,Y and flux of the brightest point sources in the image.
+    A difference of gaussians removes the sky gradient and hot pixels.
+    '''
+    data = np.array(fits_data,dtype='float32')
+    smooth = ndimage.gaussian_filter(data,1.5)
+    highpass = smooth-ndimage.gaussian_filter(data,10)
+
+    if mask is not None:
+        highpass[np.array(mask)<=0] = 0
+
+    # Border pixels cannot be centered
+    highpass[:box,:] = 0; highpass[-box:,:] = 0
+    highpass[:,:box] = 0; highpass[:,-box:] = 0
+
+    peaks = (highpass==ndimage.maximum_filter(highpass,2*box+1))
+    noise = 1.4826*np.median(np.abs(highpass-np.median(highpass)))
+    peaks *= highpass>5*noise
+
+    Ypeaks,Xpeaks = np.nonzero(peaks)
+    flux = highpass[Ypeaks,Xpeaks]
+    order = np.argsort(flux)[::-1][:max_sources]
+    Xpeaks,Ypeaks,flux = Xpeaks[order],Ypeaks[order],flux[order]
+
+    # Sub-pixel position
+    Xpeaks,Ypeaks,shift,converged = batch_centroid(\
+        smooth,Xpeaks,Ypeaks,np.ones(np.size(Xpeaks))*box/2.,\
+        np.median(smooth)*np.ones(np.size(Xpeaks)))
+    valid = np.isfinite(Xpeaks)*np.isfinite(Ypeaks)
+    return(Xpeaks[valid],Ypeaks[valid],flux[valid])
+
+def triangle_invariants(X,Y,min_side=0):
+    '''
+    Build all the triangles of the given points.
+    Returns the vertex indexes (sorted from the one opposite to the
+    longest side to the one opposite to the shortest side) and the
+    invariants (b/a, c/a, orientation) for each triangle.
+    '''
+    points = np.array([X,Y],dtype=float).T
+    triangles = np.array(list(itertools.combinations(xrange(len(points)),3)))
+    if len(triangles)==0:
+        return(np.zeros((0,3),dtype=int),np.zeros((0,3)))
+
+    P = points[triangles]
+    # Side opposite to each vertex
+    sides = np.array([\
+        np.hypot(*(P[:,1]-P[:,2]).T),\
+        np.hypot(*(P[:,0]-P[:,2]).T),\
+        np.hypot(*(P[:,0]-P[:,1]).T)]).T
+
+    order = np.argsort(sides,axis=1)[:,::-1]
+    rows = np.arange(len(triangles))[:,None]
+    sides = sides[rows,order]
+    triangles = triangles[rows,order]
+
+    P = points[triangles]
+    orientation = np.sign(\
+        (P[:,1,0]-P[:,0,0])*(P[:,2,1]-P[:,0,1])-\
+        (P[:,1,1]-P[:,0,1])*(P[:,2,0]-P[:,0,0]))
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        invariants = np.array([sides[:,1]/sides[:,0],sides[:,2]/sides[:,0],orientation]).T
+
+    # Avoid degenerate (almost flat or too small) triangles
+    valid = (sides[:,0]>min_side)*(invariants[:,1]>0.2)*\
+        (sides[:,1]+sides[:,2]>1.05*sides[:,0])
+    return(triangles[valid],invariants[valid])
+
+def similarity_transform(source,target):
+    '''
+    Least squares similarity transform (scale, rotation, translation)
+    between two sets of points. Points are given as complex numbers,
+    target = scale*source + shift, with complex scale.
+    '''
+    source_mean,target_mean = np.mean(source),np.mean(target)
+    ds,dt = source-source_mean,target-target_mean
+    scale = np.sum(dt*np.conj(ds))/np.sum(np.abs(ds)**2)
+    return(scale,target_mean-scale*source_mean)
+
+
+class BlindAstrometry():
+    '''
+    Solve the astrometry of the image from scratch.
+    Only the site, date and an approximate radial_factor are needed.
+    '''
+
+    def __init__(self,FitsImage,ImageInfo,StarCatalog,\
+     nstars_hash=20,min_matches=8,tolerance=None):
+        print('Blind astrometric solver ...')
+        self.ImageInfo = ImageInfo
+        if tolerance is None:
+            tolerance = max(3.,0.005*np.min(ImageInfo.resolution))
+        self.tolerance = tolerance
+
+        self.load_sources(FitsImage)
+        self.load_catalog(StarCatalog)
+
+        try:
+            self.solve_similarity(nstars_hash,min_matches)
+            self.solve_projection()
+        except Exception as e:
+            print(str(inspect.stack()[0][2:4][::-1])+\
+             ' Blind astrometry failed: '+str(e))
+            self.solved = False
+        else:
+            self.solved = True
+            set_projection_parameters(ImageInfo,self.solution)
+            self.print_solution()
+            if getattr(ImageInfo,'refine_astrometry',False)==True:
+                AstrometryCache(ImageInfo).save(self.solution,self.rms,self.nmatches)
+
+    def load_sources(self,FitsImage):
+        mask = getattr(FitsImage,'mask',None)
+        self.Xsources,self.Ysources,self.Fsources = \
+            extract_sources(FitsImage.fits_data,mask=mask)
+        self.source_tree = spatial.cKDTree(np.array([self.Xsources,self.Ysources]).T)
+        print(' - Sources found: %d' %len(self.Xsources))
+
+    def load_catalog(self,StarCatalog):
+        ''' Catalog stars projected with a rotation free, centered model '''
+        StarList = sorted(StarCatalog.StarList_Tot,key=lambda Star: Star.FilterMag)
+        self.azimuth  = np.array([Star.azimuth for Star in StarList])
+        self.altitude = np.array([Star.altit_appa for Star in StarList])
+        self.nominal_radial_factor = float(self.ImageInfo.radial_factor)
+        self.Xcatalog,self.Ycatalog = projection_model(\
+            [self.nominal_radial_factor,0,0,0,0,0],\
+            self.azimuth,self.altitude,[0,0],\
+            self.ImageInfo.latitude,self.ImageInfo.projection)
+        print(' - Catalog stars: %d' %len(self.azimuth))
+
+    def count_matches(self,scale,shift,ncatalog):
+        Zcatalog = scale*(self.Xcatalog[:ncatalog]+1j*self.Ycatalog[:ncatalog])+shift
+        distance,index = self.source_tree.query(\
+            np.array([Zcatalog.real,Zcatalog.imag]).T,\
+            distance_upper_bound=self.tolerance)
+        return(np.sum(np.isfinite(distance)))
+
+    def solve_similarity(self,nstars_hash,min_matches):
+        '''
+        Match triangles built with the brightest sources and catalog
+        stars, then keep the transform that explains most stars.
+        '''
+        min_side = 10*self.tolerance
+        triangles_src,invariants_src = triangle_invariants(\
+            self.Xsources[:nstars_hash],self.Ysources[:nstars_hash],min_side)
+        triangles_cat,invariants_cat = triangle_invariants(\
+            self.Xcatalog[:int(1.5*nstars_hash)],\
+            self.Ycatalog[:int(1.5*nstars_hash)])
+
+        assert len(triangles_src)>0 and len(triangles_cat)>0, 'not enough stars'
+
+        tree = spatial.cKDTree(invariants_cat)
+        candidates = tree.query_ball_point(invariants_src,r=0.01)
+
+        Zsources = self.Xsources+1j*self.Ysources
+        Zcatalog = self.Xcatalog+1j*self.Ycatalog
+        ncatalog = min(len(Zcatalog),3*nstars_hash)
+
+        best_matches = 0
+        for k,matched in enumerate(candidates):
+            for j in matched:
+                scale,shift = similarity_transform(\
+                    Zcatalog[triangles_cat[j]],Zsources[triangles_src[k]])
+                # Reject unrealistic scales (radial_factor guess is approximate)
+                if not (0.3<np.abs(scale)<3.): continue
+                matches = self.count_matches(scale,shift,ncatalog)
+                if matches>best_matches:
+                    best_matches = matches
+                    self.scale,self.shift = scale,shift
+
+        print(' - Best triangle match explains %d stars' %best_matches)
+        assert best_matches>=min_matches, 'no reliable triangle match'
+
+    def match_stars(self,Xmodel,Ymodel):
+        distance,index = self.source_tree.query(\
+            np.array([Xmodel,Ymodel]).T,distance_upper_bound=self.tolerance)
+        matched = np.isfinite(distance)
+        # Each source can only be assigned once (keep the brightest star)
+        index_used,first = np.unique(index[matched],return_index=True)
+        selected = np.where(matched)[0][first]
+        return(selected,index[selected])
+
+    def solve_projection(self,iterations=3):
+        '''
+        Convert the similarity transform to projection parameters
+        and refine them with all the matched stars.
+        '''
+        resolution = self.ImageInfo.resolution
+        self.solution = np.array([\
+            self.nominal_radial_factor*np.abs(self.scale),\
+            (-np.angle(self.scale)*180./np.pi)%360,\
+            resolution[0]//2-self.shift.real,\
+            self.shift.imag-resolution[1]//2,\
+            0,0])
+
+        for iteration in xrange(iterations):
+            Xmodel,Ymodel = projection_model(\
+                self.solution,self.azimuth,self.altitude,resolution,\
+                self.ImageInfo.latitude,self.ImageInfo.projection)
+            stars,sources = self.match_stars(Xmodel,Ymodel)
+            # Zenith pointing offsets need a good sampling of the sky
+            free = [True,True,True,True,len(stars)>=20,len(stars)>=20]
+            self.solution,self.rms = fit_projection(\
+                self.azimuth[stars],self.altitude[stars],\
+                self.Xsources[sources],self.Ysources[sources],\
+                self.ImageInfo,initial=self.solution,free=free)
+
+        self.solution[1] = self.solution[1]%360
+        self.nmatches = len(stars)
+
+    def print_solution(self):
+        print(' - Solution from %d stars, rms=%.2f px' %(self.nmatches,self.rms))
+        for name,value in zip(projection_parameter_names,self.solution):
+            print('%s = %.8f' %(name,value))
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+'''
+Figure rendering
+
+Figures saved to disk are drawn on Agg canvases, without pyplot
+(no interactive backend or display needed, nothing kept in the pyplot
+figure list). Each figure (sky map, Bouguer fit, SB map, cloud map) is
+created once with its static elements (axes, grids, ticks, colorbar)
+and reused for the next images: only the data artists are replaced.
+Figures shown on screen use pyplot and are closed after being shown.
+
+Figures are drawn from their plot inputs (arrays, numbers and strings,
+see plot_data), not from the analysis objects. With plot_workers>0 they
+are rendered in a pool of background processes (PlotQueue), so the
+analysis of the next image doesn't wait for matplotlib. With
+plot_every=N only one of every N figures of each kind is rendered.
+With plot_data_path the plot inputs are also saved (.npz, one file per
+figure), and with defer_plots the figures are not rendered during the
+analysis: render_plots.py generates them later from the saved inputs.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import signal
+    import time
+    import atexit
+    import Queue
+    import multiprocessing
+    import numpy as np
+    from contextlib import contextmanager
+    from lazy_modules import LazyModule
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+plt = LazyModule('matplotlib.pyplot')
+mpf = LazyModule('matplotlib.figure')
+backend_agg = LazyModule('matplotlib.backends.backend_agg')
+
+
+class PlotRenderer():
+    '''
+    Figures of the analysis, by name.
+    A figure is kept only after it has been saved without errors;
+    if the plot fails, the figure is discarded.
+    '''
+    def __init__(self):
+        self.figures = {}
+        self.in_use = {}
+
+    @staticmethod
+    def new_figure(screen,figsize):
+        if screen:
+            return(plt.figure(figsize=figsize))
+        figure = mpf.Figure(figsize=figsize)
+        backend_agg.FigureCanvasAgg(figure)
+        return(figure)
+
+    @staticmethod
+    def clear_data(axes,static_artists):
+        ''' Remove everything drawn in axes after the template '''
+        for artist in axes.get_children():
+            if artist in static_artists:
+                continue
+            try:
+                artist.remove()
+            except ValueError:
+                # Already removed with its parent (e.g. contour labels)
+                pass
+        del axes.containers[:]
+        # Autoscale only with the new data, same colours as a new figure
+        axes.ignore_existing_data_limits = True
+        if hasattr(axes,'set_prop_cycle'):
+            axes.set_prop_cycle(None)
+        else:
+            axes.set_color_cycle(None)
+
+    @staticmethod
+    def get_layout(figure):
+        return(dict([(param,getattr(figure.subplotpars,param)) for param in \
+             ['left','right','bottom','top','wspace','hspace']]),\
+            [(axes,axes.get_position(original=True)) for axes in figure.axes])
+
+    @staticmethod
+    def set_layout(figure,layout):
+        subplot_params,positions = layout
+        figure.subplots_adjust(**subplot_params)
+        for axes,position in positions:
+            axes.set_position(position)
+
+    def acquire(self,name,output_path,figsize,template=None,reuse=True):
+        '''
+        Returns the figure, its main axes and whether it is new (to add the
+        static elements that need data, e.g. colorbars).
+        template(figure) adds the static elements and returns the main axes.
+        '''
+        # A figure not released (the plot failed) is discarded
+        if name in self.in_use:
+            self.close(self.in_use.pop(name)[0])
+
+        screen = (output_path=="screen")
+        reuse = reuse and not screen
+        cached = self.figures.pop(name,None)
+        if cached is not None and reuse:
+            figure,axes,static_artists = cached
+            self.clear_data(axes,static_artists)
+            # Data placed as in a new figure (contour labels depend on it)
+            self.set_layout(figure,figure.template_layout)
+            new = False
+        else:
+            if cached is not None:
+                self.close(cached[0])
+            figure = self.new_figure(screen,figsize)
+            if template is None:
+                axes = figure.add_subplot(111)
+            else:
+                axes = template(figure)
+            static_artists = set(axes.get_children())
+            figure.template_layout = self.get_layout(figure)
+            new = True
+
+        self.in_use[name] = (figure,axes,static_artists,reuse)
+        return(figure,axes,new)
+
+    def release(self,name,failed=False):
+        ''' Keep the figure for the next image or close it '''
+        if name not in self.in_use:
+            return
+        figure,axes,static_artists,reuse = self.in_use.pop(name)
+        if reuse and not failed:
+            self.figures[name] = (figure,axes,static_artists)
+        else:
+            self.close(figure)
+
+    @contextmanager
+    def figure(self,name,output_path,figsize,template=None,reuse=True):
+        ''' acquire / release around a with block '''
+        figure,axes,new = self.acquire(name,output_path,figsize,template,reuse)
+        try:
+            yield(figure,axes,new)
+        except:
+            self.release(name,failed=True)
+            raise
+        else:
+            self.release(name)
+
+    @staticmethod
+    def output(figure,output_path,filename,tight_layout={},**savefig_options):
+        ''' Show the figure on screen or save it '''
+        if output_path=="screen":
+            plt.show()
+        else:
+            # tight_layout always starts from the layout of the new figure
+            if not hasattr(figure,'initial_layout'):
+                figure.initial_layout = PlotRenderer.get_layout(figure)
+            else:
+                PlotRenderer.set_layout(figure,figure.initial_layout)
+            figure.tight_layout(**tight_layout)
+            figure.savefig(filename,**savefig_options)
+
+    @staticmethod
+    def close(figure):
+        # Only pyplot figures have a figure manager
+        if getattr(figure.canvas,'manager',None) is not None:
+            plt.close(figure)
+        else:
+            figure.clear()
+
+    def close_all(self):
+        for name in list(self.in_use):
+            self.close(self.in_use.pop(name)[0])
+        for name in list(self.figures):
+            self.close(self.figures.pop(name)[0])
+
+
+# Shared by all the images analyzed in this process
+Renderer = PlotRenderer()
+
+
+def plot_data(ImageInfo,path_option,prefix,**data):
+    '''
+    Plot inputs: the data to draw (arrays, numbers and strings only),
+    the output path and the file name (prefix_obsname_date_filter.png).
+    '''
+    output_path = getattr(ImageInfo,path_option)
+    data.update({'output_path': output_path,\
+        'reuse_figures': getattr(ImageInfo,'reuse_figures',True)==True,\
+        'filename': str("%s/%s_%s_%s_%s.png" %(output_path,prefix,\
+            ImageInfo.obs_name,ImageInfo.fits_date,ImageInfo.used_filter))})
+    return(data)
+
+def save_plot_data(name,PlotData,plot_data_path):
+    '''
+    Save the plot inputs of a figure to plot_data_path, as a .npz file
+    named as the figure. The figure kind is stored as plot_name.
+    '''
+    filename = "%s/%s.npz" %(plot_data_path,\
+        os.path.splitext(os.path.basename(PlotData['filename']))[0])
+    # Written to a temporary file first, a partial file is never rendered
+    temporary_filename = filename+'.part'
+    with open(temporary_filename,'wb') as plot_data_file:
+        np.savez(plot_data_file,plot_name=name,**PlotData)
+    os.rename(temporary_filename,filename)
+    return(filename)
+
+def load_plot_data(filename):
+    ''' Figure kind and plot inputs saved by save_plot_data '''
+    with np.load(filename) as saved:
+        PlotData = dict([(key,saved[key].item() if saved[key].ndim==0 else saved[key]) \
+            for key in saved.files])
+    return(PlotData.pop('plot_name'),PlotData)
+
+# In the plot workers, queue where the figures being started are announced
+started_figures = None
+
+def render_plot(name,PlotData,figure_id=None):
+    ''' Draw a figure in a plot worker. Returns the error, if any. '''
+    if started_figures is not None and figure_id is not None:
+        started_figures.put((figure_id,time.time()))
+    try:
+        Plots.draw_functions[name](PlotData)
+    except Exception as e:
+        return(str(PlotData.get('filename'))+' '+type(e).__name__+': '+str(e))
+    return(None)
+
+def plot_worker_setup(nice,started=None):
+    global started_figures
+    started_figures = started
+    # Ctrl-C is handled by the analysis process
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+    if nice>0 and hasattr(os,'nice'):
+        os.nice(nice)
+
+
+class PendingFigure():
+    ''' Figure sent to the plot workers '''
+    def __init__(self,figure_id,name,PlotData,result):
+        self.figure_id = figure_id
+        self.name = name
+        self.PlotData = PlotData
+        self.result = result
+        self.started = None
+
+
+class PlotQueue():
+    '''
+    Render figures from their plot inputs, in the analysis process
+    (plot_workers=0 or screen output) or in background plot workers.
+    Each kind of figure is registered with the function that draws it.
+    A figure still running plot_timeout seconds after a worker started
+    it is given up: the workers are replaced (a hung one never finishes)
+    and the other pending figures are sent to the new ones.
+    '''
+    def __init__(self):
+        self.draw_functions = {}
+        self.file_prefixes = {}
+        self.submitted = {}
+        self.pool = None
+        self.pending = []
+        self.figure_count = 0
+        atexit.register(self.wait)
+
+    def register(self,name,draw_function,file_prefix):
+        ''' file_prefix: prefix of the figure file names (see plot_data) '''
+        self.draw_functions[name] = draw_function
+        self.file_prefixes[name] = file_prefix
+
+    def start(self,workers,nice,timeout):
+        self.workers,self.nice,self.timeout = workers,nice,timeout
+        if self.pool is None:
+            self.started = multiprocessing.Queue()
+            self.pool = multiprocessing.Pool(workers,plot_worker_setup,(nice,self.started))
+            self.max_pending = 4*workers
+
+    def send(self,name,PlotData):
+        self.figure_count += 1
+        result = self.pool.apply_async(render_plot,(name,PlotData,self.figure_count))
+        self.pending.append(PendingFigure(self.figure_count,name,PlotData,result))
+
+    def update_started(self):
+        started = {}
+        while True:
+            try:
+                figure_id,start_time = self.started.get_nowait()
+            except Queue.Empty:
+                break
+            started[figure_id] = start_time
+        for Figure in self.pending:
+            if Figure.figure_id in started:
+                Figure.started = started[Figure.figure_id]
+
+    def restart_workers(self):
+        ''' Replace the workers and send them the figures not finished '''
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+        unfinished = [Figure for Figure in self.pending if not Figure.result.ready()]
+        self.pending = []
+        self.start(self.workers,self.nice,self.timeout)
+        for Figure in unfinished:
+            self.send(Figure.name,Figure.PlotData)
+
+    def collect(self,block=False):
+        ''' Check the finished figures (or wait for the oldest one) '''
+        if self.pool is None:
+            return
+        self.update_started()
+        if block and len(self.pending)>0:
+            Oldest = self.pending[0]
+            if Oldest.started is None:
+                # Not started yet, check again soon
+                Oldest.result.wait(1)
+            else:
+                Oldest.result.wait(max(0,Oldest.started+self.timeout-time.time()))
+            self.update_started()
+
+        running = []
+        hung = False
+        for Figure in self.pending:
+            if Figure.result.ready():
+                try:
+                    error = Figure.result.get()
+                except Exception as e:
+                    error = type(e).__name__+': '+str(e)
+            elif Figure.started is not None and time.time()>=Figure.started+self.timeout:
+                hung = True
+                error = str(Figure.PlotData.get('filename'))+' not finished in '+\
+                    str(self.timeout)+' s, giving up'
+            else:
+                running.append(Figure)
+                continue
+            if error is not None:
+                print(str(inspect.stack()[0][2:4][::-1])+' Plot failed: '+error)
+        self.pending = running
+        if hung:
+            self.restart_workers()
+
+    def submit(self,name,PlotData,ImageInfo):
+        plot_data_path = getattr(ImageInfo,'plot_data_path',False)
+        if plot_data_path!=False and PlotData['output_path']!="screen":
+            try:
+                save_plot_data(name,PlotData,plot_data_path)
+            except (IOError,OSError) as e:
+                print(str(inspect.stack()[0][2:4][::-1])+' Cannot save plot data: '+str(e))
+            else:
+                if getattr(ImageInfo,'defer_plots',False)==True:
+                    print('Deferring '+str(name)+' plot')
+                    return
+
+        count = self.submitted.get(name,0)
+        self.submitted[name] = count+1
+        if count%max(1,getattr(ImageInfo,'plot_every',1))!=0:
+            print('Skipping '+str(name)+' plot (plot_every)')
+            return
+
+        workers = getattr(ImageInfo,'plot_workers',0)
+        if workers<=0 or PlotData['output_path']=="screen":
+            self.draw_functions[name](PlotData)
+            return
+
+        self.start(workers,getattr(ImageInfo,'plot_nice',0),\
+            getattr(ImageInfo,'plot_timeout',300))
+        self.collect()
+        while len(self.pending)>=self.max_pending:
+            self.collect(block=True)
+        self.send(name,PlotData)
+
+    def wait(self):
+        ''' Wait for the figures being rendered and stop the workers '''
+        while len(self.pending)>0:
+            self.collect(block=True)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+# Figures of all the images analyzed in this process
+Plots = PlotQueue()
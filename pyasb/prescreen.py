@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+'''
+Image pre-screening
+
+Cheap checks done before loading and reducing the image, to discard
+daytime/twilight, saturated and blank frames early. Only the header
+and a decimated copy of the pixels are read.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import copy
+    import ephem
+    import numpy as np
+    import astropy.io.fits as pyfits
+    from astrometry import pyephem_setup_real
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+
+class ImagePrescreen():
+    '''
+    Check Sun altitude, saturation and dynamic range of the image.
+    self.accepted is False if any check fails, self.reasons tells why.
+    The Moon is only reported (self.tags), it does not reject the image.
+    '''
+    def __init__(self,input_file,ImageInfoCommon):
+        self.ImageInfo = copy.copy(ImageInfoCommon)
+        self.input_name = input_file if isinstance(input_file,basestring) else 'in memory'
+        self.reasons = []
+        self.tags = []
+        self.sun_altitude = self.moon_altitude = self.moon_phase = np.nan
+
+        try:
+            self.read_image(input_file)
+        except Exception as e:
+            self.reasons.append('cannot read image ('+str(e)+')')
+        else:
+            self.check_sun_and_moon()
+            self.check_pixels()
+
+        self.accepted = len(self.reasons)==0
+        self.log()
+
+    def read_image(self,input_file):
+        ''' Header and every n-th pixel (raw data, scaled by hand) '''
+        is_filename = isinstance(input_file,basestring)
+        fits_file = pyfits.open(input_file,memmap=is_filename,\
+            do_not_scale_image_data=True)
+        try:
+            header = fits_file[0].header
+            self.ImageInfo.read_header(header)
+            step = max(1,int(self.ImageInfo.prescreen_decimation))
+            self.pixels = np.array(fits_file[0].data[::step,::step],dtype=float)*\
+                float(header.get('BSCALE',1))+float(header.get('BZERO',0))
+        finally:
+            fits_file.close()
+            if not is_filename: input_file.seek(0)
+
+    def check_sun_and_moon(self):
+        ObsPyephem = pyephem_setup_real(self.ImageInfo)
+        Sun = ephem.Sun(ObsPyephem)
+        Moon = ephem.Moon(ObsPyephem)
+        self.sun_altitude = float(Sun.alt)*180.0/np.pi
+        self.moon_altitude = float(Moon.alt)*180.0/np.pi
+        self.moon_phase = float(Moon.phase)
+
+        if self.sun_altitude>self.ImageInfo.prescreen_max_sun_altitude:
+            self.reasons.append('Sun altitude %.1f deg' %self.sun_altitude)
+        if self.moon_altitude>0:
+            self.tags.append('Moon altitude %.1f deg, %.0f%% illuminated' \
+                %(self.moon_altitude,self.moon_phase))
+
+    def check_pixels(self):
+        # Same saturation level used for the stars
+        saturated = np.mean(self.pixels>=0.9*2**self.ImageInfo.ccd_bits)
+        if saturated>self.ImageInfo.prescreen_max_saturated:
+            self.reasons.append('saturated (%.1f%% of pixels)' %(100*saturated))
+
+        low,high = np.percentile(self.pixels,[5,95])
+        if high-low<self.ImageInfo.prescreen_min_range:
+            self.reasons.append('blank image (5-95 percentile range %.1f counts)' %(high-low))
+
+    def log(self):
+        status = 'accepted' if self.accepted else 'rejected'
+        print('Prescreen: '+str(self.input_name)+' '+status+\
+            ''.join('; '+text for text in self.reasons+self.tags))
+
+        summary_path = getattr(self.ImageInfo,'summary_path',False)
+        if summary_path in [ False, "False", "false", "F", "screen" ]:
+            return
+
+        if not os.path.exists(summary_path):
+            os.makedirs(summary_path)
+        prescreen_log = open(summary_path+'/prescreen_log.txt','a+')
+        prescreen_log.write(','.join([str(self.input_name),\
+            str(getattr(self.ImageInfo,'fits_date','')),\
+            str(getattr(self.ImageInfo,'used_filter','')),\
+            '%.2f' %self.sun_altitude,'%.2f' %self.moon_altitude,'%.1f' %self.moon_phase,\
+            status,'; '.join(self.reasons+self.tags)])+'\r\n')
+        prescreen_log.close()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+'''
+Quick-look SB and cloud maps
+
+False colour SB and cloud maps for dashboards, written directly as PNG
+files with numpy and zlib (no matplotlib, no interpolation with scipy).
+The measured grids of SkyBrightness and CloudCoverage are mapped onto a
+square polar raster (zenith at the centre, North up, East right, as in
+the full maps) through a precomputed index, and coloured with a LUT.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import struct
+    import zlib
+    import numpy as np
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+# Colour maps of the full maps: matplotlib YlGnBu (ColorBrewer anchors)
+# and the 5 grey levels of the cloud map.
+YlGnBu_anchors = [\
+ (255,255,217),(237,248,177),(199,233,180),(127,205,187),(65,182,196),\
+ (29,145,192),(34,94,168),(37,52,148),(8,29,88)]
+cloud_anchors = [(51,51,51),(204,204,204)]
+
+background_colour = (255,255,255)
+horizon_colour = (128,128,128)
+
+
+def colour_lut(anchors,levels):
+    ''' levels colours, linear between the (equally spaced) anchors '''
+    anchors = np.array(anchors,dtype=float)
+    positions = np.linspace(0,1,len(anchors))
+    samples = np.linspace(0,1,levels)
+    return(np.array([np.interp(samples,positions,anchors[:,channel]) \
+        for channel in range(3)]).T.round().astype(np.uint8))
+
+def write_png(filename,rgb,compression=6):
+    ''' Write a (rows,columns,3) uint8 array as a RGB PNG file '''
+    rows,columns = rgb.shape[0:2]
+    # Each row starts with its filter type (0, none)
+    raw = np.zeros((rows,1+3*columns),dtype=np.uint8)
+    raw[:,1:] = rgb.reshape(rows,3*columns)
+
+    def chunk(tag,data):
+        return(struct.pack('>I',len(data))+tag+data+\
+            struct.pack('>I',zlib.crc32(tag+data)&0xffffffff))
+
+    png = b'\x89PNG\r\n\x1a\n'+\
+        chunk(b'IHDR',struct.pack('>IIBBBBB',columns,rows,8,2,0,0,0))+\
+        chunk(b'IDAT',zlib.compress(raw.tobytes(),compression))+\
+        chunk(b'IEND',b'')
+
+    # Written to a temporary file first, dashboards never read a partial file
+    temporary_filename = filename+'.part'
+    with open(temporary_filename,'wb') as png_file:
+        png_file.write(png)
+    os.rename(temporary_filename,filename)
+
+
+class PolarRaster():
+    '''
+    Position of each pixel of the polar raster in a grid of azimuths
+    (columns) and zenith distances (rows), as indices of the flattened
+    grid and their weights (bilinear or nearest). Only depends on the
+    raster and the grid, so it is kept and shared between images.
+    '''
+
+    cached_rasters = {}
+    max_cached_rasters = 4
+
+    def __init__(self,size,max_zd,AZdirs,ZDdirs,method='linear'):
+        key = (size,max_zd,tuple(AZdirs),tuple(ZDdirs),method)
+        if key in self.cached_rasters:
+            self.inside,self.horizon,self.indices,self.weights = self.cached_rasters[key]
+            return(None)
+
+        self.calculate_index(size,max_zd,np.array(AZdirs,dtype=float),\
+            np.array(ZDdirs,dtype=float),method)
+
+        if len(self.cached_rasters)>=self.max_cached_rasters:
+            self.cached_rasters.clear()
+        self.cached_rasters[key] = (self.inside,self.horizon,self.indices,self.weights)
+
+    @staticmethod
+    def grid_position(values,axis):
+        ''' Cell of the axis where each value is and position inside it (0 to 1) '''
+        cell = np.clip(np.searchsorted(axis,values,side='right')-1,0,len(axis)-2)
+        position = (values-axis[cell])/(axis[cell+1]-axis[cell])
+        return(cell,np.clip(position,0,1))
+
+    def calculate_index(self,size,max_zd,AZdirs,ZDdirs,method):
+        # Pixel coordinates from the centre, y up, in raster radii
+        center = (size-1)/2.
+        y,x = np.mgrid[0:size,0:size]
+        dx = (x-center)/(size/2.)
+        dy = (center-y)/(size/2.)
+        zd = np.hypot(dx,dy)*max_zd
+        # North up, East right
+        az = np.degrees(np.arctan2(dx,dy))%360
+
+        self.inside = zd<=max_zd
+        self.horizon = self.inside*(zd>max_zd*(1-2./size))
+
+        az_cell,az_position = self.grid_position(az[self.inside],AZdirs)
+        zd_cell,zd_position = self.grid_position(zd[self.inside],ZDdirs)
+        columns = len(AZdirs)
+
+        if method=='nearest':
+            az_cell += (az_position>=0.5)
+            zd_cell += (zd_position>=0.5)
+            self.indices = (zd_cell*columns+az_cell)[:,None]
+            self.weights = np.ones(self.indices.shape,dtype=np.float32)
+        else:
+            corner = zd_cell*columns+az_cell
+            self.indices = np.array([corner,corner+1,corner+columns,corner+columns+1]).T
+            self.weights = np.array([\
+                (1-zd_position)*(1-az_position),(1-zd_position)*az_position,\
+                zd_position*(1-az_position),zd_position*az_position],dtype=np.float32).T
+
+    def values(self,grid):
+        ''' Grid values at the pixels inside the horizon '''
+        return(np.sum(np.ravel(grid)[self.indices]*self.weights,axis=1))
+
+    def colour_image(self,grid,lut,vmin,vmax):
+        ''' RGB raster: values between vmin and vmax coloured with lut '''
+        values = self.values(grid)
+        valid = np.isfinite(values)
+        levels = np.floor((values[valid]-vmin)*len(lut)/(vmax-vmin))
+        colours = np.empty((len(values),3),dtype=np.uint8)
+        colours[:] = background_colour
+        colours[valid] = lut[np.clip(levels,0,len(lut)-1).astype(int)]
+
+        rgb = np.empty(self.inside.shape+(3,),dtype=np.uint8)
+        rgb[:] = background_colour
+        rgb[self.inside] = colours
+        rgb[self.horizon] = horizon_colour
+        return(rgb)
+
+
+def quicklook_filename(ImageInfo,path_option,prefix):
+    return(str("%s/%s_%s_%s_%s.png" %(getattr(ImageInfo,path_option),prefix,\
+        ImageInfo.obs_name,ImageInfo.fits_date,ImageInfo.used_filter)))
+
+def quicklook_map(ImageInfo,path_option,prefix,AZgrid,ZDgrid,grid,\
+ max_zd,method,lut,vmin,vmax):
+    output_path = getattr(ImageInfo,path_option,False)
+    if output_path==False:
+        return(None)
+    if output_path=="screen":
+        print('Quick-look maps are only saved to disk, skipping '+str(prefix))
+        return(None)
+
+    # Azimuths of the grids in radians, zenith distances in degrees
+    AZdirs = np.round(np.degrees(np.array(AZgrid)[0,:]),6)
+    ZDdirs = np.array(ZDgrid,dtype=float)[:,0]
+    Raster = PolarRaster(ImageInfo.quicklook_size,max_zd,AZdirs,ZDdirs,method)
+    try:
+        write_png(quicklook_filename(ImageInfo,path_option,prefix),\
+            Raster.colour_image(grid,lut,vmin,vmax))
+    except (IOError,OSError) as e:
+        print(str(inspect.stack()[0][2:4][::-1])+' Cannot write '+str(prefix)+': '+str(e))
+
+def skybrightness_quicklook(SkyBrightness,ImageInfo):
+    ''' SB map (up to 75 deg zenith distance) between the background levels '''
+    if getattr(ImageInfo,'skybrightness_quicklook_path',False)==False:
+        return(None)
+    if not hasattr(SkyBrightness,'SBgrid'):
+        print('SB not measured in the grid, skipping SkyBrightnessQuicklook')
+        return(None)
+    vmin,vmax = ImageInfo.background_levels[ImageInfo.used_filter][0:2]
+    quicklook_map(ImageInfo,'skybrightness_quicklook_path','SkyBrightnessQuicklook',\
+        SkyBrightness.AZgrid,SkyBrightness.ZDgrid,SkyBrightness.SBgrid,\
+        75,'linear',colour_lut(YlGnBu_anchors,256),float(vmin),float(vmax))
+
+def cloudmap_quicklook(CloudCoverage,ImageInfo):
+    ''' Cloud coverage map (0 to 1), nearest grid value as in the full map '''
+    quicklook_map(ImageInfo,'cloudmap_quicklook_path','CloudMapQuicklook',\
+        CloudCoverage.AZgrid,CloudCoverage.ZDgrid,\
+        np.array(CloudCoverage.CloudCoverage,dtype=float),\
+        90,'nearest',colour_lut(cloud_anchors,5),0.,1.)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+'''
+Render figures from saved plot inputs
+
+The analysis saves the plot inputs of each figure (SB map, cloud map,
+Bouguer fit, sky map) to plot_data_path when that option is set (see
+plot_rendering.py). With defer_plots the figures are not rendered in
+real time; this command generates any subset of them later, e.g. for a
+whole night, in parallel.
+
+  render_plots.py -p plot_data_path [-d date,...] [-k kind,...] [-o output_dir] [-n workers]
+
+  date:  start of the image date (YYYYMMDD, YYYYMMDD_HH, ...)
+  kind:  skymap, bouguer, skybrightness, cloudmap (default: all)
+  output_dir: default, the output path configured during the analysis
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import glob
+    import time
+    import multiprocessing
+    # The draw functions are registered when these modules are imported
+    from bouguer_fit import *
+    from sky_brightness import *
+    from cloud_coverage import *
+    from skymap_plot import *
+    from plot_rendering import Plots,load_plot_data,render_plot,plot_worker_setup
+    from input_options import read_option_pairs,option_pairs_usage
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+
+def plot_data_files(plot_data_path,dates,kinds=[]):
+    '''
+    Saved plot inputs of the given figure kinds and images taken on the
+    given dates. Selected by file name, the files are not read.
+    '''
+    if len(dates)==0:
+        dates = ['']
+    prefixes = [Plots.file_prefixes[kind] for kind in kinds]
+    if len(prefixes)==0:
+        prefixes = ['*']
+    files = set()
+    for prefix in prefixes:
+        for date in dates:
+            # Files are named prefix_obsname_date_filter.npz
+            files.update(glob.glob("%s/%s_*_%s*.npz" %(plot_data_path,prefix,date)))
+    return(sorted(files))
+
+def render_file(arguments):
+    '''
+    Render the figure of a plot inputs file.
+    Returns the status (rendered, skipped or failed) and the error.
+    '''
+    filename,kinds,output_dir = arguments
+    try:
+        name,PlotData = load_plot_data(filename)
+    except Exception as e:
+        return('failed',str(filename)+' '+type(e).__name__+': '+str(e))
+    if len(kinds)>0 and name not in kinds:
+        return('skipped',None)
+
+    if output_dir!=False:
+        PlotData['output_path'] = output_dir
+    if PlotData['output_path'] in [False,"screen"]:
+        return('failed',str(filename)+' has no output path, use -o output_dir')
+    PlotData['filename'] = "%s/%s" %(PlotData['output_path'],\
+        os.path.basename(PlotData['filename']))
+    error = render_plot(name,PlotData)
+    return(('rendered',None) if error is None else ('failed',error))
+
+def render_plots(plot_data_path,dates=[],kinds=[],output_dir=False,workers=1,nice=0):
+    ''' Render the figures in parallel. Returns the number of failed figures. '''
+    files = plot_data_files(plot_data_path,dates,kinds)
+    print('Rendering '+str(len(files))+' plot input files from '+str(plot_data_path))
+    arguments = [(filename,kinds,output_dir) for filename in files]
+
+    start = time.time()
+    if workers<=1:
+        results = [render_file(argument) for argument in arguments]
+    else:
+        pool = multiprocessing.Pool(workers,plot_worker_setup,(nice,))
+        try:
+            # Several files per task, so each worker reuses its figures
+            results = pool.map(render_file,arguments,\
+                chunksize=max(1,len(arguments)//(4*workers)))
+        finally:
+            pool.close()
+            pool.join()
+
+    statuses = [status for status,error in results]
+    for status,error in results:
+        if error is not None:
+            print(str(inspect.stack()[0][2:4][::-1])+' Plot failed: '+error)
+    print('%d figures rendered in %.1f s, %d failed' \
+        %(statuses.count('rendered'),time.time()-start,statuses.count('failed')))
+    return(statuses.count('failed'))
+
+
+class RenderOptions():
+    ''' option value pairs '''
+    options = {'-p': 'plot_data_path', '-d': 'dates', '-k': 'kinds',\
+     '-o': 'output_dir', '-n': 'workers'}
+
+    def __init__(self,input_options):
+        self.plot_data_path = False
+        self.dates = ''
+        self.kinds = ''
+        self.output_dir = False
+        self.workers = str(multiprocessing.cpu_count())
+
+        read_option_pairs(self,input_options[1:],'render_plots.py')
+        if self.plot_data_path==False:
+            option_pairs_usage('render_plots.py',self.options)
+
+        self.dates = [date for date in self.dates.split(',') if date!='']
+        self.kinds = [kind for kind in self.kinds.split(',') if kind!='']
+        for kind in self.kinds:
+            if kind not in Plots.draw_functions:
+                print('ERROR. Unknown figure kind: '+str(kind)+', use one of '+\
+                 ','.join(sorted(Plots.draw_functions)))
+                raise SystemExit
+        self.workers = int(self.workers)
+
+
+if __name__ == '__main__':
+    Options = RenderOptions(sys.argv)
+    failed = render_plots(Options.plot_data_path,Options.dates,Options.kinds,\
+        Options.output_dir,Options.workers)
+    sys.exit(0 if failed==0 else 1)
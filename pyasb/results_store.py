@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+'''
+Results database
+
+Optional SQLite store of the results of each image: summary, star
+photometry, SB grid, cloud coverage grid and measured image bias.
+The rows of an image are collected during its analysis and saved at
+the end in a single transaction (rows of a previous analysis of the
+same image are replaced), instead of one small text file per product.
+
+The text files of the previous versions can be regenerated from it:
+
+  results_store.py -r results_database -o output_dir [-d date,...]
+
+  date: start of the image date (YYYYMMDD, YYYYMMDD_HH, ...)
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import sqlite3
+    from input_options import read_option_pairs,option_pairs_usage
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+
+class ResultsStore():
+    '''
+    Tables of results, one row per image (summaries, image_bias), per
+    star (stars) or per grid point (sb_grid, cloud_grid). Every row
+    starts with the image key: obs_name, date (fits_date) and filter.
+    '''
+    key_columns = ['obs_name','date','filter']
+    tables = [\
+     ['summaries',['stars INTEGER','good_stars REAL','zero_point REAL',\
+       'zero_point_err REAL','extinction REAL','extinction_err REAL',\
+       'sb_zenith REAL','sb_zenith_err REAL','cloud_cover REAL','cloud_cover_err REAL']],\
+     ['stars',['hd_code TEXT','name TEXT','ra1950 TEXT','dec1950 TEXT',\
+       'azimuth REAL','altitude REAL','airmass REAL','magnitude REAL','color REAL',\
+       'flux REAL','flux_err REAL','m25logf REAL','m25logf_err REAL']],\
+     ['sb_grid',['altitude REAL','azimuth REAL','sb REAL','sb_err REAL']],\
+     ['cloud_grid',['altitude REAL','azimuth REAL','cloud_cover REAL','cloud_cover_err REAL']],\
+     ['image_bias',['date_string TEXT','bias REAL','bias_err REAL']]]
+
+    def __init__(self,database_filename):
+        self.database_filename = database_filename
+        # Several analysis processes can share the database
+        self.connection = sqlite3.connect(database_filename,timeout=60)
+        with self.connection:
+            for table,columns in self.tables:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %(table,\
+                    ', '.join([column+' TEXT' for column in self.key_columns]+columns)))
+                self.connection.execute(\
+                    'CREATE INDEX IF NOT EXISTS %s_image ON %s (date, filter, obs_name)' \
+                    %(table,table))
+
+    @classmethod
+    def columns(cls,table):
+        return(cls.key_columns+[column.split()[0] for column in dict(cls.tables)[table]])
+
+    def save(self,key,rows):
+        ''' Replace the results of an image (key) with rows, a list for each table '''
+        with self.connection:
+            for table,columns in self.tables:
+                self.connection.execute(\
+                    'DELETE FROM %s WHERE obs_name=? AND date=? AND filter=?' %table,key)
+                self.connection.executemany(\
+                    'INSERT INTO %s VALUES (%s)' %(table,','.join(['?']*len(self.columns(table)))),\
+                    [tuple(key)+tuple(row) for row in rows.get(table,[])])
+
+    def select(self,table,dates=[]):
+        ''' Rows of the images taken on the given dates, in insertion order '''
+        query = 'SELECT * FROM %s' %table
+        parameters = []
+        if len(dates)>0:
+            query += ' WHERE '+' OR '.join(['date GLOB ?']*len(dates))
+            parameters = [str(date)+'*' for date in dates]
+        return(self.connection.execute(query+' ORDER BY rowid',parameters).fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+class ImageResults():
+    ''' Rows of one image, collected during its analysis '''
+    def __init__(self,ImageInfo):
+        self.database_filename = ImageInfo.results_database
+        self.key = (str(ImageInfo.obs_name),str(ImageInfo.fits_date),str(ImageInfo.used_filter))
+        self.rows = {}
+
+    def add(self,table,rows):
+        self.rows.setdefault(table,[]).extend(rows)
+
+    def add_grid(self,table,ALTdirs,AZdirs,values,errors):
+        ''' One row per grid point: altitude, azimuth, value and error '''
+        self.add(table,[(float(alt_),float(az_),float(values[k][j]),float(errors[k][j])) \
+            for k,alt_ in enumerate(ALTdirs) for j,az_ in enumerate(AZdirs)])
+
+    def save(self):
+        Store = ResultsStore(self.database_filename)
+        try:
+            Store.save(self.key,self.rows)
+        finally:
+            Store.close()
+        print('Results saved to '+str(self.database_filename))
+
+
+def image_results(ImageInfo):
+    ''' Results of the image, if results_database is set '''
+    if getattr(ImageInfo,'results_database',False)==False:
+        return(None)
+    return(ImageResults(ImageInfo))
+
+
+def grid_axes(rows):
+    '''
+    Altitudes, azimuths, values and errors of a grid table (rows of
+    altitude, azimuth, value, error). Integer axes are written as such.
+    '''
+    def axis(values):
+        unique = []
+        for value in values:
+            if value not in unique:
+                unique.append(value)
+        return([int(value) if value==int(value) else value for value in unique])
+
+    ALTdirs = axis([row[0] for row in rows])
+    AZdirs = axis([row[1] for row in rows])
+    def grid(column):
+        return([[row[column] for row in rows[k*len(AZdirs):(k+1)*len(AZdirs)]] \
+            for k in range(len(ALTdirs))])
+    return(ALTdirs,AZdirs,grid(2),grid(3))
+
+def group_by_image(rows):
+    ''' Rows (without the key) of each image. NaN values are stored as NULL. '''
+    images = {}
+    order = []
+    for row in rows:
+        key = tuple(row[0:3])
+        if key not in images:
+            images[key] = []
+            order.append(key)
+        images[key].append(tuple(float('nan') if value is None else value \
+            for value in row[3:]))
+    return([(key,images[key]) for key in order])
+
+def export_legacy(database_filename,output_dir,dates=[]):
+    ''' Write the text files of the previous versions from the database '''
+    # Only needed here (they import the whole analysis)
+    from star_calibration import StarCatalog
+    from sky_brightness import SkyBrightness
+    from cloud_coverage import CloudCoverage
+    from write_summary import Summary
+
+    def write(filename,content):
+        with open(filename,'w+') as output_file:
+            output_file.writelines(content)
+
+    def table_filename(prefix,key):
+        return(str("%s/%s_%s_%s_%s.txt" %((output_dir,prefix)+tuple(key))))
+
+    Store = ResultsStore(database_filename)
+    files = 0
+    try:
+        for key,rows in group_by_image(Store.select('stars',dates)):
+            write(table_filename('PhotTable',key),StarCatalog.phottable_content(rows))
+            files += 1
+        for key,rows in group_by_image(Store.select('sb_grid',dates)):
+            ALTdirs,AZdirs,SBgrid,SBgrid_errors = grid_axes(rows)
+            write(table_filename('SBTable',key),\
+                SkyBrightness.sbtable_content(ALTdirs,AZdirs,SBgrid,SBgrid_errors))
+            files += 1
+        for key,rows in group_by_image(Store.select('cloud_grid',dates)):
+            ALTdirs,AZdirs,CloudGrid,CloudGridErr = grid_axes(rows)
+            write(table_filename('CloudTable',key),\
+                CloudCoverage.cloudtable_content(ALTdirs,AZdirs,CloudGrid,CloudGridErr))
+            files += 1
+        for key,rows in group_by_image(Store.select('summaries',dates)):
+            write(table_filename('Summary',key),\
+                Summary.summary_file_content(Summary.summary_strings(key[1:3],rows[0])))
+            files += 1
+        bias_rows = Store.select('image_bias',dates)
+        if len(bias_rows)>0:
+            write(output_dir+'/measured_image_bias.txt',\
+                [str(date_string)+','+str(used_filter)+','+str(bias)+','+str(bias_err)+'\r\n' \
+                 for obs_name,date,used_filter,date_string,bias,bias_err in bias_rows])
+            files += 1
+    finally:
+        Store.close()
+    print('%d files written to %s' %(files,output_dir))
+    return(files)
+
+
+class ExportOptions():
+    ''' option value pairs '''
+    options = {'-r': 'results_database', '-o': 'output_dir', '-d': 'dates'}
+
+    def __init__(self,input_options):
+        self.results_database = False
+        self.output_dir = False
+        self.dates = ''
+
+        read_option_pairs(self,input_options[1:],'results_store.py')
+        if self.results_database==False or self.output_dir==False:
+            option_pairs_usage('results_store.py',self.options)
+        self.dates = [date for date in self.dates.split(',') if date!='']
+
+
+if __name__ == '__main__':
+    Options = ExportOptions(sys.argv)
+    if not os.path.exists(Options.output_dir):
+        os.makedirs(Options.output_dir)
+    export_legacy(Options.results_database,Options.output_dir,Options.dates)
@@ -28,15 +28,19 @@ __status__ = "Prototype" # "Prototype", "Development", or "Production"
 try:
     import sys,os,inspect
     import numpy as np
-    import scipy.interpolate as sint
-    import matplotlib as mpl
-    import matplotlib.pyplot as plt
-    import matplotlib.colors as mpc
-    import matplotlib.patches as mpp
+    from lazy_modules import LazyModule
+    from plot_rendering import Renderer,Plots,plot_data
 except:
     print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
     raise SystemExit
 
+# Only needed for the SB map
+sint = LazyModule('scipy.interpolate')
+mpl = LazyModule('matplotlib')
+mpc = LazyModule('matplotlib.colors')
+mpcm = LazyModule('matplotlib.cm')
+mpp = LazyModule('matplotlib.patches')
+
 
 class SkyBrightness():
     '''
@@ -45,11 +49,15 @@ class SkyBrightness():
     '''
 
     def __init__(self,FitsImage,ImageInfo,ImageCoordinates,BouguerFit):
-        if ImageInfo.skybrightness_map_path!=False:
+        if ImageInfo.skybrightness_map_path!=False or \
+         getattr(ImageInfo,'skybrightness_quicklook_path',False)!=False:
             print('Measuring All-Sky Sky Brightness ...')
             #NOTE: This function is very slow, I need to figure how to improve it.
             self.measure_in_grid(FitsImage,ImageInfo,ImageCoordinates,BouguerFit)
             self.sbdata_table(ImageInfo)
+            Results = getattr(ImageInfo,'results',None)
+            if Results is not None:
+                Results.add_grid('sb_grid',self.ALTdirs,self.AZdirs,self.SBgrid,self.SBgrid_errors)
         else:
             print('Measuring SB only at zenith ...')
         self.measure_in_positions(FitsImage,ImageInfo,ImageCoordinates,BouguerFit)
@@ -120,6 +128,24 @@ class SkyBrightness():
         # Once we measured the sky brightness in the image, convert to radians the azimuths
         self.AZgrid = self.AZgrid*np.pi/180.
 
+    @staticmethod
+    def sbtable_content(ALTdirs,AZdirs,SBgrid,SBgrid_errors):
+        header = '#Altitude\Azimuth'
+        for az_ in  AZdirs:
+            header += ', '+str(az_)
+        header+='\n'
+
+        content = [header]
+
+        for k,alt_ in enumerate(ALTdirs):
+            line = str(alt_)
+            for j in xrange(len(AZdirs)):
+                line += ', '+str("%.3f" % float(SBgrid[k][j])) +\
+                ' +/- ' + str("%.3f" % float(SBgrid_errors[k][j]))
+            line+='\n'
+            content.append(line)
+        return(content)
+
     def sbdata_table(self,ImageInfo):
         try:
             assert(ImageInfo.skybrightness_table_path!=False)
@@ -129,20 +155,8 @@ class SkyBrightness():
         else:
             print('Write skybrightness table to file')
 
-            header = '#Altitude\Azimuth'
-            for az_ in  self.AZdirs:
-                header += ', '+str(az_)
-            header+='\n'
-
-            content = [header]
-
-            for k,alt_ in enumerate(self.ALTdirs):
-                line = str(alt_)
-                for j in xrange(len(self.AZdirs)):
-                    line += ', '+str("%.3f" % float(self.SBgrid[k][j])) +\
-                    ' +/- ' + str("%.3f" % float(self.SBgrid_errors[k][j]))
-                line+='\n'
-                content.append(line)
+            content = self.sbtable_content(\
+                self.ALTdirs,self.AZdirs,self.SBgrid,self.SBgrid_errors)
 
             if ImageInfo.skybrightness_table_path == "screen":
                 print(content)
@@ -188,32 +202,61 @@ class SkyBrightnessGraph():
         else:
             print('Generating Sky Brightness Map ...')
 
-        self.create_plot()
-        self.plot_labels(SkyBrightness,ImageInfo,BouguerFit)
-        self.define_contours(ImageInfo)
-        self.ticks_and_locators()
-        self.grid_data(SkyBrightness)
-        self.plot_data()
-        self.color_bar()
-        self.show_map(ImageInfo)
+        Plots.submit('skybrightness',\
+            self.skybrightness_plot_data(SkyBrightness,ImageInfo,BouguerFit),ImageInfo)
+
+    @staticmethod
+    def skybrightness_plot_data(SkyBrightness,ImageInfo,BouguerFit):
+        ''' Plot inputs of the SB map: measured grid and texts '''
+        image_information = str(ImageInfo.date_string)+" UTC\n"+str(ImageInfo.latitude)+5*" "+\
+            str(ImageInfo.longitude)+"\n"+ImageInfo.used_filter+4*" "+\
+            "K="+str("%.3f" % float(BouguerFit.Regression.extinction))+"+-"+\
+            str("%.3f" % float(BouguerFit.Regression.error_extinction))+"\n"+\
+            "SB="+str("%.2f" % float(SkyBrightness.SBzenith))+"+-"+\
+            str("%.2f" % float(SkyBrightness.SBzenith_err))+" mag/arcsec2 (zenith)"
 
-    def create_plot(self):
+        return(plot_data(ImageInfo,'skybrightness_map_path','SkyBrightnessMap',\
+            AZgrid=np.array(SkyBrightness.AZgrid),ZDgrid=np.array(SkyBrightness.ZDgrid),\
+            SBgrid=np.array(SkyBrightness.SBgrid),used_filter=ImageInfo.used_filter,\
+            background_levels=np.array(\
+                ImageInfo.background_levels[ImageInfo.used_filter][0:2],dtype=float),\
+            title=ImageInfo.backgroundmap_title,image_information=image_information))
+
+
+class SkyBrightnessMap():
+    ''' Draw the SB map from its plot inputs '''
+    def __init__(self,PlotData):
+        # The contour levels (and the colorbar) depend on the filter
+        with Renderer.figure('skybrightness_'+str(PlotData['used_filter']),\
+         PlotData['output_path'],(8,7.5),self.create_plot,PlotData['reuse_figures']) as \
+         (self.SBfigure,self.SBgraph,new):
+            self.plot_labels(PlotData)
+            self.define_contours(PlotData)
+            self.grid_data(PlotData)
+            self.plot_data()
+            if new: self.color_bar()
+            self.show_map(PlotData)
+
+    def create_plot(self,SBfigure):
         ''' Create the figure (empty) with matplotlib '''
-        self.SBfigure = plt.figure(figsize=(8,7.5))
+        self.SBfigure = SBfigure
         self.SBgraph  = self.SBfigure.add_subplot(111,projection='polar')
+        self.ticks_and_locators()
+        return(self.SBgraph)
 
-    def grid_data(self,SkyBrightness):
+    def grid_data(self,PlotData):
         # Griddata.
         self.AZgridi,self.ZDgridi = np.mgrid[0:2*np.pi:1000j, 0:75:1000j]
         self.ALTgridi = 90. - self.ZDgridi
 
-        coord_reshape = [[SkyBrightness.AZgrid[j][k],SkyBrightness.ZDgrid[j][k]] \
-            for k in xrange(len(SkyBrightness.AZgrid[0])) \
-            for j in xrange(len(SkyBrightness.AZgrid))]
+        AZgrid,ZDgrid,SBgrid = PlotData['AZgrid'],PlotData['ZDgrid'],PlotData['SBgrid']
+        coord_reshape = [[AZgrid[j][k],ZDgrid[j][k]] \
+            for k in xrange(len(AZgrid[0])) \
+            for j in xrange(len(AZgrid))]
 
-        data_reshape = [ SkyBrightness.SBgrid[j][k] \
-            for k in xrange(len(SkyBrightness.AZgrid[0])) \
-            for j in xrange(len(SkyBrightness.AZgrid))]
+        data_reshape = [ SBgrid[j][k] \
+            for k in xrange(len(AZgrid[0])) \
+            for j in xrange(len(AZgrid))]
 
         self.SBgridi = sint.griddata(coord_reshape,data_reshape, \
             (self.AZgridi,self.ZDgridi), method='linear')
@@ -221,7 +264,7 @@ class SkyBrightnessGraph():
     def plot_data(self):
         ''' Returns the graph with data plotted.'''
         self.SBcontoursf = self.SBgraph.contourf(\
-            self.AZgridi, self.ZDgridi, self.SBgridi, cmap=plt.cm.YlGnBu,levels=self.level_list)
+            self.AZgridi, self.ZDgridi, self.SBgridi, cmap=mpcm.YlGnBu,levels=self.level_list)
         self.SBcontours  = self.SBgraph.contour(\
             self.AZgridi, self.ZDgridi, self.SBgridi,
             colors='k',alpha=0.3,levels=self.coarse_level_list)
@@ -229,27 +272,21 @@ class SkyBrightnessGraph():
         # Limit radius
         self.SBgraph.set_ylim(0,75)
 
-    def plot_labels(self,SkyBrightness,ImageInfo,BouguerFit):
+    def plot_labels(self,PlotData):
         ''' Set the figure title and add extra information (annotation) '''
         # Image title
-        self.SBgraph.text(0,90, unicode(ImageInfo.backgroundmap_title,'utf-8'),\
+        self.SBgraph.text(0,90, unicode(PlotData['title'],'utf-8'),\
             horizontalalignment='center',size='xx-large')
 
         # Image information
-        image_information = str(ImageInfo.date_string)+" UTC\n"+str(ImageInfo.latitude)+5*" "+\
-            str(ImageInfo.longitude)+"\n"+ImageInfo.used_filter+4*" "+\
-            "K="+str("%.3f" % float(BouguerFit.Regression.extinction))+"+-"+\
-            str("%.3f" % float(BouguerFit.Regression.error_extinction))+"\n"+\
-            "SB="+str("%.2f" % float(SkyBrightness.SBzenith))+"+-"+\
-            str("%.2f" % float(SkyBrightness.SBzenith_err))+" mag/arcsec2 (zenith)"
+        self.SBgraph.text(5*np.pi/4,125,unicode(PlotData['image_information'],'utf-8'),\
+            fontsize='x-small')
 
-        self.SBgraph.text(5*np.pi/4,125,unicode(image_information,'utf-8'),fontsize='x-small')
-
-    def define_contours(self,ImageInfo):
+    def define_contours(self,PlotData):
         ''' Calculate optimal contours for pyplot.contour and pyplot.contourf '''
 
-        _min_ = float(ImageInfo.background_levels[ImageInfo.used_filter][0])
-        _max_ = float(ImageInfo.background_levels[ImageInfo.used_filter][1])
+        _min_ = float(PlotData['background_levels'][0])
+        _max_ = float(PlotData['background_levels'][1])
 
         sval = 0.1
         def create_ticks(_min_,_max_,sval):
@@ -283,22 +320,16 @@ class SkyBrightnessGraph():
         # Separation between colour bar and graph
         self.SBfigure.subplots_adjust(right=1)
         # Color bar
-        self.SBcolorbar = plt.colorbar(self.SBcontoursf,orientation='vertical',pad=0.07,shrink=0.75)
+        self.SBcolorbar = self.SBfigure.colorbar(self.SBcontoursf,ax=self.SBgraph,\
+            orientation='vertical',pad=0.07,shrink=0.75)
         self.SBfigure.subplots_adjust(right=0.80) # Restore separation
         self.SBcolorbar.set_ticks(self.label_list,update_ticks=self.update_ticks)
         self.SBcolorbar.set_label("mag/arcsec2",rotation="vertical",size="large")
 
-    def show_map(self,ImageInfo):
-        if ImageInfo.skybrightness_map_path=="screen":
-            plt.show()
-        else:
-            skybrightness_filename = str("%s/SkyBrightnessMap_%s_%s_%s.png" %(\
-                ImageInfo.skybrightness_map_path, ImageInfo.obs_name,\
-                ImageInfo.fits_date, ImageInfo.used_filter))
-            plt.tight_layout(pad=-1.5,rect=[0.1,0.05,1.,0.95])
-            plt.savefig(skybrightness_filename)
-
-        #plt.clf()
-        #plt.close('all')
+    def show_map(self,PlotData):
+        Renderer.output(self.SBfigure,PlotData['output_path'],PlotData['filename'],\
+            tight_layout={'pad':-1.5,'rect':[0.1,0.05,1.,0.95]})
+
+Plots.register('skybrightness',SkyBrightnessMap,'SkyBrightnessMap')
 
 
@@ -26,21 +26,33 @@ __status__ = "Prototype" # "Prototype", "Development", or "Production"
 try:
     import sys,os,inspect
     from astrometry import *
-    from scipy.ndimage import uniform_filter
-    from scipy.ndimage import median_filter
+    from astrometry_fit import *
     import numpy as np
     import math
-    import matplotlib.pyplot as plt
-    import matplotlib.colors as mpc
-    import matplotlib.patches as mpp
-    import matplotlib as mpl
+    from lazy_modules import LazyModule
+    from plot_rendering import Renderer,Plots,plot_data
 except:
     print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
     raise SystemExit
 
+# Only needed to draw the sky map
+ndimage = LazyModule('scipy.ndimage')
+plt = LazyModule('matplotlib.pyplot')
+mpc = LazyModule('matplotlib.colors')
+mpp = LazyModule('matplotlib.patches')
+mpcoll = LazyModule('matplotlib.collections')
+mpl = LazyModule('matplotlib')
+
+# Size (inches) of the sky map figure
+skymap_figsize = (8,8)
+
 class SkyMap():
     ''' SkyMap class '''
     
+    # Display stretch of the last frames, by filter and exposure
+    cached_stretch = {}
+    max_cached_stretch = 8
+    
     def __init__(self,ImageInfo,FitsImage):
         # Set ImageInfo as local sub-object, we will use
         # it a lot.
@@ -52,8 +64,11 @@ class SkyMap():
         else:
             print('Star Map plot ...')
             bitpix = ImageInfo.ccd_bits
+            # The image is not drawn with more pixels than the figure has
+            self.decimation = self.display_decimation(ImageInfo)
             self.stretch_data(\
-                FitsImage.fits_data_notcalibrated*1./2**bitpix,\
+                self.block_average(FitsImage.fits_data_notcalibrated,self.decimation)\
+                    *1./2**bitpix,\
                 ImageInfo.perc_low,\
                 ImageInfo.perc_high)
             #self.setup_skymap()
@@ -65,15 +80,16 @@ class SkyMap():
     
     def setup_skymap(self):
         '''
-        To be executed at the beginning (no stars)
+        To be executed at the beginning (no stars).
+        Figure of the interactive astrometry solver.
         '''
         if (self.ImageInfo.skymap_path!=False):
             self.define_skymap()
-            self.draw_skymap_data()
-            self.skyfigure.canvas.draw()
-            self.skyfigure.canvas.flush_events()
+            SkyMapPlot.draw_skymap_data(self.skyimage,self.image_plot_data())
             
             if (self.ImageInfo.skymap_path=="screen"):
+                self.skyfigure.canvas.draw()
+                self.skyfigure.canvas.flush_events()
                 plt.show(block=False)
     
     def complete_skymap(self):
@@ -81,42 +97,121 @@ class SkyMap():
         To be executed when an astrometric solution is found
         '''
         if (self.ImageInfo.skymap_path!=False):
-            self.draw_catalog_stars()
-            self.draw_detected_stars()
-            self.draw_polar_axes()
-            self.skyfigure.canvas.draw()
-            self.skyfigure.canvas.flush_events()
-            self.show_figure()
+            Plots.submit('skymap',self.skymap_plot_data(),self.ImageInfo)
     
     def set_starcatalog(self,StarCatalog):
         self.StarCatalog = StarCatalog
     
-    def draw_catalog_stars(self):
-        for Star in self.StarCatalog.StarList_Tot:
-            self.draw_annotate_star(Star, type=0)
+    def image_plot_data(self):
+        ''' Plot inputs: stretched image and information text '''
+        information=str(self.ImageInfo.date_string)+" UTC\n"+str(self.ImageInfo.latitude)+5*" "+\
+            str(self.ImageInfo.longitude)+"\n"+self.ImageInfo.used_filter
+        return(plot_data(self.ImageInfo,'skymap_path','SkyMap',\
+            image=self.stretched_fits_data,information=information,\
+            image_extent=self.image_extent(self.stretched_fits_data.shape,self.decimation),\
+            resolution=np.array(self.ImageInfo.resolution[0:2]),\
+            dpi=self.ImageInfo.skymap_dpi))
     
-    def draw_detected_stars(self):
-        for Star in self.StarCatalog.StarList_Det:
-            self.draw_annotate_star(Star, type=1)
-        for Star in self.StarCatalog.StarList_Phot:
-            self.draw_annotate_star(Star, type=2)
+    def skymap_plot_data(self):
+        ''' Plot inputs: image, star positions and apertures, meridians and altitude isolines '''
+        PlotData = self.image_plot_data()
+        
+        def star_values(star_list,attributes):
+            return([np.array([getattr(Star,attribute) for Star in star_list],\
+                dtype=float) for attribute in attributes])
+        
+        PlotData['catalog_x'],PlotData['catalog_y'] = \
+            star_values(self.StarCatalog.StarList_Tot,['Xcoord','Ycoord'])
+        PlotData['catalog_name'] = \
+            np.array([str(Star.name) for Star in self.StarCatalog.StarList_Tot])
+        PlotData['catalog_mag'], = star_values(self.StarCatalog.StarList_Tot,['FilterMag'])
+        PlotData['detected_x'],PlotData['detected_y'],PlotData['detected_r1'] = \
+            star_values(self.StarCatalog.StarList_Det,['Xcoord','Ycoord','R1'])
+        PlotData['photometric_x'],PlotData['photometric_y'],\
+            PlotData['photometric_r2'],PlotData['photometric_r3'] = \
+            star_values(self.StarCatalog.StarList_Phot,['Xcoord','Ycoord','R2','R3'])
+        PlotData['photometric_mag'] = \
+            np.array([str(Star.FilterMag) for Star in self.StarCatalog.StarList_Phot])
+        PlotData['max_labels'] = self.ImageInfo.skymap_max_labels
+        PlotData['label_spacing'] = self.ImageInfo.skymap_label_spacing
+        
+        zenith_xy = zenith_position(self.ImageInfo)
+        altitudes = np.arange(0,90,15)
+        azimuths = np.arange(0,360,30)
+        key_azimuths = {0: "N",90: "E", 180: "S", 270: "W"}
+        PlotData['zenith_xy'] = np.array(zenith_xy[0:2],dtype=float)
+        PlotData['altitudes'] = altitudes
+        PlotData['altitude_radius'] = np.array([math.sqrt(\
+            (horiz2xy(0,each_altitude,self.ImageInfo)[0]-zenith_xy[0])**2 +\
+            (horiz2xy(0,each_altitude,self.ImageInfo)[1]-zenith_xy[1])**2) \
+            for each_altitude in altitudes])
+        PlotData['azimuth_xy'] = np.array([horiz2xy(each_azimuth,0,self.ImageInfo) \
+            for each_azimuth in azimuths],dtype=float)
+        PlotData['azimuth_label_xy'] = np.array([\
+            horiz2xy(each_azimuth,self.ImageInfo.min_altitude,self.ImageInfo) \
+            for each_azimuth in azimuths],dtype=float)
+        PlotData['azimuth_label'] = np.array([str(key_azimuths.get(each_azimuth,each_azimuth)) \
+            for each_azimuth in azimuths])
+        return(PlotData)
+    
+    @staticmethod
+    def display_decimation(ImageInfo):
+        ''' Image pixels per displayed pixel at the output DPI '''
+        display_pixels = min(skymap_figsize)*ImageInfo.skymap_dpi
+        return(max(1,int(min(ImageInfo.resolution[0:2])//display_pixels)))
+    
+    @staticmethod
+    def block_average(data,block):
+        ''' Mean of each block x block pixels (the remaining edge is dropped) '''
+        if block<=1:
+            return(data)
+        rows,columns = data.shape[0]//block,data.shape[1]//block
+        return(data[:rows*block,:columns*block].reshape(rows,block,columns,block).\
+            mean(axis=(1,3),dtype='float32'))
+    
+    @staticmethod
+    def image_extent(shape,block):
+        ''' Extent of the block averaged image in pixels of the full image '''
+        return(np.array([-0.5,shape[1]*block-0.5,shape[0]*block-0.5,-0.5]))
+    
+    @staticmethod
+    def approximate_percentiles(data,percentiles,bins=4096):
+        ''' Percentiles from the histogram of data (error below one bin) '''
+        datamin,datamax = np.min(data),np.max(data)
+        if not datamax>datamin:
+            return([datamin for percentile in percentiles])
+        counts,edges = np.histogram(data,bins=bins,range=(datamin,datamax))
+        cumulative = np.concatenate(([0],np.cumsum(counts)*100./np.size(data)))
+        return([np.interp(percentile,cumulative,edges) for percentile in percentiles])
     
     def stretch_data(self,fits_data,pmin,pmax):
-        #log_fits_data = np.log(fits_data-np.min(fits_data)+1,dtype="float32")
-        # some statistics: min, max, mean
-        print(np.min(fits_data),np.max(fits_data),np.mean(fits_data))
-        #fits_data = median_filter(fits_data, 3)
-        fits_data = uniform_filter(fits_data, 5)
-        log_fits_data = np.arcsinh(fits_data-np.min(fits_data)+1.,dtype="float32")
-        valuemin = np.percentile(log_fits_data,pmin)
-        valuemax = np.percentile(log_fits_data,pmax)
+        #fits_data = ndimage.median_filter(fits_data, 3)
+        # Smoothing of 5 pixels of the full image
+        fits_data = ndimage.uniform_filter(fits_data, int(5./self.decimation+0.5))
+        
+        # The offset and limits are kept for skymap_stretch_refresh frames
+        key = (self.ImageInfo.used_filter,self.ImageInfo.exposure,\
+            fits_data.shape,self.decimation,pmin,pmax)
+        cached = self.cached_stretch.get(key)
+        if cached is None or cached[3]>=self.ImageInfo.skymap_stretch_refresh:
+            offset = np.min(fits_data)
+            log_fits_data = np.arcsinh(fits_data-offset+1.,dtype="float32")
+            valuemin,valuemax = self.approximate_percentiles(log_fits_data,[pmin,pmax])
+            frames = 0
+        else:
+            offset,valuemin,valuemax,frames = cached
+            log_fits_data = np.arcsinh(fits_data-offset+1.,dtype="float32")
+        
+        if key not in self.cached_stretch and \
+         len(self.cached_stretch)>=self.max_cached_stretch:
+            self.cached_stretch.clear()
+        self.cached_stretch[key] = (offset,valuemin,valuemax,frames+1)
         self.stretched_fits_data = log_fits_data.clip(valuemin,valuemax)
     
     def define_skymap(self):
         ''' Create figure and self.skyimage subplot. '''
-        self.skyfigure = plt.figure(figsize=(8,8))
-        self.skyimage  = self.skyfigure.add_subplot(111)
-        self.skyfigure.canvas.draw()#(block=False)
+        self.skyfigure,self.skyimage,new = Renderer.acquire(\
+            'skymap_solver',self.ImageInfo.skymap_path,skymap_figsize,reuse=False)
     
     def mouse_press_callback(self,event):
         ''' Coordinate input '''
@@ -195,47 +290,44 @@ class SkyMap():
         return(None)
     
     def astrometry_optimizer(self,full=True):
-        from scipy.optimize import minimize
-        from astrometry import horiz2xy
-        
-        def horiz2xy_chi2(sol,az,alt,x,y):
-            self.ImageInfo.radial_factor     = sol[0]
-            self.ImageInfo.azimuth_zeropoint = sol[1]
-            if (full==True):
-                self.ImageInfo.delta_x           = sol[2]
-                self.ImageInfo.delta_y           = sol[3]
-                self.ImageInfo.latitude_offset   = sol[4]
-                self.ImageInfo.longitude_offset  = sol[5]
-            else:
-                self.ImageInfo.delta_x           = 0
-                self.ImageInfo.delta_y           = 0
-                self.ImageInfo.latitude_offset   = 0
-                self.ImageInfo.longitude_offset  = 0
-            
-            xf,yf = horiz2xy(az,alt,self.ImageInfo,derotate=True)
-            return(np.sum((xf-x)**2 + (yf-y)**2))
-        
+        '''
+        Fit the astrometric solution to the identified stars.
+        If full is False, only the radial factor and azimuth zeropoint
+        are fitted (the other parameters are set to 0).
+        '''
         coords = np.array(self.identified_stars)[:,1:] # Remove star name
         coords = np.array(coords,dtype=float)          # Convert to float
         [_az,_alt,_x,_y] = np.transpose(coords)        # Transpose and split
         print('Solving equation system')
         
+        initial = get_projection_parameters(self.ImageInfo)
         if (full==True):
-            initial=[10,0,0,0,0,0]
+            free = [True]*6
+            starting_zeropoints = [initial[1]]
         else:
-            initial=[0,0]
+            initial[2:] = 0
+            free = [True,True,False,False,False,False]
+            # Few stars, avoid local minima in the azimuth zeropoint
+            starting_zeropoints = np.arange(0,360,45)
+        
+        solutions = []
+        for zeropoint in starting_zeropoints:
+            initial[1] = zeropoint
+            solutions.append(fit_projection(\
+                _az,_alt,_x,_y,self.ImageInfo,initial=initial,free=free))
+        solution,rms = min(solutions,key=lambda each: each[1])
         
-        res = minimize(horiz2xy_chi2,initial,args = (_az,_alt,_x,_y),tol=1e-3)
-
         # Fix negative radial factor
-        if (res.x[0]<0):
-            res.x[0] = -res.x[0]
-            res.x[1] = 180-res.x[1]
-
+        if (solution[0]<0):
+            solution[0] = -solution[0]
+            solution[1] = solution[1]+180
+        solution[1] = solution[1]%360
+        
+        set_projection_parameters(self.ImageInfo,solution)
+        
         print("Parameters (radial_factor, azimuth_zeropoint, delta_x, delta_y, lat_offset, lon_offset): ")
-        print(res.x)
-        print("Score [sum(dev^2)] = %.3f" %horiz2xy_chi2(res.x,_az,_alt,_x,_y))
-        print("Success: %s" %res.success)
+        print(solution)
+        print("Score [sum(dev^2)] = %.3f" %(np.size(_x)*rms**2))
 
     def astrometry_solver(self):
         print(\
@@ -269,30 +361,40 @@ class SkyMap():
         self.cid_mouse = self.skyfigure.canvas.mpl_connect('button_press_event', self.mouse_press_callback)
         self.cid_keyboard = self.skyfigure.canvas.mpl_connect('key_press_event', self.key_press_callback)
         plt.show(block=True)
+        Renderer.release('skymap_solver')
+
+
+class SkyMapPlot():
+    ''' Draw the sky map from its plot inputs '''
+    def __init__(self,PlotData):
+        with Renderer.figure('skymap',PlotData['output_path'],skymap_figsize,\
+         reuse=PlotData['reuse_figures']) as (self.skyfigure,self.skyimage,new):
+            self.draw_skymap_data(self.skyimage,PlotData)
+            self.draw_catalog_stars(PlotData)
+            self.draw_detected_stars(PlotData)
+            self.draw_polar_axes(PlotData)
+            Renderer.output(self.skyfigure,PlotData['output_path'],PlotData['filename'],\
+                tight_layout={'pad':0},dpi=PlotData['dpi'])
     
-    def draw_skymap_data(self):
+    @staticmethod
+    def draw_skymap_data(skyimage,PlotData):
         ''' Draw image '''
-        self.skyimage.imshow(self.stretched_fits_data,cmap=mpl.cm.gray)
-
-        self.skyimage.axis([0,self.ImageInfo.resolution[0],0,self.ImageInfo.resolution[1]])
-        information=str(self.ImageInfo.date_string)+" UTC\n"+str(self.ImageInfo.latitude)+5*" "+\
-            str(self.ImageInfo.longitude)+"\n"+self.ImageInfo.used_filter
+        skyimage.imshow(PlotData['image'],cmap=mpl.cm.gray,\
+            extent=tuple(PlotData['image_extent']))
         
-        self.skyimage.text(0.010,0.010,information,fontsize='small',color='white',\
-            transform = self.skyimage.transAxes,backgroundcolor=(0,0,0,0.75))
+        skyimage.axis([0,PlotData['resolution'][0],0,PlotData['resolution'][1]])
+        skyimage.text(0.010,0.010,PlotData['information'],fontsize='small',color='white',\
+            transform = skyimage.transAxes,backgroundcolor=(0,0,0,0.75))
         
-        plt.draw()
-        
-    def draw_polar_axes(self):
+        if (PlotData['output_path']=="screen"):
+            plt.draw()
+    
+    def draw_polar_axes(self,PlotData):
         ''' Draws meridian and altitude isolines. '''
         
-        zenith_xy = zenith_position(self.ImageInfo)
+        zenith_xy = PlotData['zenith_xy']
         
-        for each_altitude in np.arange(0,90,15):
-            coord_altitude_0 = horiz2xy(0,each_altitude,self.ImageInfo)
-            radius = math.sqrt(\
-                (coord_altitude_0[0]-zenith_xy[0])**2 +\
-                (coord_altitude_0[1]-zenith_xy[1])**2)
+        for each_altitude,radius in zip(PlotData['altitudes'],PlotData['altitude_radius']):
             self.skyimage.add_patch(\
                 mpp.Circle((zenith_xy[0],zenith_xy[1]),radius,
                 facecolor='k',fill=False, alpha=0.2,label='_nolegend_'))
@@ -302,72 +404,75 @@ class SkyMap():
                 alpha=0.2,
                 fontsize=10)
         
-        key_azimuths = {0: "N",90: "E", 180: "S", 270: "W"}
-        
-        for each_azimuth in np.arange(0,360,30):
-            coord_azimuth_0 = horiz2xy(each_azimuth,0,self.ImageInfo)
+        for coord_azimuth_0,label_xy,azimuth_label in zip(\
+         PlotData['azimuth_xy'],PlotData['azimuth_label_xy'],PlotData['azimuth_label']):
             self.skyimage.plot(\
                 [zenith_xy[0],coord_azimuth_0[0]],
                 [zenith_xy[1],coord_azimuth_0[1]],
                 color='k',
                 alpha=0.2,)
-            
-            if each_azimuth in key_azimuths:
-                azimuth_label = str(key_azimuths[each_azimuth])
-            else:
-                azimuth_label = str(each_azimuth)
             self.skyimage.annotate(\
-                azimuth_label,
-                xy=horiz2xy(each_azimuth,self.ImageInfo.min_altitude,self.ImageInfo),
+                str(azimuth_label),
+                xy=label_xy,
                 color='k',
                 alpha=0.2,
                 fontsize=10)
-        
-    def draw_annotate_star(self,Star,type=0):
+    
+    @staticmethod
+    def label_selection(x,y,magnitudes,max_labels,label_spacing):
+        '''
+        Stars to annotate: the brightest one in each cell of
+        label_spacing x label_spacing pixels, and at most max_labels
+        (brightest first). Negative values mean no limit.
+        '''
+        selected = np.argsort(magnitudes,kind='mergesort')
+        if label_spacing>0 and len(selected)>0:
+            cell_x = np.floor(x[selected]/label_spacing).astype(int)
+            cell_y = np.floor(y[selected]/label_spacing).astype(int)
+            cell_x -= cell_x.min()
+            cell_y -= cell_y.min()
+            cells = cell_x*(cell_y.max()+1)+cell_y
+            selected = selected[np.sort(np.unique(cells,return_index=True)[1])]
+        if max_labels>=0:
+            selected = selected[:max_labels]
+        return(selected)
+    
+    def draw_apertures(self,x,y,radius,edgecolor,label):
+        ''' All the apertures of a class in one collection '''
+        self.skyimage.add_collection(mpcoll.PatchCollection(\
+            [mpp.Circle((x_,y_),radius_) for x_,y_,radius_ in zip(x,y,radius)],\
+            facecolor='none',edgecolor=edgecolor,\
+            linewidth=1,alpha=0.5,label=label))
+    
+    def draw_labels(self,x,y,labels,selected,**annotate_options):
+        for index in selected:
+            self.skyimage.annotate(str(labels[index]),xy=(x[index],y[index]),\
+                xycoords='data',textcoords='offset points',fontsize=8,**annotate_options)
+    
+    def draw_catalog_stars(self,PlotData):
+        x,y = PlotData['catalog_x'],PlotData['catalog_y']
+        if len(x)==0:
+            return
+        self.skyimage.scatter(x,y,\
+            marker='+',c='red',alpha=0.2,label='Catalog')
+        self.draw_labels(x,y,PlotData['catalog_name'],\
+            self.label_selection(x,y,PlotData['catalog_mag'],\
+                PlotData['max_labels'],PlotData['label_spacing']),\
+            xytext=(0,3),alpha=0.8)
+    
+    def draw_detected_stars(self,PlotData):
         # Draw identified stars and measuring circles.
-        # Annotate HD catalog code and Magnitude for each star.
+        # Annotate the Magnitude of the photometric stars.
+        self.draw_apertures(PlotData['detected_x'],PlotData['detected_y'],\
+            PlotData['detected_r1'],(0,0,0.8),'Detected')
         
-        if(type==0):
-            self.skyimage.scatter(Star.Xcoord,Star.Ycoord,\
-                marker='+',c='red',alpha=0.2,label='Catalog')
-            self.skyimage.annotate(\
-                Star.name,xy=(Star.Xcoord,Star.Ycoord), \
-                xycoords='data',xytext=(0, 3),\
-                textcoords='offset points',fontsize=8,alpha=0.8)
-        elif(type==1):
-            self.skyimage.add_patch(mpp.Circle(\
-                (Star.Xcoord,Star.Ycoord),Star.R1,\
-                facecolor='none',edgecolor=(0,0,0.8),\
-                linewidth=1, fill=False, alpha=0.5,\
-                label='Detected'))
-        elif(type==2):
-            self.skyimage.add_patch(mpp.Circle(\
-                (Star.Xcoord,Star.Ycoord),Star.R2,\
-                facecolor='none',edgecolor=(0,0.8,0),\
-                linewidth=1, fill=False, alpha=0.5,\
-                label='Photometric'))
-            self.skyimage.add_patch(mpp.Circle(\
-                (Star.Xcoord,Star.Ycoord),Star.R3,\
-                facecolor='none',edgecolor=(0.8,0,0),\
-                linewidth=1, fill=False, alpha=0.5,\
-                label='_nolegend_'))
-            self.skyimage.annotate(Star.FilterMag,xy=(Star.Xcoord,Star.Ycoord), \
-                xycoords='data',xytext=(0,-10),\
-                textcoords='offset points',fontsize=8)
-            
-    def show_figure(self):
-        #self.skyimage.legend(('Catalog','Detected','Photometric'),loc='upper right')
-        if self.ImageInfo.skymap_path=="screen":
-            plt.show()
-            #self.skyfigure.canvas.draw()
-            #self.skyfigure.canvas.flush_events()
-        else:
-            skymap_filename = str("%s/SkyMap_%s_%s_%s.png" %(\
-                self.ImageInfo.skymap_path, self.ImageInfo.obs_name,\
-                self.ImageInfo.fits_date, self.ImageInfo.used_filter))
+        x,y = PlotData['photometric_x'],PlotData['photometric_y']
+        self.draw_apertures(x,y,PlotData['photometric_r2'],(0,0.8,0),'Photometric')
+        self.draw_apertures(x,y,PlotData['photometric_r3'],(0.8,0,0),'_nolegend_')
+        if len(x)>0:
+            self.draw_labels(x,y,PlotData['photometric_mag'],\
+                self.label_selection(x,y,np.array(PlotData['photometric_mag'],dtype=float),\
+                    PlotData['max_labels'],PlotData['label_spacing']),\
+                xytext=(0,-10))
 
-            plt.tight_layout(pad=0)
-            plt.savefig(skymap_filename)
-        
-        #plt.clf()
-        #plt.close('all')
+Plots.register('skymap',SkyMapPlot,'SkyMap')
@@ -30,15 +30,17 @@ __status__ = "Prototype" # "Prototype", "Development", or "Production"
 try:
     import sys,os,inspect
     import ephem
-    import scipy.stats
     import scipy.ndimage as ndimage
     import scipy.ndimage.filters as filters
     from astrometry import *
     from skymap_plot import *
+    from lazy_modules import LazyModule
 except:
     print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
     raise SystemExit
 
+stats = LazyModule('scipy.stats')
+
 
 def verbose(function, *args):
     '''
@@ -55,6 +57,62 @@ def verbose(function, *args):
     else:
         return(out)
 
+def batch_centroid(fits_data,Xcoords,Ycoords,radii,background,\
+ iterations=3,tolerance=0.05):
+    '''
+    Refine the centroid of many stars at once.
+    Square cutouts (half size = radii) around each star are stacked
+    in a single array and weighted with the background-subtracted
+    squared flux. Stars whose position changes less than tolerance
+    pixels are frozen for the next iterations.
+    Returns the refined X,Y coordinates, the total shift of each star
+    and the convergence mask. Stars that cannot be centered get NaN.
+    '''
+    Xcoords    = np.array(Xcoords,dtype=float)
+    Ycoords    = np.array(Ycoords,dtype=float)
+    radii      = np.array(radii,dtype=float)
+    background = np.array(background,dtype=float)
+    max_y,max_x = np.shape(fits_data)
+
+    X0 = np.array(Xcoords)
+    Y0 = np.array(Ycoords)
+    converged = np.zeros(np.size(Xcoords),dtype=bool)
+
+    if np.size(Xcoords)==0:
+        return(Xcoords,Ycoords,np.zeros(0),converged)
+
+    half = int(np.ceil(np.max(radii)))+1
+    offsets = np.arange(-half,half+1)
+
+    for iteration in xrange(iterations):
+        active = np.where(~converged*np.isfinite(Xcoords)*np.isfinite(Ycoords))[0]
+        if np.size(active)==0:
+            break
+
+        Xa = Xcoords[active][:,None,None]
+        Ya = Ycoords[active][:,None,None]
+        Ra = radii[active][:,None,None]
+        # Pixel indexes of each cutout, shape (stars,rows,columns)
+        px = np.floor(Xa+0.5).astype(int) + offsets[None,None,:]
+        py = np.floor(Ya+0.5).astype(int) + offsets[None,:,None]
+        inbox = (np.abs(px-Xa)<=Ra)*(np.abs(py-Ya)<=Ra)*\
+            (px>=0)*(px<max_x)*(py>=0)*(py<max_y)
+        cutouts = fits_data[np.clip(py,0,max_y-1),np.clip(px,0,max_x-1)]
+
+        weight = inbox*(cutouts-background[active][:,None,None])**2
+        norm = np.sum(weight,axis=(1,2))
+        with np.errstate(invalid='ignore',divide='ignore'):
+            newX = np.sum(weight*px,axis=(1,2))/norm
+            newY = np.sum(weight*py,axis=(1,2))/norm
+
+        step = np.hypot(newX-Xcoords[active],newY-Ycoords[active])
+        Xcoords[active] = newX
+        Ycoords[active] = newY
+        converged[active] = step<tolerance
+
+    shift = np.hypot(Xcoords-X0,Ycoords-Y0)
+    return(Xcoords,Ycoords,shift,converged)
+
 class Star():
     def __init__(self,StarCatalogLine,ImageInfo):
         ''' Takes StarCatalogLine (line from catalog file) and 
@@ -102,15 +160,11 @@ class Star():
          errormsg=' Cannot detect peaks')
  
     def camera_dependent_astrometry(self,FitsImage,ImageInfo):
-        # Measure fluxes
+        # Measure fluxes (the background is needed to weight the centroid).
+        # The centroid itself is refined for all stars at once, 
+        # see StarCatalog.refine_centroids
         self.verbose_detection(self.measure_star_fluxes,FitsImage.fits_data,\
          errormsg=' Error measuring fluxes')
-        # Estimate centroid
-        self.verbose_detection(self.estimate_fits_region_centroid,\
-         FitsImage,True,\
-         errormsg=' Cannot create the Star+SecurityRing region')
-        self.verbose_detection(self.estimate_centroid,\
-         errormsg=' Star centroid calculated')
     
     def camera_dependent_photometry(self,FitsImage,ImageInfo):
         # Measure fluxes
@@ -408,21 +462,6 @@ class Star():
              max(0,int(self.Ycoord - self.R3 + 0.5)),\
              min(len(FitsImage.fits_data),int(self.Ycoord + self.R3 + 0.5)))]
     
-    def estimate_fits_region_centroid(self,FitsImage,coarse=False):
-        ''' Return the region that contains the star+background '''
-        if (coarse==True):
-            self.fits_region_centroid = [[FitsImage.fits_data[y,x] \
-             for x in xrange(int(self.Xcoord - self.R2 + 0.5),\
-              int(self.Xcoord + self.R2 + 0.5)) if self.valid_point(x,y,FitsImage)] \
-             for y in xrange(int(self.Ycoord - self.R2 + 0.5),\
-              int(self.Ycoord + self.R2 + 0.5))]
-        else:
-            self.fits_region_centroid = [[FitsImage.fits_data[y,x] \
-             for x in xrange(int(self.Xcoord - self.R1 + 0.5),\
-              int(self.Xcoord + self.R1 + 0.5)) if self.valid_point(x,y,FitsImage)] \
-             for y in xrange(int(self.Ycoord - self.R1 + 0.5),\
-              int(self.Ycoord + self.R1 + 0.5))]
-
     def detect_peaks(self,FitsImage,size=5,threshold=None):
         ''' Find peaks (stars) in our complete region '''
         data = np.array([[FitsImage.fits_data[y,x] \
@@ -480,7 +519,7 @@ class Star():
                  y-len(self.fits_region_complete[0])/2.,self.R2)]
             
             # Sky background flux. t_student 95%.
-            t_skyflux = scipy.stats.t.isf(0.025,np.size(self.pixels3))
+            t_skyflux = stats.t.isf(0.025,np.size(self.pixels3))
 
             # 4 possible background estimators. Mean, Median and a Mode approx.
             # Each one has its own drawbacks.
@@ -569,22 +608,6 @@ class Star():
         except:
             self.destroy=True
     
-    def estimate_centroid(self):
-        ''' Returns star centroid from a region that contains the star
-            needs self.R2'''
-        
-        try:
-            data = (self.fits_region_centroid - self.skyflux)**2.
-            h,w=data.shape
-            x=np.arange(w)
-            y=np.arange(h)
-            x1=np.ones((1,h))
-            y1=np.ones((w,1))
-            self.Xcoord += (np.dot(np.dot(x1, data), y))/(np.dot(np.dot(x1, data), y1)) -w/2.
-            self.Ycoord += (np.dot(np.dot(x, data), y1))/(np.dot(np.dot(x1, data), y1)) -h/2.
-        except:
-            self.destroy=True
-    
     def optimal_aperture_photometry(self,ImageInfo,fits_data):
         '''
         Optimize the aperture to minimize uncertainties and assert
@@ -635,7 +658,8 @@ class Star():
          "destroy","PhotometricStandard","HDcode","name","FilterMag",\
          "Color","saturated","cold_pixels","masked","RA1950","DEC1950",\
          "azimuth","altit_real","airmass","Xcoord","Ycoord",\
-         "R1","R2","R3","starflux","starflux_err","m25logF","m25logF_unc"\
+         "R1","R2","R3","starflux","starflux_err","m25logF","m25logF_unc",\
+         "centroid_shift"\
          ]
         for atribute in list(self.__dict__):
             #if atribute[0]!="_" and atribute not in backup_attributes:
@@ -647,6 +671,9 @@ class StarCatalog():
         Takes FitsImage,ImageInfo,ObsPyephem, returns an object with 
         the processed Star list'''
     
+    # Catalog lines already read, by (filename, modification time)
+    loaded_catalogs = {}
+    
     def __init__(self,ImageInfo):
         print('Creating Star Catalog ...')
         self.load_catalog_file(ImageInfo.catalog_filename)
@@ -675,13 +702,21 @@ class StarCatalog():
             return(theline)
         
         try:
+            catalog_key = (catalog_filename,os.path.getmtime(catalog_filename))
+            if catalog_key in StarCatalog.loaded_catalogs:
+                self.CatalogLines = StarCatalog.loaded_catalogs[catalog_key]
+                print('File '+str(catalog_filename)+' already loaded.')
+                return
+            
             self.catalogfile = open(catalog_filename, 'r')
             CatalogContent = self.catalogfile.readlines()
+            self.catalogfile.close()
             MinLine = 1; separator = ";"
             self.CatalogLines = [catalog_separation(CatalogContent[line])
              for line in xrange(len(CatalogContent)) \
              if line>=MinLine-1 and line_is_star(CatalogContent[line])]
-        except IOError:
+            StarCatalog.loaded_catalogs = {catalog_key:self.CatalogLines}
+        except (IOError,OSError):
             print('IOError. Error opening file '+catalog_filename+'.')
             #return 1
         except:
@@ -728,9 +763,13 @@ class StarCatalog():
                 self.StarList_TotVisible.append(TheStar)
         
         print(" - Observable stars: %d" %len(self.StarList_TotVisible))
-        
+
         for TheStar in self.StarList_TotVisible:
             TheStar.camera_dependent_astrometry(FitsImage,ImageInfo)
+
+        self.refine_centroids(FitsImage,ImageInfo)
+
+        for TheStar in self.StarList_TotVisible:
             TheStar.camera_dependent_photometry(FitsImage,ImageInfo)
             TheStar.check_star_issues(FitsImage,ImageInfo)
             if (TheStar.destroy==False):
@@ -740,7 +779,46 @@ class StarCatalog():
         
         print(" - Detected stars: %d" %len(self.StarList_Det))
         print(" - With photometry: %d" %len(self.StarList_Phot))
-   
+
+    def refine_centroids(self,FitsImage,ImageInfo):
+        '''
+        Estimate the centroid of all the observable stars at once.
+        Each star keeps the distance between its predicted and
+        measured position (centroid_shift). A large median shift
+        means that the astrometric solution is no longer valid.
+        '''
+
+        StarList = [Star for Star in self.StarList_TotVisible if Star.destroy==False]
+
+        Xcoords,Ycoords,shift,converged = batch_centroid(\
+            FitsImage.fits_data,\
+            [Star.Xcoord for Star in StarList],\
+            [Star.Ycoord for Star in StarList],\
+            [Star.R2 for Star in StarList],\
+            [Star.skyflux for Star in StarList],\
+            iterations=ImageInfo.centroid_iterations,\
+            tolerance=ImageInfo.centroid_tolerance)
+
+        for k,Star in enumerate(StarList):
+            if not (np.isfinite(Xcoords[k]) and np.isfinite(Ycoords[k])):
+                Star.destroy=True
+                continue
+            Star.Xcoord = Xcoords[k]
+            Star.Ycoord = Ycoords[k]
+            Star.centroid_shift = shift[k]
+
+        valid = np.isfinite(shift)
+        if np.sum(valid)>0:
+            self.centroid_median_shift = np.median(shift[valid])
+            print(" - Centroid shift: %.2f px (median), %d/%d stars converged" \
+             %(self.centroid_median_shift,np.sum(converged),np.size(converged)))
+            if self.centroid_median_shift>ImageInfo.max_centroid_shift:
+                print(str(inspect.stack()[0][2:4][::-1])+\
+                 ' WARNING: large astrometric offset detected,'+\
+                 ' the astrometric solution should be revised')
+        else:
+            self.centroid_median_shift = None
+
     def look_for_nearby_stars(self,FitsImage,ImageInfo):
         '''
         Process the catalog. For each star, look for close stars in the field
@@ -757,7 +835,28 @@ class StarCatalog():
         print(" - Observable stars: %d" %len(self.StarList_TotVisible))
         print(" - With nearby stars: %d" %len(self.StarList_WithNearbyStar))
 
+    def photometry_rows(self):
+        ''' Values of the photometric table, one tuple per star '''
+        return([(Star.HDcode,Star.name,Star.RA1950,Star.DEC1950,Star.azimuth,\
+            Star.altit_real,Star.airmass,Star.FilterMag,Star.Color,Star.starflux,\
+            Star.starflux_err,Star.m25logF,Star.m25logF_unc) for Star in self.StarList_Phot])
+    
+    @staticmethod
+    def phottable_content(rows):
+        content = ['#HDcode, CommonName, RA1950, DEC1950, Azimuth, '+\
+         'Altitude, Airmass, Magnitude, Color(#-V), StarFlux, StarFluxErr, '+\
+         'mag+2.5logF, [mag+2.5logF]_Err\n']
+        for row in rows:
+            content.append(', '.join([str(value) for value in row])+'\n')
+        return(content)
+    
     def save_to_file(self,ImageInfo):
+        rows = self.photometry_rows()
+        Results = getattr(ImageInfo,'results',None)
+        if Results is not None:
+            Results.add('stars',[tuple(str(value) for value in row[0:4])+\
+                tuple(float(value) for value in row[4:]) for row in rows])
+        
         try:
             assert(ImageInfo.photometry_table_path not in [False, "False", "false", "F"])
         except:
@@ -765,15 +864,7 @@ class StarCatalog():
         else:
             print('Write photometric table to file')
             
-            content = ['#HDcode, CommonName, RA1950, DEC1950, Azimuth, '+\
-             'Altitude, Airmass, Magnitude, Color(#-V), StarFlux, StarFluxErr, '+\
-             'mag+2.5logF, [mag+2.5logF]_Err\n']
-            for Star in self.StarList_Phot:
-                content.append(str(Star.HDcode)+', '+str(Star.name)+', '+str(Star.RA1950)+', '+\
-                 str(Star.DEC1950)+', '+str(Star.azimuth)+', '+str(Star.altit_real)+\
-                 ', '+str(Star.airmass)+', '+str(Star.FilterMag)+', '+str(Star.Color)+\
-                 ', '+str(Star.starflux)+', '+str(Star.starflux_err)+', '+str(Star.m25logF)+\
-                 ', '+str(Star.m25logF_unc)+'\n')
+            content = self.phottable_content(rows)
             
             if (ImageInfo.photometry_table_path == "screen"):
                 print(content)
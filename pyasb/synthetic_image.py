@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+'''
+Synthetic AllSky image generator
+
+Create fisheye AllSky frames from the star catalog, for tests and
+benchmarks. Stars are projected with horiz2xy (ZEA or ARC) for the
+given date and observatory, rendered with a Gaussian or Moffat PSF
+and added to a sky background with gradient and light dome. The
+frame is then vignetted (data/vignetting_*.cfg), flat and dark
+signatures and noise are added. The matching MasterDark and
+FlatField are also written, so the frame can be reduced as a real one.
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import copy
+    import numpy as np
+    import astropy.io.fits as pyfits
+    from read_config import *
+    from image_info import *
+    from astrometry import horiz2xy,calculate_airmass
+    from star_calibration import StarCatalog
+    from input_options import read_option_pairs
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+default_vignetting = os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+    '..','data','vignetting_sigma8mm_f35.cfg')
+
+
+def synthetic_header(date,exposure,used_filter,resolution):
+    ''' Minimal header with the keywords checked by ImageTest '''
+    header = pyfits.Header()
+    header['NAXIS1'] = int(resolution[0])
+    header['NAXIS2'] = int(resolution[1])
+    header['DATE'] = (str(date),'YYYYMMDD_HHMMSS (UTC)')
+    header['EXPOSURE'] = (float(exposure),'Exposure time (s)')
+    header['FILTER'] = str(used_filter)
+    return(header)
+
+def radial_factor_for(resolution,fill=0.95):
+    ''' radial_factor (ZEA) that puts the horizon at fill*half the image size '''
+    return(fill*min(resolution)/2./(180.0*np.sqrt(2)/np.pi))
+
+def load_vignetting(vignetting_file):
+    ''' Angle (deg from the optical axis) and relative illumination '''
+    table = np.loadtxt(vignetting_file,delimiter=',',comments='#',ndmin=2)
+    return(table[:,0],table[:,1])
+
+
+class SyntheticAllSky():
+    '''
+    Synthetic frame for the given ImageInfo (observatory and geometry,
+    from the config file). The model parameters are class attributes
+    and can be changed with keyword arguments. Units: sky brightness
+    in mag/arcsec2, dark_current in counts/s, read_noise in e-,
+    ccd_gain in e-/count. The true values are written in the header
+    (SYNT* keywords), to compare with the analysis results.
+    '''
+    zero_point = 10.3
+    extinction = 0.25
+    sb_zenith = 20.5
+    # Sky brighter by sb_airmass_gradient*(airmass-1) (fraction)
+    sb_airmass_gradient = 0.3
+    # Light pollution dome, fraction of the zenith brightness at the horizon
+    light_dome = 1.0
+    light_dome_azimuth = 180.0
+    psf = 'gaussian'
+    psf_fwhm = 2.5
+    moffat_beta = 3.0
+    render_max_magnitude = 6.5
+    render_min_altitude = 2.0
+    bias_level = 1000.0
+    dark_current = 0.5
+    hot_pixel_fraction = 1e-4
+    flat_prnu = 0.01
+    vignetting_file = default_vignetting
+
+    def __init__(self,ImageInfo,ConfigOptions,date,exposure=30.,\
+     used_filter='Johnson_V',resolution=(1000,1000),seed=0,**parameters):
+        for parameter,value in parameters.items():
+            if not hasattr(SyntheticAllSky,parameter):
+                raise ValueError('Unknown synthetic image parameter '+str(parameter))
+            setattr(self,parameter,value)
+
+        self.random = np.random.RandomState(seed)
+        self.header = synthetic_header(date,exposure,used_filter,resolution)
+        self.ImageInfo = copy.copy(ImageInfo)
+        self.ImageInfo.read_header(self.header)
+        self.ImageInfo.config_processing_specificfilter(ConfigOptions)
+        self.shape = (self.ImageInfo.resolution[1],self.ImageInfo.resolution[0])
+
+        self.horizontal_maps()
+        self.flat_signature()
+        self.dark_signature()
+
+    def horizontal_maps(self):
+        ''' Altitude and azimuth of each pixel (inverse of horiz2xy, no derotation) '''
+        II = self.ImageInfo
+        x = np.arange(II.resolution[0])-(II.resolution[0]/2-II.delta_x)
+        y = np.arange(II.resolution[1])-(II.resolution[1]/2+II.delta_y)
+        X,Y = np.meshgrid(x,y)
+        radius = np.sqrt(X**2+Y**2)/(II.radial_factor*180.0/np.pi)
+
+        if II.projection=='ARC':
+            self.altitude = 90.0*(1-radius)
+        else:
+            self.altitude = np.where(radius<2,\
+             np.arcsin(np.clip(1-0.5*radius**2,-1,1))*180.0/np.pi,-90.0)
+        self.azimuth = (II.azimuth_zeropoint+np.arctan2(Y,X)*180.0/np.pi)%360
+
+    def sky_background(self):
+        ''' Sky counts per pixel (before vignetting) '''
+        pixel_scale = (3600**2)/self.ImageInfo.radial_factor**2
+        zenith_flux = self.ImageInfo.exposure*pixel_scale*\
+            10**(0.4*(self.zero_point-self.sb_zenith))
+
+        # Airmass saturates near the horizon (extinction dims the sky there)
+        altitude = np.clip(self.altitude,5,90)
+        airmass = calculate_airmass(altitude)
+        dome = 0.5*(1+np.cos((self.azimuth-self.light_dome_azimuth)*np.pi/180.))*\
+            np.exp(-altitude/20.)
+        sky = zenith_flux*(1+self.sb_airmass_gradient*(airmass-1))*(1+self.light_dome*dome)
+        sky[self.altitude<=0] = 0
+        return(sky)
+
+    def catalog_stars(self):
+        ''' X, Y and counts of the catalog stars above the horizon '''
+        II = copy.copy(self.ImageInfo)
+        II.max_magnitude = self.render_max_magnitude
+        II.min_altitude = self.render_min_altitude
+        II.max_star_number = 1000000
+        self.StarCatalog = StarCatalog(II)
+
+        stars = []
+        color_term = II.color_terms[II.used_filter][0]
+        for Star in self.StarCatalog.StarList_Tot:
+            X,Y = horiz2xy(Star.azimuth,Star.altit_appa,II)
+            # Inverse of the photometry: m+2.5log(F/t)+c*color = ZP-K*airmass
+            counts = II.exposure*10**(0.4*(self.zero_point-\
+                self.extinction*Star.airmass-Star.FilterMag-color_term*Star.Color))
+            stars.append((X,Y,counts))
+        return(stars)
+
+    def psf_profile(self,dx,dy):
+        if self.psf=='moffat':
+            alpha = self.psf_fwhm/(2*np.sqrt(2**(1./self.moffat_beta)-1))
+            return((1+(dx**2+dy**2)/alpha**2)**(-self.moffat_beta))
+        else:
+            sigma = self.psf_fwhm/(2*np.sqrt(2*np.log(2)))
+            return(np.exp(-0.5*(dx**2+dy**2)/sigma**2))
+
+    def render_stars(self,image,stars):
+        ''' Add the stars to the image, each one in a small stamp '''
+        half = int(np.ceil((4 if self.psf=='moffat' else 3)*self.psf_fwhm))+1
+        offsets = np.arange(-half,half+1)
+        for X,Y,counts in stars:
+            xc,yc = int(round(X)),int(round(Y))
+            dx,dy = np.meshgrid(offsets+xc-X,offsets+yc-Y)
+            profile = self.psf_profile(dx,dy)
+            profile = counts*profile/np.sum(profile)
+
+            x0,y0 = xc-half,yc-half
+            xa,ya = max(0,x0),max(0,y0)
+            xb,yb = min(self.shape[1],x0+2*half+1),min(self.shape[0],y0+2*half+1)
+            if xa>=xb or ya>=yb: continue
+            image[ya:yb,xa:xb] += profile[ya-y0:yb-y0,xa-x0:xb-x0]
+        return(image)
+
+    def flat_signature(self):
+        ''' Vignetting of the lens and pixel response (the synthetic FlatField) '''
+        vignetting = np.ones(self.shape)
+        if self.vignetting_file not in [None,False] and os.path.isfile(self.vignetting_file):
+            angle,illumination = load_vignetting(self.vignetting_file)
+            vignetting = np.interp(90.0-self.altitude,angle,illumination)
+        prnu = 1+self.flat_prnu*self.random.standard_normal(self.shape)
+        self.flat = np.array(vignetting*prnu,dtype='float32')
+
+    def dark_signature(self):
+        ''' Bias and dark current with hot pixels (the noiseless MasterDark) '''
+        dark_rate = self.dark_current*np.ones(self.shape)
+        hot_pixels = self.random.random_sample(self.shape)<self.hot_pixel_fraction
+        dark_rate[hot_pixels] *= 50
+        self.dark_rate = dark_rate
+        self.dark = np.array(self.bias_level+dark_rate*self.ImageInfo.exposure,dtype='float32')
+
+    def render(self):
+        ''' Returns the raw frame (counts, clipped to the CCD range) '''
+        II = self.ImageInfo
+        signal = self.render_stars(self.sky_background(),self.catalog_stars())
+        signal = signal*self.flat+self.dark_rate*II.exposure
+
+        gain = float(II.ccd_gain)
+        electrons = self.random.poisson(np.clip(signal,0,None)*gain)
+        frame = electrons/gain+self.bias_level+\
+            self.random.normal(0,II.read_noise/gain,self.shape)
+        frame = np.clip(np.round(frame),0,2**II.ccd_bits-1)
+        self.data = np.array(frame,dtype='uint16' if II.ccd_bits<=16 else 'int32')
+
+        self.header['SYNTZP'] = (self.zero_point,'Synthetic zero point')
+        self.header['SYNTK'] = (self.extinction,'Synthetic extinction')
+        self.header['SYNTSB'] = (self.sb_zenith,'Synthetic zenith SB (mag/arcsec2)')
+        self.header['SYNTFWHM'] = (self.psf_fwhm,'Synthetic '+str(self.psf)+' PSF FWHM (px)')
+        self.header.add_comment('Synthetic AllSky image [PyASB]')
+        return(self.data)
+
+    def save(self,output_dir):
+        ''' Write image, MasterDark and FlatField. Returns the 3 file names '''
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        II = self.ImageInfo
+        files = [\
+         "%s/Synthetic_%s_%s.fits" %(output_dir,II.fits_date,II.used_filter),
+         "%s/Synthetic_MasterDark_%ds.fits" %(output_dir,II.exposure),
+         "%s/Synthetic_FlatField_%s.fits" %(output_dir,II.used_filter)]
+
+        if not hasattr(self,'data'):
+            self.render()
+        for filename,data in zip(files,[self.data,self.dark,self.flat]):
+            header = self.header.copy()
+            for keyword in ['NAXIS1','NAXIS2']:
+                del header[keyword]
+            pyfits.PrimaryHDU(data=data,header=header).writeto(filename,clobber=True)
+            print('Synthetic image written to '+str(filename))
+        return(files)
+
+
+class SyntheticOptions():
+    '''
+    -c config_file -o output_dir -d YYYYMMDD_HHMMSS -f filter
+    -t exposure -r WIDTHxHEIGHT -s seed
+    '''
+    options = {'-c': 'configfile', '-o': 'output_dir', '-d': 'date',\
+     '-f': 'used_filter', '-t': 'exposure', '-r': 'resolution', '-s': 'seed'}
+
+    def __init__(self,input_options):
+        self.configfile = 'config.cfg'
+        self.output_dir = '.'
+        self.date = '20130115_220000'
+        self.used_filter = 'Johnson_V'
+        self.exposure = 30.
+        self.resolution = '1000x1000'
+        self.seed = 0
+
+        read_option_pairs(self,input_options[1:],'synthetic_image.py')
+
+        self.exposure = float(self.exposure)
+        self.seed = int(self.seed)
+        self.resolution = [int(value) for value in self.resolution.split('x')]
+        if not self.used_filter.startswith('Johnson'):
+            self.used_filter = 'Johnson_'+self.used_filter
+
+
+if __name__ == '__main__':
+    InputOptions = SyntheticOptions(sys.argv)
+    ConfigOptions_ = ConfigOptions(InputOptions.configfile)
+    ImageInfoCommon = ImageInfo()
+
+    class FakeInputOptions:
+        void = None
+
+    ImageInfoCommon.config_processing_common(ConfigOptions_,FakeInputOptions)
+
+    Synthetic = SyntheticAllSky(ImageInfoCommon,ConfigOptions_,\
+     InputOptions.date,InputOptions.exposure,InputOptions.used_filter,\
+     InputOptions.resolution,InputOptions.seed)
+    Synthetic.save(InputOptions.output_dir)
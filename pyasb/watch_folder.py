@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+'''
+Watch folder
+
+Detect the new FITS images written by the camera in one or more
+directories. pyinotify is used when available, otherwise the
+directories are polled. Files are returned only when they are
+complete (size and mtime no longer changing).
+____________________________
+
+This module is part of the PyASB project,
+created and maintained by Mireia Nievas [UCM].
+____________________________
+'''
+
+__author__ = "Mireia Nievas"
+__copyright__ = "Copyright 2012, PyASB project"
+__credits__ = ["Mireia Nievas"]
+__license__ = "GNU GPL v3"
+__shortname__ = "PyASB"
+__longname__ = "Python All-Sky Brightness pipeline"
+__version__ = "1.99.0"
+__maintainer__ = "Mireia Nievas"
+__email__ = "mirph4k[at]gmail[dot]com"
+__status__ = "Prototype" # "Prototype", "Development", or "Production"
+
+try:
+    import sys,os,inspect
+    import time
+except:
+    print(str(inspect.stack()[0][2:4][::-1])+': One or more modules missing')
+    raise SystemExit
+
+try:
+    import pyinotify
+except ImportError:
+    # Linux only, fall back to polling
+    pyinotify = None
+
+
+class FolderWatcher():
+    '''
+    Report new FITS files in the given directories.
+    If a ProcessedRegister is given, the files already in the directories
+    that are not registered are analyzed too (catch up after a restart).
+    Otherwise only the files written after the start are reported.
+    '''
+    valid_ext = ['.fts','.fit','.fits','.FTS','.FIT','.FITS']
+
+    def __init__(self,directories,register=None,settle_time=2.,poll_interval=1.):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.register = register
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+
+        # path -> (size,mtime) in the last check
+        self.pending = {}
+        self.known = set()
+
+        for path in self.list_directories():
+            if register is None: self.known.add(path)
+            else: self.add_candidate(path)
+
+        self.notifier = None
+        if pyinotify is not None:
+            self.setup_inotify()
+        print('Watching '+str(self.directories)+\
+         (' (inotify)' if self.notifier is not None else ' (polling)'))
+
+    def is_fits(self,path):
+        return(os.path.splitext(path)[1] in self.valid_ext)
+
+    def list_directories(self):
+        for directory in self.directories:
+            try: names = os.listdir(directory)
+            except OSError: continue
+            for name in names:
+                path = os.path.join(directory,name)
+                if self.is_fits(path): yield path
+
+    def add_candidate(self,path):
+        if path in self.known or not self.is_fits(path): return
+        self.known.add(path)
+        self.pending[path] = None
+
+    def setup_inotify(self):
+        watcher = self
+        class NewFileHandler(pyinotify.ProcessEvent):
+            def process_IN_CLOSE_WRITE(self,event):
+                watcher.add_candidate(event.pathname)
+            def process_IN_MOVED_TO(self,event):
+                watcher.add_candidate(event.pathname)
+
+        try:
+            watch_manager = pyinotify.WatchManager()
+            for directory in self.directories:
+                watch_manager.add_watch(directory,\
+                 pyinotify.IN_CLOSE_WRITE|pyinotify.IN_MOVED_TO)
+            self.notifier = pyinotify.Notifier(watch_manager,NewFileHandler())
+        except Exception as e:
+            print(str(inspect.stack()[0][2:4][::-1])+\
+             ' inotify not available, polling the directories: '+str(e))
+            self.notifier = None
+
+    def wait_for_events(self):
+        if self.notifier is not None:
+            if self.notifier.check_events(timeout=int(1000*self.poll_interval)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        else:
+            time.sleep(self.poll_interval)
+            for path in self.list_directories():
+                self.add_candidate(path)
+
+    def complete_files(self):
+        '''
+        Candidates whose size and mtime did not change since the last
+        check and were not modified in the last settle_time seconds.
+        '''
+        now = time.time()
+        for path in sorted(self.pending):
+            try: file_stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+
+            signature = (file_stat.st_size,file_stat.st_mtime)
+            if signature!=self.pending[path] or file_stat.st_size==0 or \
+             now-file_stat.st_mtime<self.settle_time:
+                self.pending[path] = signature
+                continue
+
+            del self.pending[path]
+            if self.register is not None and \
+             self.register.contains(path,*signature):
+                continue
+            yield((path,)+signature)
+
+    def new_files(self):
+        ''' Complete new files (path,size,mtime). Never ends '''
+        while True:
+            for new_file in self.complete_files():
+                yield(new_file)
+            self.wait_for_events()
@@ -44,26 +44,45 @@ class Summary():
     def summarize_results(self,InputOptions, Image, ImageAnalysis,\
     InstrumentCalibration, ImageSkyBrightness, CloudCoverage):
 
-        sum_date   = str(Image.ImageInfo.fits_date)
-        sum_filter = str(Image.ImageInfo.used_filter)
-        sum_stars  = str(InstrumentCalibration.BouguerFit.Regression.Nstars_initial)
-        sum_gstars = str("%.1f"%float(InstrumentCalibration.BouguerFit.Regression.Nstars_rel))
-        sum_zpoint = \
-         str("%.3f"%float(InstrumentCalibration.BouguerFit.Regression.mean_zeropoint))+' +/- '+\
-         str("%.3f"%float(InstrumentCalibration.BouguerFit.Regression.error_zeropoint))
-        sum_extinction = \
-         str("%.3f"%float(InstrumentCalibration.BouguerFit.Regression.extinction))+' +/- '+\
-         str("%.3f"%float(InstrumentCalibration.BouguerFit.Regression.error_extinction))
-        sum_skybrightness = \
-         str("%.3f"%float(ImageSkyBrightness.SBzenith))+' +/- '+\
-         str("%.3f"%float(ImageSkyBrightness.SBzenith_err))
-        sum_cloudcoverage = \
-         str("%.3f"%float(CloudCoverage.mean_cloudcover))+' +/- '+\
-         str("%.3f"%float(CloudCoverage.error_cloudcover))
+        Regression = InstrumentCalibration.BouguerFit.Regression
+        self.summary_values = [\
+            Regression.Nstars_initial, Regression.Nstars_rel,\
+            Regression.mean_zeropoint, Regression.error_zeropoint,\
+            Regression.extinction, Regression.error_extinction,\
+            ImageSkyBrightness.SBzenith, ImageSkyBrightness.SBzenith_err,\
+            CloudCoverage.mean_cloudcover, CloudCoverage.error_cloudcover]
         
-        self.summary_content = \
-            [sum_date, sum_filter,sum_stars, sum_gstars, \
-            sum_zpoint, sum_extinction, sum_skybrightness, sum_cloudcoverage]
+        self.summary_content = self.summary_strings(\
+            [Image.ImageInfo.fits_date,Image.ImageInfo.used_filter],self.summary_values)
+        
+        Results = getattr(Image.ImageInfo,'results',None)
+        if Results is not None:
+            Results.add('summaries',[tuple([int(float(self.summary_values[0]))]+\
+                [float(value) for value in self.summary_values[1:]])])
+    
+    @staticmethod
+    def summary_strings(date_filter,summary_values):
+        ''' Date, filter, stars, good stars and each value +/- its error '''
+        sum_date   = str(date_filter[0])
+        sum_filter = str(date_filter[1])
+        sum_stars  = str(summary_values[0])
+        sum_gstars = str("%.1f"%float(summary_values[1]))
+        sum_zpoint,sum_extinction,sum_skybrightness,sum_cloudcoverage = \
+         [str("%.3f"%float(value))+' +/- '+str("%.3f"%float(error)) \
+          for value,error in zip(summary_values[2::2],summary_values[3::2])]
+        
+        return([sum_date, sum_filter,sum_stars, sum_gstars, \
+            sum_zpoint, sum_extinction, sum_skybrightness, sum_cloudcoverage])
+    
+    @staticmethod
+    def summary_file_content(summary_content):
+        content = ['#Date, Filter, Stars, % Good Stars, ZeroPoint, Extinction, SkyBrightness, CloudCoverage\n']
+        for line in summary_content:
+            content_line = ""
+            for element in line:
+                content_line += element
+            content.append(content_line+", ")
+        return(content)
 
     def save_summary_to_file(self,ImageInfo):
         try:
@@ -74,12 +93,7 @@ class Summary():
         else:
             print('Write summary to file')
             
-            content = ['#Date, Filter, Stars, % Good Stars, ZeroPoint, Extinction, SkyBrightness, CloudCoverage\n']
-            for line in self.summary_content:
-                content_line = ""
-                for element in line:
-                    content_line += element
-                content.append(content_line+", ")
+            content = self.summary_file_content(self.summary_content)
             
             if ImageInfo.summary_path == "screen":
                 print(content)